@@ -0,0 +1,251 @@
+import re
+import time
+from sqlalchemy import Table, Column
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression
+
+#A proposed index is kept only if it makes its statements at least this much
+#faster, smaller gains are within timing noise
+MIN_SPEEDUP = 1.25
+#Runs per statement when timing, the fastest one counts
+TIMING_RUNS = 5
+
+#EXPLAIN QUERY PLAN details, e.g. "SCAN fact_payment", "SEARCH main.fact_rental
+#USING INDEX idx_fact_rental_id (rental_id=?)", "USE TEMP B-TREE FOR GROUP BY"
+_ACCESS = re.compile(r"^(SCAN|SEARCH) (?:(\w+)\.)?(\w+)(?: AS \w+)?(?: USING (.*))?$")
+_TEMP_BTREE = re.compile(r"^USE TEMP B-TREE FOR (.*)$")
+
+_FILTERS = (operators.eq, operators.in_op)
+
+
+class Finding:
+    """A plan step worth an index: a full scan, index lookups that go back to
+    the table, an automatic index SQLite builds on every run or a temp B-tree
+    for sorting/grouping."""
+
+    def __init__(self, kind, schema, table, detail):
+        self.kind = kind
+        self.schema = schema
+        self.table = table
+        self.detail = detail
+
+
+class Proposal:
+    """An index on table's columns, built in every schema (main and any
+    attached year files) where the table showed up in a finding."""
+
+    def __init__(self, table, columns, where=None):
+        self.table = table
+        self.columns = tuple(columns)
+        self.where = where
+        self.schemas = []
+        self.statements = []
+        self.before = self.after = None
+        self.kept = False
+
+    @property
+    def name(self):
+        return f"idx_advise_{self.table}_{'_'.join(self.columns)}"[:60]
+
+    def create_sql(self):
+        where = f" WHERE {self.where}" if self.where else ""
+        return [f"CREATE INDEX IF NOT EXISTS {schema}.{self.name} ON {self.table} ({', '.join(self.columns)}){where}"
+                for schema in self.schemas]
+
+    def drop_sql(self):
+        return [f"DROP INDEX IF EXISTS {schema}.{self.name}" for schema in self.schemas]
+
+    def describe(self):
+        kind = "partial index" if self.where else "index"
+        where = f" WHERE {self.where}" if self.where else ""
+        schemas = f" in {', '.join(self.schemas)}" if self.schemas != ['main'] else ""
+        return f"{kind} {self.table}({', '.join(self.columns)}){where}{schemas}"
+
+
+def compile_statement(statement, dialect):
+    """(sql, params) of a Core/ORM statement, IN lists expanded."""
+    compiled = statement.compile(dialect=dialect, compile_kwargs={"render_postcompile": True})
+    return str(compiled), tuple(compiled.params[name] for name in compiled.positiontup or ())
+
+
+def explain(conn, sql, params):
+    return [row[3] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def plan_findings(plan, tables):
+    """Findings in an EXPLAIN QUERY PLAN, for steps on the given table names.
+    Scans of subqueries and views are left out, their arms are listed on their own."""
+    findings = []
+    for detail in plan:
+        access = _ACCESS.match(detail)
+        if access:
+            step, schema, table, using = access.groups()
+            if table not in tables:
+                continue
+            using = using or ""
+            if "AUTOMATIC" in using:
+                findings.append(Finding('automatic index', schema or 'main', table, detail))
+            elif step == 'SCAN' and "COVERING" not in using:
+                findings.append(Finding('full scan', schema or 'main', table, detail))
+            elif step == 'SEARCH' and using.startswith("INDEX"):
+                findings.append(Finding('table lookups', schema or 'main', table, detail))
+        elif _TEMP_BTREE.match(detail):
+            findings.append(Finding('temp b-tree', None, None, detail))
+    return findings
+
+
+def statement_columns(statement):
+    """{table name: (filtered, grouped, used)} columns of every table the
+    statement reads. filtered are compared with = or IN (in WHERE or a join's
+    ON), grouped are in GROUP BY / ORDER BY, used are all referenced ones.
+    nulls holds 'column IS [NOT] NULL' terms, candidates for a partial index."""
+    columns = {}
+
+    def entry(column):
+        return columns.setdefault(column.table.name, {'filtered': [], 'grouped': [], 'used': [], 'nulls': []})
+
+    def add(column, kind):
+        if isinstance(column, Column) and isinstance(column.table, Table):
+            names = entry(column)[kind]
+            if column.name not in names:
+                names.append(column.name)
+
+    for element in visitors.iterate(statement):
+        if isinstance(element, BinaryExpression):
+            if element.operator in _FILTERS:
+                add(element.left, 'filtered')
+                add(element.right, 'filtered')
+            elif element.operator in (operators.is_, operators.is_not) and isinstance(element.left, Column):
+                term = f"{element.left.name} IS {'NOT ' if element.operator is operators.is_not else ''}NULL"
+                if isinstance(element.left.table, Table):
+                    entry(element.left)['nulls'].append(term)
+        add(element, 'used')
+    for clause in getattr(statement, '_group_by_clauses', ()) + getattr(statement, '_order_by_clauses', ()):
+        add(clause, 'grouped')
+    return columns
+
+
+def candidate(finding, columns, existing):
+    """The index that would serve finding: the filtered columns, then the
+    grouped ones, then the rest of the table's columns the statement uses, so
+    the index covers it. None when there is nothing to search on or an index
+    with those columns exists already."""
+    table_columns = columns.get(finding.table)
+    if table_columns is None or not (table_columns['filtered'] or table_columns['grouped']):
+        return None
+    ordered = []
+    for kind in ('filtered', 'grouped', 'used'):
+        ordered += [name for name in table_columns[kind] if name not in ordered]
+    if any(index[:len(ordered)] == tuple(ordered) for index in existing):
+        return None
+    where = table_columns['nulls'][0] if len(table_columns['nulls']) == 1 else None
+    return Proposal(finding.table, ordered, where)
+
+
+def merge_prefixes(proposals):
+    """Drops proposals whose columns start another proposal on the same table,
+    that one serves their statements too."""
+    merged = {}
+    for key, proposal in sorted(proposals.items(), key=lambda item: -len(item[1].columns)):
+        longer = next((other for other in merged.values()
+                       if (other.table, other.where) == (proposal.table, proposal.where)
+                       and other.columns[:len(proposal.columns)] == proposal.columns), None)
+        if longer is None:
+            merged[key] = proposal
+        else:
+            longer.schemas += [s for s in proposal.schemas if s not in longer.schemas]
+            longer.statements += [s for s in proposal.statements if s not in longer.statements]
+    return merged
+
+
+def existing_indexes(conn, schema, table):
+    """Column tuples of table's indexes in schema."""
+    indexes = []
+    for row in conn.exec_driver_sql(f"PRAGMA {schema}.index_list({table})").fetchall():
+        indexes.append(tuple(r[2] for r in conn.exec_driver_sql(f"PRAGMA {schema}.index_info({row[1]})")))
+    return indexes
+
+
+def time_statement(conn, sql, params, runs=TIMING_RUNS):
+    """Fastest of runs executions. Each run is rolled back, so timing a
+    DELETE or UPDATE leaves the data as it was."""
+    best = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = conn.exec_driver_sql(sql, params)
+        if result.returns_rows:
+            result.fetchall()
+        elapsed = time.perf_counter() - started
+        conn.rollback()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def advise(engine, workload, tables, apply=False):
+    """Explains every (name, statement) of the workload on engine and proposes
+    indexes for the full scans, table lookups, automatic indexes and temp
+    B-trees found. With apply, each proposal is built and kept only if its
+    statements got MIN_SPEEDUP times faster. Returns the proposals."""
+    proposals = {}
+    with engine.connect() as conn:
+        print(f"Explaining {len(workload)} statements")
+        for name, statement in workload:
+            sql, params = compile_statement(statement, engine.dialect)
+            try:
+                findings = plan_findings(explain(conn, sql, params), tables)
+            except DBAPIError as e: #e.g. a DELETE on a fact table that is a view over year files
+                print(f"  {name}: skipped, {e.orig}")
+                continue
+            if not statement.is_select: #A write reads the whole row anyway
+                findings = [finding for finding in findings if finding.kind != 'table lookups']
+            if not findings:
+                print(f"  {name}: ok")
+                continue
+            columns = statement_columns(statement)
+            for detail in dict.fromkeys(f"{finding.kind} - {finding.detail}" for finding in findings):
+                print(f"  {name}: {detail}")
+            for finding in findings:
+                targets = [finding]
+                if finding.kind == 'temp b-tree':
+                    #Sorting is saved by an index on the grouped table
+                    targets = [Finding(finding.kind, 'main', table, finding.detail)
+                               for table, c in columns.items() if c['grouped'] and table in tables]
+                for target in targets:
+                    proposal = candidate(target, columns, existing_indexes(conn, target.schema, target.table))
+                    if proposal is None:
+                        continue
+                    proposal = proposals.setdefault((proposal.table, proposal.columns, proposal.where), proposal)
+                    if target.schema not in proposal.schemas:
+                        proposal.schemas.append(target.schema)
+                    if (sql, params) not in proposal.statements:
+                        proposal.statements.append((sql, params))
+        conn.rollback()
+        proposals = merge_prefixes(proposals)
+
+        if not proposals:
+            print("No indexes to propose.")
+            return []
+        print("Proposed indexes:")
+        for proposal in proposals.values():
+            for sql in proposal.create_sql():
+                print(f"  {sql}")
+        if not apply:
+            return list(proposals.values())
+
+        print("Building and measuring:")
+        for proposal in proposals.values():
+            proposal.before = sum(time_statement(conn, sql, params) for sql, params in proposal.statements)
+            for sql in proposal.create_sql():
+                conn.exec_driver_sql(sql)
+            conn.commit()
+            proposal.after = sum(time_statement(conn, sql, params) for sql, params in proposal.statements)
+            proposal.kept = proposal.before >= proposal.after * MIN_SPEEDUP
+            if not proposal.kept:
+                for sql in proposal.drop_sql():
+                    conn.exec_driver_sql(sql)
+                conn.commit()
+            print(f"  {proposal.describe()}: {proposal.before * 1000:.2f}ms -> {proposal.after * 1000:.2f}ms "
+                  f"({proposal.before / max(proposal.after, 1e-9):.1f}x), "
+                  + ("kept" if proposal.kept else "dropped"))
+    return list(proposals.values())
@@ -0,0 +1,287 @@
+"""Throughput benchmarks for the sync commands.
+
+    python bench.py --scales 1 10 --change-rate 0.01
+
+For every scale a Sakila-shaped source is generated into a SQLite file that
+stands in for MySQL (reused on later runs unless --regenerate). Then init,
+full-load, incremental and validate run through main.py, each in its own
+process, pointed at it with MYSQL_URL / SQLITE_URL. Wall time, peak RSS and
+rows/sec of every stage are written to --out as JSON."""
+import argparse
+import json
+import os
+import random
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, insert, update, select, func
+from models import SakilaBase, Language, Category, Actor, Country, City, Address
+from models import Store, Staff, Customer, Film, FilmActor, FilmCategory, Inventory, Rental, Payment
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+#Row counts of the real Sakila. Only rentals and payments grow with the scale,
+#the catalogue and customers stay Sakila sized
+SAKILA_COUNTS = {
+    'actor': 200, 'category': 16, 'language': 6, 'country': 109, 'city': 600,
+    'address': 603, 'customer': 599, 'film': 1000, 'film_actor': 5462, 'inventory': 4581,
+    'rental': 16044,
+}
+#Rentals are spread over Sakila's own date range at every scale, so bigger
+#scales mean busier days rather than more of them
+RENTAL_START = datetime(2005, 5, 24, 22, 53, 30)
+RENTAL_SPAN = timedelta(days=266)
+SOURCE_LAST_UPDATE = datetime(2006, 2, 15, 4, 34, 33)
+#Rows per executemany while generating
+GEN_BATCH = 20000
+
+STAGES = ('init', 'full-load', 'incremental-catchup', 'incremental', 'validate')
+
+
+#GENERATOR
+def generate_source(url, scale, seed=1):
+    """Writes a Sakila-shaped source with scale x the rental/payment volume.
+    Rentals and payments are written in batches, so memory stays flat at 1000x."""
+    rnd = random.Random(seed)
+    engine = create_engine(url)
+    SakilaBase.metadata.drop_all(engine)
+    SakilaBase.metadata.create_all(engine)
+    n = SAKILA_COUNTS
+    lu = SOURCE_LAST_UPDATE
+
+    with engine.begin() as conn:
+        if engine.dialect.name == 'sqlite':
+            conn.exec_driver_sql("PRAGMA synchronous = OFF")
+        conn.execute(insert(Language), [{'language_id': i, 'name': f'Language {i}', 'last_update': lu}
+                                        for i in range(1, n['language'] + 1)])
+        conn.execute(insert(Category), [{'category_id': i, 'name': f'Category {i}', 'last_update': lu}
+                                        for i in range(1, n['category'] + 1)])
+        conn.execute(insert(Actor), [{'actor_id': i, 'first_name': f'First{i}', 'last_name': f'Last{i}',
+                                      'last_update': lu} for i in range(1, n['actor'] + 1)])
+        conn.execute(insert(Country), [{'country_id': i, 'country': f'Country {i}', 'last_update': lu}
+                                       for i in range(1, n['country'] + 1)])
+        conn.execute(insert(City), [{'city_id': i, 'city': f'City {i}', 'country_id': rnd.randint(1, n['country']),
+                                     'last_update': lu} for i in range(1, n['city'] + 1)])
+        conn.execute(insert(Address), [{'address_id': i, 'address': f'{i} Sakila Drive',
+                                        'city_id': rnd.randint(1, n['city']), 'postal_code': f'{i:05d}',
+                                        'last_update': lu} for i in range(1, n['address'] + 1)])
+        #Staff and stores point at each other, the staff rows go in first
+        conn.execute(insert(Staff), [{'staff_id': i, 'first_name': f'Staff{i}', 'last_name': f'Staff{i}',
+                                      'address_id': i, 'store_id': i, 'active': True, 'username': f'staff{i}',
+                                      'last_update': lu} for i in (1, 2)])
+        conn.execute(insert(Store), [{'store_id': i, 'manager_staff_id': i, 'address_id': i + 2,
+                                      'last_update': lu} for i in (1, 2)])
+        conn.execute(insert(Customer), [{'customer_id': i, 'store_id': rnd.randint(1, 2), 'first_name': f'First{i}',
+                                         'last_name': f'Last{i}', 'email': f'customer{i}@sakilacustomer.org',
+                                         'address_id': i + 4, 'active': True, 'create_date': lu, 'last_update': lu}
+                                        for i in range(1, n['customer'] + 1)])
+        conn.execute(insert(Film), [{'film_id': i, 'title': f'Film {i}', 'release_year': 2006,
+                                     'language_id': 1, 'rating': rnd.choice(('G', 'PG', 'PG-13', 'R', 'NC-17')),
+                                     'length': rnd.randint(46, 185), 'last_update': lu}
+                                    for i in range(1, n['film'] + 1)])
+        pairs = set()
+        while len(pairs) < n['film_actor']:
+            pairs.add((rnd.randint(1, n['actor']), rnd.randint(1, n['film'])))
+        conn.execute(insert(FilmActor), [{'actor_id': a, 'film_id': f, 'last_update': lu} for a, f in sorted(pairs)])
+        conn.execute(insert(FilmCategory), [{'film_id': i, 'category_id': rnd.randint(1, n['category']),
+                                             'last_update': lu} for i in range(1, n['film'] + 1)])
+        conn.execute(insert(Inventory), [{'inventory_id': i, 'film_id': rnd.randint(1, n['film']),
+                                          'store_id': rnd.randint(1, 2), 'last_update': lu}
+                                         for i in range(1, n['inventory'] + 1)])
+
+        total = n['rental'] * scale
+        step = RENTAL_SPAN / total
+        for start in range(1, total + 1, GEN_BATCH):
+            rentals, payments = [], []
+            for i in range(start, min(start + GEN_BATCH, total + 1)):
+                rented = RENTAL_START + step * (i - 1)
+                customer_id, staff_id = rnd.randint(1, n['customer']), rnd.randint(1, 2)
+                #Like Sakila, a handful of rentals are never returned
+                returned = rented + timedelta(days=rnd.randint(1, 9), hours=rnd.randint(0, 23)) if i % 87 else None
+                rentals.append({'rental_id': i, 'rental_date': rented, 'inventory_id': rnd.randint(1, n['inventory']),
+                                'customer_id': customer_id, 'return_date': returned, 'staff_id': staff_id,
+                                'last_update': lu})
+                payments.append({'payment_id': i, 'customer_id': customer_id, 'staff_id': staff_id,
+                                 'rental_id': i, 'amount': rnd.choice((0.99, 2.99, 4.99, 6.99, 9.99)),
+                                 'payment_date': rented, 'last_update': lu})
+            conn.execute(insert(Rental), rentals)
+            conn.execute(insert(Payment), payments)
+    engine.dispose()
+    return source_counts(url)
+
+
+def source_counts(url):
+    engine = create_engine(url)
+    with engine.connect() as conn:
+        counts = {model.__tablename__: conn.execute(select(func.count()).select_from(model)).scalar()
+                  for model in (Customer, Film, FilmActor, Inventory, Rental, Payment)}
+    engine.dispose()
+    return counts
+
+
+def apply_changes(url, rate, seed=2):
+    """Changes rate x the source's rentals for an incremental run: half of them
+    are returned (updated along with their payment), the other half are new
+    rentals with a payment each. Returns how many rows were touched per kind."""
+    rnd = random.Random(seed)
+    engine = create_engine(url)
+    now = datetime.now()
+    with engine.begin() as conn:
+        total, last_id, last_date = conn.execute(
+            select(func.count(), func.max(Rental.rental_id), func.max(Rental.rental_date))
+        ).one()
+        changed = max(1, int(total * rate))
+        updated = rnd.sample(range(1, last_id + 1), changed // 2)
+        for start in range(0, len(updated), 500):
+            ids = updated[start:start + 500]
+            conn.execute(update(Rental).where(Rental.rental_id.in_(ids))
+                         .values(return_date=now, last_update=now))
+            conn.execute(update(Payment).where(Payment.rental_id.in_(ids))
+                         .values(amount=Payment.amount + 1, last_update=now))
+
+        if isinstance(last_date, str):
+            last_date = datetime.fromisoformat(last_date)
+        added = changed - len(updated)
+        rentals, payments = [], []
+        for i in range(last_id + 1, last_id + added + 1):
+            rented = last_date + timedelta(minutes=i - last_id)
+            customer_id, staff_id = rnd.randint(1, SAKILA_COUNTS['customer']), rnd.randint(1, 2)
+            rentals.append({'rental_id': i, 'rental_date': rented, 'inventory_id': rnd.randint(1, SAKILA_COUNTS['inventory']),
+                            'customer_id': customer_id, 'return_date': None, 'staff_id': staff_id, 'last_update': now})
+            payments.append({'payment_id': i, 'customer_id': customer_id, 'staff_id': staff_id, 'rental_id': i,
+                             'amount': 4.99, 'payment_date': rented, 'last_update': now})
+        for start in range(0, len(rentals), GEN_BATCH):
+            conn.execute(insert(Rental), rentals[start:start + GEN_BATCH])
+            conn.execute(insert(Payment), payments[start:start + GEN_BATCH])
+    engine.dispose()
+    return {'rental_updates': len(updated), 'payment_updates': len(updated),
+            'rental_inserts': added, 'payment_inserts': added}
+
+
+#RUNNER
+def run_stage(stage, args, env):
+    """Runs one main.py command in its own process. Peak RSS comes from wait4,
+    so it is that process's alone."""
+    with tempfile.TemporaryFile(mode='w+') as out:
+        started = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, os.path.join(HERE, 'main.py'), *args],
+                                stdout=out, stderr=subprocess.STDOUT, env=env, cwd=HERE)
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - started
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        out.seek(0)
+        output = out.read()
+    #The CLI reports most failures in its output rather than the exit code
+    ok = proc.returncode == 0 and not re.search(r'FAILED|Transaction rollback|ERROR', output)
+    return {'stage': stage, 'args': args, 'ok': ok, 'wall_s': round(wall, 3),
+            'peak_rss_kb': usage.ru_maxrss, 'output': output}
+
+
+def stage_rows(result, source_rows, changes):
+    """Rows a stage moved, per table where the output says so."""
+    output = result['output']
+    if result['stage'] == 'init':
+        staged = re.search(r'staged (\d+) dates', output)
+        return {'dim_date': int(staged.group(1))} if staged else {}
+    if result['stage'] == 'full-load':
+        return {table: int(count) for count, table in re.findall(r'Loaded (\d+) records into (\w+)', output)}
+    if result['stage'].startswith('incremental'):
+        processed = re.search(r'Processed (\d+) rentals and (\d+) payments', output)
+        if result['stage'] == 'incremental' and not processed:
+            return changes
+        return {'rental': int(processed.group(1)), 'payment': int(processed.group(2))} if processed else {}
+    return {'rental': source_rows['rental'], 'payment': source_rows['payment']}
+
+
+def bench_scale(scale, args):
+    source_path = os.path.join(args.workdir, f'sakila_{scale}x.db')
+    warehouse_path = os.path.join(args.workdir, f'warehouse_{scale}x.db')
+    source_url, warehouse_url = f'sqlite:///{source_path}', f'sqlite:///{warehouse_path}'
+    result = {'scale': scale, 'stages': []}
+
+    if args.regenerate or not os.path.exists(source_path):
+        print(f"[{scale}x] generating source")
+        started = time.perf_counter()
+        source_rows = generate_source(source_url, scale)
+        wall = time.perf_counter() - started
+        result['generate'] = {'wall_s': round(wall, 3), 'rows': source_rows}
+    else:
+        source_rows = source_counts(source_url)
+    result['source_rows'] = source_rows
+    if os.path.exists(warehouse_path):
+        os.remove(warehouse_path)
+
+    env = dict(os.environ, MYSQL_URL=source_url, SQLITE_URL=warehouse_url)
+    commands = {
+        'init': ['init'],
+        'full-load': ['full-load', *shlex.split(args.full_load_args)],
+        #Brings sync_state up to the source, so the measured incremental only
+        #sees the changes made for it
+        'incremental-catchup': ['incremental', *shlex.split(args.incremental_args)],
+        'incremental': ['incremental', *shlex.split(args.incremental_args)],
+        'validate': ['validate'],
+    }
+    changes = {}
+    for stage in STAGES:
+        if stage == 'incremental':
+            changes = apply_changes(source_url, args.change_rate)
+            result['changes'] = changes
+        print(f"[{scale}x] {stage}")
+        stage_result = run_stage(stage, commands[stage], env)
+        rows = stage_rows(stage_result, source_rows, changes)
+        stage_result['rows'] = rows
+        stage_result['rows_per_sec'] = round(sum(rows.values()) / stage_result['wall_s'], 1) if stage_result['wall_s'] else 0
+        if stage_result['ok']:
+            del stage_result['output']
+        else:
+            print(f"[{scale}x] {stage} failed:\n{stage_result['output']}")
+        result['stages'].append(stage_result)
+        if not stage_result['ok']:
+            break
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark init / full-load / incremental / validate")
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10],
+                        help='Rental/payment volume as multiples of Sakila (e.g. 1 10 100 1000).')
+    parser.add_argument('--change-rate', type=float, default=0.01,
+                        help='Fraction of rentals changed before the measured incremental run.')
+    parser.add_argument('--workdir', default=os.path.join(HERE, 'bench_data'),
+                        help='Where generated sources and warehouses are kept.')
+    parser.add_argument('--out', default='bench_results.json', help='Results file.')
+    parser.add_argument('--regenerate', action='store_true', help='Regenerate sources that already exist.')
+    parser.add_argument('--full-load-args', default='', help='Extra full-load flags, e.g. --full-load-args="--workers 4".')
+    parser.add_argument('--incremental-args', default='', help='Extra incremental flags, e.g. --incremental-args=--pipeline.')
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    report = {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'change_rate': args.change_rate,
+        'full_load_args': args.full_load_args,
+        'incremental_args': args.incremental_args,
+        'results': [],
+    }
+    for scale in args.scales:
+        report['results'].append(bench_scale(scale, args))
+        #Written after every scale, so a long 1000x run still leaves the smaller ones
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    print(f"\n{'scale':>6} {'stage':<20} {'wall s':>9} {'rows/s':>11} {'peak RSS MB':>12}")
+    for result in report['results']:
+        for stage in result['stages']:
+            print(f"{result['scale']:>5}x {stage['stage']:<20} {stage['wall_s']:>9.2f} "
+                  f"{stage['rows_per_sec']:>11.0f} {stage['peak_rss_kb'] / 1024:>12.1f}"
+                  + ("" if stage['ok'] else "  FAILED"))
+    print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,8 +9,9 @@ MYSQL_HOST = "172.31.144.1"
 MYSQL_PORT = "3306"
 MYSQL_DB = "sakila"
 
-MYSQL_URI = f"mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DB}"
-SQLITE_URI = "sqlite:///sakila_analytics.db"
+#MYSQL_URL / SQLITE_URL override these, e.g. to point at a generated stand-in source
+MYSQL_URI = os.environ.get("MYSQL_URL", f"mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DB}")
+SQLITE_URI = os.environ.get("SQLITE_URL", "sqlite:///sakila_analytics.db")
 
 mysql_engine = create_engine(MYSQL_URI, echo=False)
 sqlite_engine = create_engine(SQLITE_URI, echo=False)
@@ -0,0 +1,246 @@
+from array import array
+from sqlalchemy import event
+from models import DimActor, DimFilm, DimCustomer, DimStore, DimCategory
+
+#Natural key -> looked up column, per warehouse table.
+LOOKUPS = {
+    DimActor: ('actor_id', 'actor_key'),
+    DimFilm: ('film_id', 'film_key'),
+    DimCustomer: ('customer_id', 'customer_key'),
+    DimStore: ('store_id', 'store_key'),
+    DimCategory: ('category_id', 'category_key'),
+}
+
+#Batches up to this many unknown keys are resolved with indexed IN lookups,
+#bigger ones load the whole map once
+SMALL_BATCH = 2000
+#Bound parameters per IN lookup, under SQLite's variable limit
+LOOKUP_CHUNK = 500
+#A KeyMap keeps ids in its array while it spans at most this many slots per
+#id stored, past that they go to its dict
+DENSE_SPAN = 4
+#Batches at least this big are looked up with numpy, when it is installed
+NUMPY_BATCH = 64
+
+try:
+    import numpy as np
+except ImportError: #Optional, batch lookups then run in pure Python
+    np = None
+
+
+class KeyMap:
+    """Integer natural id -> surrogate key map, used like a dict. Dense ids
+    (the usual AUTO_INCREMENT range) are stored in an array of 8-byte keys
+    indexed by id - base, 0 marking a missing id, which is ~9 bytes per entry
+    instead of ~100 for a dict. Ids far outside that range, non-integer ids
+    and keys that are not positive integers go to a plain dict."""
+
+    def __init__(self, pairs=()):
+        self.base = 0
+        self.slots = array('q')
+        self.dense = 0
+        self.sparse = {}
+        self.update(pairs)
+
+    def __len__(self):
+        return self.dense + len(self.sparse)
+
+    def _slot(self, natural_id):
+        """Array index of natural_id, None when it lies outside the array."""
+        if type(natural_id) is int:
+            slot = natural_id - self.base
+            if 0 <= slot < len(self.slots):
+                return slot
+        return None
+
+    def get(self, natural_id, default=None):
+        slot = self._slot(natural_id)
+        if slot is not None and self.slots[slot]:
+            return self.slots[slot]
+        return self.sparse.get(natural_id, default)
+
+    def __getitem__(self, natural_id):
+        slot = self._slot(natural_id)
+        if slot is not None and self.slots[slot]:
+            return self.slots[slot]
+        return self.sparse[natural_id]
+
+    def __contains__(self, natural_id):
+        slot = self._slot(natural_id)
+        return bool(slot is not None and self.slots[slot]) or natural_id in self.sparse
+
+    def _cover(self, low, high, count):
+        """Widens the array to ids low..high - 1 if it then holds at least one
+        id per DENSE_SPAN slots, counting count more ids. Extends by half its
+        size at a time, so ids arriving in order are cheap."""
+        if self.slots:
+            low, high = min(low, self.base), max(high, self.base + len(self.slots))
+        limit = DENSE_SPAN * (self.dense + count)
+        if high - low > limit:
+            return False
+        if not self.slots:
+            self.base = low
+        if low < self.base:
+            self.slots[:0] = array('q', bytes(8 * (self.base - low)))
+            self.base = low
+        size = len(self.slots)
+        if high - low > size:
+            size = min(max(high - low, size * 3 // 2), limit)
+            self.slots.extend(array('q', bytes(8 * (size - len(self.slots)))))
+        return True
+
+    def __setitem__(self, natural_id, key):
+        self.pop(natural_id)
+        dense_key = type(natural_id) is int and type(key) is int and key > 0
+        if dense_key and (self._slot(natural_id) is not None or self._cover(natural_id, natural_id + 1, 1)):
+            self.slots[natural_id - self.base] = key
+            self.dense += 1
+        else:
+            self.sparse[natural_id] = key
+
+    def pop(self, natural_id, default=None):
+        slot = self._slot(natural_id)
+        if slot is not None and self.slots[slot]:
+            key, self.slots[slot] = self.slots[slot], 0
+            self.dense -= 1
+            return key
+        return self.sparse.pop(natural_id, default)
+
+    def update(self, pairs):
+        """Adds many pairs at once. Integer pairs are staged in two arrays, the
+        array is widened once for all of them and filled in one pass."""
+        ids, keys = array('q'), array('q')
+        for natural_id, key in (pairs.items() if hasattr(pairs, 'items') else pairs):
+            if type(natural_id) is int and type(key) is int and key > 0:
+                ids.append(natural_id)
+                keys.append(key)
+            else:
+                self[natural_id] = key
+        if not ids:
+            return
+        if not self._cover(min(ids), max(ids) + 1, len(ids)):
+            for natural_id, key in zip(ids, keys):
+                self[natural_id] = key
+            return
+        slots, base, sparse = self.slots, self.base, self.sparse
+        for natural_id, key in zip(ids, keys):
+            slot = natural_id - base
+            if not slots[slot]:
+                self.dense += 1
+            slots[slot] = key
+            if sparse:
+                sparse.pop(natural_id, None)
+
+    def items(self):
+        base = self.base
+        for slot, key in enumerate(self.slots):
+            if key:
+                yield base + slot, key
+        yield from self.sparse.items()
+
+    def __iter__(self):
+        return (natural_id for natural_id, _ in self.items())
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return (key for _, key in self.items())
+
+    def get_many(self, ids):
+        """Keys of a whole chunk of ids at once, None where an id is missing.
+        With numpy the array part is a single gather over the chunk."""
+        slots, base = self.slots, self.base
+        if np is not None and len(ids) >= NUMPY_BATCH and slots:
+            try:
+                index = np.fromiter(ids, dtype=np.int64, count=len(ids)) - base
+            except (TypeError, ValueError, OverflowError): #None or non-integer ids
+                index = None
+            if index is not None:
+                inside = (index >= 0) & (index < len(slots))
+                found = np.zeros(len(ids), dtype=np.int64)
+                found[inside] = np.frombuffer(slots, dtype=np.int64)[index[inside]]
+                result = found.astype(object)
+                result[found == 0] = None
+                result = result.tolist()
+                if self.sparse:
+                    get = self.sparse.get
+                    result = [key if key is not None else get(i) for i, key in zip(ids, result)]
+                return result
+        size, get = len(slots), self.sparse.get
+        return [slots[i - base] or get(i) if type(i) is int and 0 <= i - base < size else get(i)
+                for i in ids]
+
+
+class KeyCache:
+    """Natural -> surrogate key maps for one sync run, shared by every
+    sync function. Maps are filled lazily: small batches only fetch the keys
+    they need, large ones load the table once and reuse it."""
+
+    def __init__(self, sqlite_session, small_batch=SMALL_BATCH):
+        self.session = sqlite_session
+        self.small_batch = small_batch
+        self.maps = {model: KeyMap() for model in LOOKUPS}
+        self.complete = set()
+
+    def _columns(self, model):
+        id_name, key_name = LOOKUPS[model]
+        return getattr(model, id_name), getattr(model, key_name)
+
+    def full_map(self, model):
+        """Whole natural -> surrogate KeyMap, loaded at most once per run."""
+        if model not in self.complete:
+            self.session.flush()
+            id_col, key_col = self._columns(model)
+            self.maps[model] = KeyMap(self.session.query(id_col, key_col).order_by(id_col))
+            self.complete.add(model)
+        return self.maps[model]
+
+    def _lookup(self, model, ids):
+        """Indexed lookup of just these ids, merged into the cached map."""
+        self.session.flush()
+        id_col, key_col = self._columns(model)
+        ids = list(ids)
+        for start in range(0, len(ids), LOOKUP_CHUNK):
+            rows = self.session.query(id_col, key_col).filter(id_col.in_(ids[start:start + LOOKUP_CHUNK]))
+            self.maps[model].update((row[0], row[1]) for row in rows)
+
+    def resolve(self, model, ids):
+        """Returns {natural id: surrogate key} for the given ids. Ids that do
+        not exist in the warehouse are left out."""
+        if model in self.complete:
+            cached = self.maps[model]
+        else:
+            cached = self.maps[model]
+            missing = {i for i in ids if i is not None and i not in cached}
+            if len(missing) > self.small_batch:
+                cached = self.full_map(model)
+            elif missing:
+                self._lookup(model, missing)
+        return {i: cached[i] for i in ids if i in cached}
+
+    def refresh(self, model, ids):
+        """Re-reads the given ids after they were written, so new keys show up
+        and changed ones are not served stale."""
+        ids = [i for i in ids if i is not None]
+        cached = self.maps[model]
+        for i in ids:
+            cached.pop(i, None)
+        if ids and (model in self.complete or len(ids) <= self.small_batch):
+            self._lookup(model, ids)
+
+
+def get_key_cache(sqlite_session):
+    """The KeyCache of this session, created on first use. It is dropped on
+    rollback, since keys written in the rolled back transaction are gone."""
+    cache = sqlite_session.info.get('key_cache')
+    if cache is None:
+        cache = sqlite_session.info['key_cache'] = KeyCache(sqlite_session)
+        if not sqlite_session.info.get('key_cache_listener'):
+            event.listen(sqlite_session, 'after_soft_rollback', _drop_key_cache)
+            sqlite_session.info['key_cache_listener'] = True
+    return cache
+
+
+def _drop_key_cache(session, previous_transaction):
+    session.info.pop('key_cache', None)
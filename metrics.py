@@ -0,0 +1,211 @@
+import json
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from sqlalchemy import insert
+from models import SyncRun
+
+try:
+    import resource
+except ImportError: #Not on Windows, memory is then left out
+    resource = None
+
+#One JSON record per run is appended here (JSON lines)
+METRICS_PATH = os.environ.get('SYNC_METRICS_FILE', 'sync_metrics.jsonl')
+
+PHASES = ('extract', 'transform', 'load')
+
+
+def peak_rss_kb():
+    """High-water mark of this process's resident memory."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+
+
+class StageMetrics:
+    """Timings and row counts of one stage (a table in full-load, one of the
+    sync functions in incremental)."""
+
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.rows_read = 0
+        self.rows_written = 0
+        self.rows_skipped = 0
+        self.peak_rss_kb = None
+        self.rss_growth_kb = None
+
+    def as_dict(self):
+        record = {'stage': self.name, 'wall_s': round(self.wall, 4)}
+        record.update({f'{phase}_s': round(seconds, 4) for phase, seconds in self.phases.items()})
+        record.update(rows_read=self.rows_read, rows_written=self.rows_written,
+                      rows_skipped=self.rows_skipped, peak_rss_kb=self.peak_rss_kb, rss_growth_kb=self.rss_growth_kb)
+        return record
+
+
+class RunMetrics:
+    """Metrics of one sync run. Stages are timed as a whole and split into
+    extract / transform / load phases. Phases nest and each is timed exclusive
+    of the ones nested in it, so a load inside a transform is not counted twice."""
+
+    def __init__(self, command):
+        self.command = command
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self.stages = []
+        self.current = None
+        self._phases = []
+
+    @contextmanager
+    def stage(self, name):
+        stage = StageMetrics(name)
+        self.stages.append(stage)
+        previous, self.current = self.current, stage
+        rss_before = peak_rss_kb()
+        started = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.wall += time.perf_counter() - started
+            stage.peak_rss_kb = peak_rss_kb()
+            if rss_before is not None:
+                stage.rss_growth_kb = stage.peak_rss_kb - rss_before
+            self.current = previous
+
+    @contextmanager
+    def phase(self, name):
+        stage = self.current
+        if stage is None:
+            yield
+            return
+        #[started, time spent in nested phases]
+        frame = [time.perf_counter(), 0.0]
+        self._phases.append(frame)
+        try:
+            yield
+        finally:
+            self._phases.pop()
+            elapsed = time.perf_counter() - frame[0]
+            stage.phases[name] += elapsed - frame[1]
+            if self._phases:
+                self._phases[-1][1] += elapsed
+
+    def count(self, read=0, written=0, skipped=0):
+        """skipped counts rows that needed no write, e.g. unchanged dimension rows."""
+        if self.current is not None:
+            self.current.rows_read += read
+            self.current.rows_written += written
+            self.current.rows_skipped += skipped
+
+    def add_phase(self, name, seconds):
+        """Adds time spent on the current stage's behalf elsewhere, e.g. an
+        extract run ahead on a worker thread."""
+        if self.current is not None:
+            self.current.phases[name] += seconds
+
+    def add_pipeline(self, pipe):
+        """Takes the stage timings of a pipeline.Pipeline run inside the current
+        stage. Its stages overlap, so the phases can add up to more than wall."""
+        if self.current is None:
+            return
+        for stats in pipe.stages:
+            self.current.phases[stats.name] += stats.busy
+        self.current.rows_read += pipe.stages[0].rows
+        self.current.rows_written += pipe.stages[-1].rows
+
+    def record(self, status):
+        stages = [stage.as_dict() for stage in self.stages]
+        return {
+            'command': self.command,
+            'status': status,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'finished_at': datetime.now().isoformat(timespec='seconds'),
+            'wall_s': round(time.perf_counter() - self.started, 4),
+            'rows_read': sum(stage['rows_read'] for stage in stages),
+            'rows_written': sum(stage['rows_written'] for stage in stages),
+            'rows_skipped': sum(stage['rows_skipped'] for stage in stages),
+            'peak_rss_kb': peak_rss_kb(),
+            'stages': stages,
+        }
+
+
+def start_run(command, *sessions):
+    """Creates the run's metrics and attaches them to the given SQLite sessions."""
+    run = RunMetrics(command)
+    for session in sessions:
+        attach(session, run)
+    return run
+
+
+def attach(session, run):
+    session.info['metrics'] = run
+
+
+def finish_run(run, status, engine, path=None):
+    """Writes the run's JSON record and its sync_run row. The row is written in
+    its own transaction, so runs that rolled back are recorded too. Failing to
+    record never fails the sync."""
+    record = run.record(status)
+    try:
+        with open(path or METRICS_PATH, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        SyncRun.__table__.create(engine, checkfirst=True)
+        with engine.begin() as conn:
+            conn.execute(insert(SyncRun), {
+                'command': record['command'],
+                'status': status,
+                'started_at': run.started_at,
+                'finished_at': datetime.fromisoformat(record['finished_at']),
+                'wall_s': record['wall_s'],
+                'rows_read': record['rows_read'],
+                'rows_written': record['rows_written'],
+                'peak_rss_kb': record['peak_rss_kb'],
+                'stages': json.dumps(record['stages']),
+            })
+    except Exception as e:
+        print(f"Could not record run metrics: {e}")
+    print_summary(record)
+    return record
+
+
+def print_summary(record):
+    print(f"\n{record['command']} {record['status']} in {record['wall_s']:.2f}s, "
+          f"{record['rows_read']} rows read, {record['rows_written']} written, "
+          f"{record['rows_skipped']} unchanged")
+    print(f"  {'stage':<22} {'wall s':>8} {'extract':>8} {'transform':>9} {'load':>8} "
+          f"{'read':>8} {'written':>8} {'skipped':>8} {'peak MB':>8}")
+    for s in record['stages']:
+        peak = f"{s['peak_rss_kb'] / 1024:8.1f}" if s['peak_rss_kb'] is not None else f"{'-':>8}"
+        print(f"  {s['stage']:<22} {s['wall_s']:>8.2f} {s['extract_s']:>8.2f} {s['transform_s']:>9.2f} "
+              f"{s['load_s']:>8.2f} {s['rows_read']:>8} {s['rows_written']:>8} {s['rows_skipped']:>8} {peak}")
+
+
+#Helpers for code that only has the SQLite session; they do nothing when no
+#run is being measured
+def stage(session, name):
+    run = session.info.get('metrics')
+    return run.stage(name) if run else nullcontext()
+
+
+def timed(session, phase):
+    run = session.info.get('metrics')
+    return run.phase(phase) if run else nullcontext()
+
+
+def count_rows(session, read=0, written=0, skipped=0):
+    run = session.info.get('metrics')
+    if run:
+        run.count(read, written, skipped)
+
+
+def add_phase(session, phase, seconds):
+    run = session.info.get('metrics')
+    if run:
+        run.add_phase(phase, seconds)
+
+
+def add_pipeline(session, pipe):
+    run = session.info.get('metrics')
+    if run:
+        run.add_pipeline(pipe)
@@ -1,4 +1,4 @@
-from sqlalchemy import Index, Column, Integer, String, DateTime, ForeignKey, Numeric, Boolean, SmallInteger, Float
+from sqlalchemy import Index, Column, Integer, String, DateTime, ForeignKey, Numeric, Boolean, SmallInteger, Float, BigInteger, Text
 from sqlalchemy.orm import declarative_base, relationship
 from datetime import datetime
 
@@ -28,7 +28,8 @@ class DimFilm(LiteBase):
     language = Column(String)
     release_year = Column(Integer)
     last_update = Column(String)
-    __table_args__ = (Index('idx_film_key', 'film_id'),)
+    row_hash = Column(BigInteger) #Fingerprint of the columns above, see sync.row_hash
+    __table_args__ = (Index('idx_film_key', 'film_id', unique=True),)
 class DimActor(LiteBase):
     __tablename__ = 'dim_actor'
     
@@ -37,7 +38,8 @@ class DimActor(LiteBase):
     first_name = Column(String)
     last_name = Column(String)
     last_update = Column(String)
-    __table_args__ = (Index('idx_actor_key', 'actor_id'),)
+    row_hash = Column(BigInteger)
+    __table_args__ = (Index('idx_actor_key', 'actor_id', unique=True),)
 class DimCategory(LiteBase):
     __tablename__ = 'dim_category'
     
@@ -45,7 +47,8 @@ class DimCategory(LiteBase):
     category_id = Column(Integer)
     name = Column(String)
     last_update = Column(String)
-    __table_args__ = (Index('idx_category_key', 'category_id'),)
+    row_hash = Column(BigInteger)
+    __table_args__ = (Index('idx_category_key', 'category_id', unique=True),)
 class DimStore(LiteBase):
     __tablename__ = 'dim_store'
     
@@ -54,7 +57,8 @@ class DimStore(LiteBase):
     city = Column(String)
     country = Column(String)
     last_update = Column(String)
-    __table_args__ = (Index('idx_store_key', 'store_id'),)
+    row_hash = Column(BigInteger)
+    __table_args__ = (Index('idx_store_key', 'store_id', unique=True),)
 
 class DimCustomer(LiteBase):
     __tablename__ = 'dim_customer'
@@ -67,7 +71,8 @@ class DimCustomer(LiteBase):
     city = Column(String)
     country = Column(String)
     last_update = Column(String)
-    __table_args__ = (Index('idx_customer_key', 'customer_id'),)
+    row_hash = Column(BigInteger)
+    __table_args__ = (Index('idx_customer_key', 'customer_id', unique=True),)
 
 #Bridges
 
@@ -109,6 +114,7 @@ class FactRental(LiteBase):
         Index('idx_fact_rental_film', 'film_key'),
         Index('idx_fact_rental_store', 'store_key'),
         Index('idx_fact_rental_id', 'rental_id'),
+        Index('idx_fact_rental_store_date', 'store_key', 'date_key_rented'),
     )
 
 class FactPayment(LiteBase):
@@ -126,14 +132,133 @@ class FactPayment(LiteBase):
     __table_args__ = (
         Index('idx_fact_payment_rental', 'rental_id'),
         Index('idx_fact_payment_cust', 'customer_key'),
+        Index('idx_fact_payment_date', 'date_key_paid'),
     )
 
+#Aggregates
+
+class AggStoreDaily(LiteBase):
+    __tablename__ = 'agg_store_daily'
+    #One row per store and day, kept up to date by the fact syncs so validation
+    #only has to re-check the partitions a run touched
+    store_id = Column(Integer, primary_key=True) #Natural key, compared with MySQL
+    date_key = Column(Integer, primary_key=True)
+    rental_count = Column(Integer)
+    rental_checksum = Column(Integer) #SUM(rental_id)
+    payment_total = Column(Float) #Payments made that day on the store's rentals
+
 #SyncState
 
 class SyncState(LiteBase):
     __tablename__ = 'sync_state'
     table_name = Column(String(50), primary_key=True)
     last_sync_timestamp = Column(DateTime, nullable=False)
+    last_change_id = Column(Integer) #Changelog offset, only used in CDC mode
+
+class SyncRun(LiteBase):
+    __tablename__ = 'sync_run'
+    #History of full-load / incremental runs, one row each, for charting latency
+    run_id = Column(Integer, primary_key=True, autoincrement=True)
+    command = Column(String(50), nullable=False)
+    status = Column(String(20), nullable=False) #ok, failed or rolled_back
+    started_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime)
+    wall_s = Column(Float)
+    rows_read = Column(Integer)
+    rows_written = Column(Integer)
+    peak_rss_kb = Column(Integer)
+    stages = Column(Text) #JSON list of per-stage metrics
+
+class LoadCheckpoint(LiteBase):
+    __tablename__ = 'load_checkpoint'
+    #Progress of full-load per source table, committed with each chunk so
+    #full-load --resume can continue after the last one
+    table_name = Column(String(50), primary_key=True)
+    last_pk = Column(String(64)) #Last loaded primary key, comma joined like sync_changelog.pk
+    rows_loaded = Column(Integer, default=0)
+    completed = Column(Boolean, default=False)
+    updated_at = Column(DateTime)
+
+class FactPartition(LiteBase):
+    __tablename__ = 'fact_partition'
+    #Year files the facts are split into by partition-facts, attached on connect
+    year = Column(Integer, primary_key=True)
+    path = Column(String, nullable=False)
+
+#Mappings
+#How each warehouse table is built from a source row, compiled into transforms
+#by transforms.py. Every entry is (column, source field, conversion), in the
+#order rows are written. Conversions: None copies the value, 'text', 'flag'
+#(1/0), 'float', 'date_key' (YYYYMMDD) and 'days' (between a pair of source
+#fields); a Dim model resolves the source id to that dimension's key.
+MAPPINGS = {
+    DimActor: (
+        ('actor_id', 'actor_id', None),
+        ('first_name', 'first_name', None),
+        ('last_name', 'last_name', None),
+        ('last_update', 'last_update', 'text'),
+    ),
+    DimFilm: (
+        ('film_id', 'film_id', None),
+        ('title', 'title', None),
+        ('release_year', 'release_year', None),
+        ('language', 'language', None),
+        ('rating', 'rating', None),
+        ('length', 'length', None),
+        ('last_update', 'last_update', 'text'),
+    ),
+    DimCustomer: (
+        ('customer_id', 'customer_id', None),
+        ('first_name', 'first_name', None),
+        ('last_name', 'last_name', None),
+        ('active', 'active', 'flag'),
+        ('city', 'city', None),
+        ('country', 'country', None),
+        ('last_update', 'last_update', 'text'),
+    ),
+    DimStore: (
+        ('store_id', 'store_id', None),
+        ('city', 'city', None),
+        ('country', 'country', None),
+        ('last_update', 'last_update', 'text'),
+    ),
+    DimCategory: (
+        ('category_id', 'category_id', None),
+        ('name', 'name', None),
+        ('last_update', 'last_update', 'text'),
+    ),
+    BridgeFilmActor: (
+        ('film_key', 'film_id', DimFilm),
+        ('actor_key', 'actor_id', DimActor),
+    ),
+    BridgeFilmCategory: (
+        ('film_key', 'film_id', DimFilm),
+        ('category_key', 'category_id', DimCategory),
+    ),
+    #film_id and store_id come from the rental's inventory
+    FactRental: (
+        ('rental_id', 'rental_id', None),
+        ('date_key_rented', 'rental_date', 'date_key'),
+        ('date_key_returned', 'return_date', 'date_key'),
+        ('customer_key', 'customer_id', DimCustomer),
+        ('film_key', 'film_id', DimFilm),
+        ('store_key', 'store_id', DimStore),
+        ('staff_id', 'staff_id', None),
+        ('rental_duration_days', ('rental_date', 'return_date'), 'days'),
+        ('last_update', 'last_update', 'text'),
+    ),
+    #store_id is the store the payment is booked to, see sync.py
+    FactPayment: (
+        ('payment_id', 'payment_id', None),
+        ('date_key_paid', 'payment_date', 'date_key'),
+        ('rental_id', 'rental_id', None),
+        ('customer_key', 'customer_id', DimCustomer),
+        ('store_key', 'store_id', DimStore),
+        ('staff_id', 'staff_id', None),
+        ('amount', 'amount', 'float'),
+        ('last_update', 'last_update', 'text'),
+    ),
+}
 
 #MySQL
 
@@ -264,3 +389,12 @@ class FilmCategory(SakilaBase, SakilaMixin):
     film_id = Column(Integer, ForeignKey('film.film_id'), primary_key=True)
     category_id = Column(SmallInteger, ForeignKey('category.category_id'), primary_key=True)
 
+class SyncChangelog(SakilaBase):
+    """Source-side change log for CDC mode, filled by triggers or the application.
+    pk holds the primary key values joined with commas, op is I, U or D."""
+    __tablename__ = 'sync_changelog'
+    change_id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    table_name = Column(String(64), nullable=False)
+    pk = Column(String(64), nullable=False)
+    op = Column(String(1), nullable=False)
+    ts = Column(DateTime, default=datetime.utcnow, nullable=False)
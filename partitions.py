@@ -0,0 +1,137 @@
+import os
+import sqlite3
+from sqlalchemy import event
+from models import FactRental, FactPayment
+
+#Partitioned fact tables and the date key that picks their year
+PARTITION_KEYS = {FactRental: 'date_key_rented', FactPayment: 'date_key_paid'}
+
+#Fact keys of a new year file start here, so they don't collide across files
+KEY_SEED = 10 ** 9
+
+
+def year_of(date_key):
+    return date_key // 10000 if date_key else None
+
+
+def year_schema(year):
+    """Name a year file is attached under, 'main' for rows without a date."""
+    return f'y{year}' if year is not None else 'main'
+
+
+def year_path(engine, year):
+    """Year files sit next to the warehouse, e.g. sakila_analytics_2005.db."""
+    root, ext = os.path.splitext(engine.url.database)
+    return f'{root}_{year}{ext or ".db"}'
+
+
+def registered_years(cursor):
+    """{year: path} from fact_partition, empty when the facts aren't partitioned."""
+    try:
+        return dict(cursor.execute("SELECT year, path FROM main.fact_partition ORDER BY year").fetchall())
+    except sqlite3.OperationalError: #Warehouse from before fact_partition
+        return {}
+
+
+def attached_schemas(cursor):
+    return {row[1] for row in cursor.execute("PRAGMA database_list").fetchall()}
+
+
+def check_attach_limit(dbapi_connection, years):
+    """Raises ValueError when years need more files than SQLite attaches to a
+    connection (SQLITE_MAX_ATTACHED, 10 unless SQLite was built with more)."""
+    limit = dbapi_connection.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    if len(years) > limit:
+        raise ValueError(f"Facts span {len(years)} years ({min(years)}-{max(years)}), but SQLite attaches "
+                         f"at most {limit} files to a connection, so they can't get a file each")
+
+
+def create_fact_tables(cursor, schema, year):
+    """Creates the fact tables and their indexes in an attached year file. The
+    foreign keys are left out, SQLite can't reference another file."""
+    for model, date_key in PARTITION_KEYS.items():
+        table = model.__table__
+        columns = [f"{c.name} {c.type.compile()}" + (" PRIMARY KEY AUTOINCREMENT" if c.primary_key else "")
+                   for c in table.columns]
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {schema}.{table.name} ({', '.join(columns)})")
+        cursor.execute(f"INSERT INTO {schema}.sqlite_sequence (name, seq) SELECT ?, ? "
+                       f"WHERE NOT EXISTS (SELECT 1 FROM {schema}.sqlite_sequence WHERE name = ?)",
+                       (table.name, year * KEY_SEED, table.name))
+        indexes = [(index.name, [c.name for c in index.columns]) for index in table.indexes]
+        #A year file is pruned by a range on its date key, which needs an index leading with it
+        if not any(index_columns[0] == date_key for _, index_columns in indexes):
+            indexes.append((f'idx_{table.name}_year', [date_key]))
+        for name, index_columns in indexes:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {schema}.{name} ON {table.name} ({', '.join(index_columns)})")
+
+
+def create_views(cursor, years):
+    """Shadows each fact table with a temp view over the main table and every
+    year file. Each year's arm carries its date range, so a query on recent
+    dates only reads the files that can hold them."""
+    for model, date_key in PARTITION_KEYS.items():
+        name = model.__tablename__
+        columns = ', '.join(c.name for c in model.__table__.columns)
+        arms = [f"SELECT {columns} FROM main.{name}"] + [
+            f"SELECT {columns} FROM {year_schema(year)}.{name} "
+            f"WHERE {date_key} BETWEEN {year * 10000 + 101} AND {year * 10000 + 1231}"
+            for year in years]
+        cursor.execute(f"DROP VIEW IF EXISTS temp.{name}")
+        cursor.execute(f"CREATE TEMP VIEW {name} AS " + " UNION ALL ".join(arms))
+
+
+def sync_connection(dbapi_connection, info):
+    """Attaches the year files registered since this connection last looked
+    and rebuilds the views when the set of years changed."""
+    cursor = dbapi_connection.cursor()
+    try:
+        years = registered_years(cursor)
+        attached = attached_schemas(cursor)
+        for year, path in years.items():
+            if year_schema(year) not in attached:
+                cursor.execute(f"ATTACH DATABASE ? AS {year_schema(year)}", (path,))
+        if years and info.get('fact_years') != list(years):
+            create_views(cursor, list(years))
+        info['fact_years'] = list(years)
+    finally:
+        cursor.close()
+
+
+def install(engine):
+    """Keeps every connection of engine attached to the year files on checkout."""
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        sync_connection(dbapi_connection, connection_record.info)
+    event.listen(engine, 'checkout', checkout)
+
+
+def fact_years(sqlite_session):
+    """Years the session's connection has attached, empty if the facts aren't
+    partitioned (or the engine was not install()ed)."""
+    return sqlite_session.connection().connection.info.get('fact_years', [])
+
+
+def shadowed_tables(connection):
+    """Fact tables a SQLAlchemy connection reads through views. Index DDL on
+    them would resolve to the view, and their main tables only hold undated rows."""
+    if not connection.connection.info.get('fact_years'):
+        return set()
+    return {model.__tablename__ for model in PARTITION_KEYS}
+
+
+def ensure_year(sqlite_session, year):
+    """Schema rows of year are written to, creating and attaching its file and
+    registering it in fact_partition the first time."""
+    schema = year_schema(year)
+    conn = sqlite_session.connection()
+    cursor = conn.connection.dbapi_connection.cursor()
+    if year is None or year in conn.connection.info.get('fact_years', ()):
+        return schema
+    check_attach_limit(conn.connection.dbapi_connection, list(registered_years(cursor)) + [year])
+    path = year_path(conn.engine, year)
+    if schema not in attached_schemas(cursor):
+        cursor.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+    create_fact_tables(cursor, schema, year)
+    cursor.execute("INSERT OR IGNORE INTO main.fact_partition (year, path) VALUES (?, ?)", (year, path))
+    sync_connection(conn.connection.dbapi_connection, conn.connection.info)
+    print(f"Attached {path} for {year}'s facts")
+    return schema
@@ -0,0 +1,153 @@
+import queue
+import threading
+import time
+
+#Chunks each queue holds before the stage feeding it blocks
+QUEUE_DEPTH = 4
+
+_DONE = object()
+
+
+class StageStats:
+    """Busy time and row count of one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.busy = 0.0
+
+    def rows_per_sec(self):
+        return self.rows / self.busy if self.busy else 0.0
+
+
+class QueueStats:
+    """Depth of a queue, sampled every time a chunk is put on it."""
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.samples = 0
+        self.total = 0
+        self.peak = 0
+
+    def sample(self, q):
+        depth = q.qsize()
+        self.samples += 1
+        self.total += depth
+        self.peak = max(self.peak, depth)
+
+    def mean(self):
+        return self.total / self.samples if self.samples else 0.0
+
+
+class Pipeline:
+    """Runs extract -> transform -> load with the stages overlapping.
+
+    The extractor and the transformer run on their own threads and hand chunks
+    over bounded queues, so a fast stage blocks (backpressure) instead of
+    buffering. load runs on the calling thread, which keeps it the only SQLite
+    writer. A failure in any stage stops the others and is re-raised here."""
+
+    def __init__(self, name, depth=QUEUE_DEPTH):
+        self.name = name
+        self.depth = depth
+        self.stages = [StageStats('extract'), StageStats('transform'), StageStats('load')]
+        self.queues = [QueueStats('extracted', depth), QueueStats('transformed', depth)]
+        self.wall = 0.0
+
+    def run(self, chunks, transform, load):
+        """chunks is an iterable of extracted chunks (consumed on the extractor
+        thread), transform maps a chunk to rows, load writes rows and returns
+        how many it wrote. Returns the total written."""
+        extract_stats, transform_stats, load_stats = self.stages
+        extracted, transformed = queue.Queue(self.depth), queue.Queue(self.depth)
+        stop = threading.Event()
+        errors = []
+
+        def put(q, stats, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.5)
+                    if stats is not None:
+                        stats.sample(q)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.5)
+                except queue.Empty:
+                    pass
+            return _DONE
+
+        def extractor():
+            try:
+                iterator = iter(chunks)
+                while True:
+                    started = time.perf_counter()
+                    chunk = next(iterator, _DONE)
+                    extract_stats.busy += time.perf_counter() - started
+                    if chunk is _DONE:
+                        break
+                    extract_stats.rows += len(chunk)
+                    if not put(extracted, self.queues[0], chunk):
+                        return
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            put(extracted, None, _DONE)
+
+        def transformer():
+            try:
+                while True:
+                    chunk = get(extracted)
+                    if chunk is _DONE:
+                        break
+                    started = time.perf_counter()
+                    rows = transform(chunk)
+                    transform_stats.busy += time.perf_counter() - started
+                    transform_stats.rows += len(chunk)
+                    if not put(transformed, self.queues[1], rows):
+                        return
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            put(transformed, None, _DONE)
+
+        threads = [threading.Thread(target=extractor, name=f'{self.name}-extract', daemon=True),
+                   threading.Thread(target=transformer, name=f'{self.name}-transform', daemon=True)]
+        started_at = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        written = 0
+        try:
+            while True:
+                rows = get(transformed)
+                if rows is _DONE:
+                    break
+                started = time.perf_counter()
+                count = load(rows)
+                load_stats.busy += time.perf_counter() - started
+                load_stats.rows += count
+                written += count
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            self.wall += time.perf_counter() - started_at
+        if errors:
+            raise errors[0]
+        return written
+
+    def report(self):
+        """One line per stage and queue, for printing at the end of a run."""
+        lines = [f"{self.name}: {self.wall:.2f}s wall"]
+        for stage in self.stages:
+            lines.append(f"  {stage.name:<10} {stage.rows:>9} rows {stage.busy:7.2f}s busy "
+                         f"{stage.rows_per_sec():>10.0f} rows/s")
+        for q in self.queues:
+            lines.append(f"  queue {q.name:<12} peak {q.peak}/{q.maxsize} mean {q.mean():.1f}")
+        return "\n".join(lines)
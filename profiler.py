@@ -0,0 +1,135 @@
+import re
+import sys
+import threading
+import time
+from sqlalchemy import event
+
+#A statement run this many times by the same sync function, one row at a time,
+#is reported as a likely N+1
+N_PLUS_ONE_MIN = 10
+#Statements listed in the report, by total time
+TOP_STATEMENTS = 15
+
+_IN_LIST = re.compile(r"\(\s*\?(\s*,\s*\?)+\s*\)")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|:\w+|\?")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(\.\d+)?(?![\w.])")
+_SPACE = re.compile(r"\s+")
+
+
+def normalize_sql(statement):
+    """SQL with literals and bound parameters replaced by ?, and expanded IN
+    lists collapsed, so the same query with different values groups together."""
+    sql = _STRING.sub("?", statement)
+    sql = _PLACEHOLDER.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _SPACE.sub(" ", sql).strip()
+    return _IN_LIST.sub("(?...)", sql)
+
+
+def looks_per_row(sql):
+    """A SELECT that fetches by equality on a key, the shape of a lazy
+    relationship load or a get() in a loop. Chunked reads (LIMIT) and batched
+    lookups (IN) are left out."""
+    upper = sql.upper()
+    return (upper.startswith("SELECT") and " WHERE " in upper and "= ?" in sql
+            and "(?...)" not in sql and " LIMIT " not in upper)
+
+
+def calling_function(module_file):
+    """Name of the nearest sync_* function on the stack, else the nearest named
+    function of module_file, else '?'."""
+    frame = sys._getframe(2)
+    nearest = None
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename == module_file and not code.co_name.startswith("<"):
+            if code.co_name.startswith("sync_"):
+                return code.co_name
+            nearest = nearest or code.co_name
+        frame = frame.f_back
+    return nearest or "?"
+
+
+class StatementStats:
+    def __init__(self):
+        self.count = 0
+        self.rows = 0
+        self.total = 0.0
+        self.slowest = 0.0
+
+
+class QueryProfiler:
+    """Counts and times every statement sent through the given engines, grouped
+    by engine, calling function and normalized SQL. Opt in with install()."""
+
+    def __init__(self, module_file, n_plus_one_min=N_PLUS_ONE_MIN):
+        self.module_file = module_file
+        self.n_plus_one_min = n_plus_one_min
+        self.stats = {}
+        self.engines = []
+        self.lock = threading.Lock()
+
+    def install(self, **engines):
+        """engines are named by keyword, e.g. install(mysql=..., sqlite=...)."""
+        for name, engine in engines.items():
+            before, after = self._listeners(name)
+            event.listen(engine, 'before_cursor_execute', before)
+            event.listen(engine, 'after_cursor_execute', after)
+            self.engines.append((engine, before, after))
+        return self
+
+    def uninstall(self):
+        for engine, before, after in self.engines:
+            event.remove(engine, 'before_cursor_execute', before)
+            event.remove(engine, 'after_cursor_execute', after)
+        self.engines = []
+
+    def _listeners(self, name):
+        def before(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('profiler_started', []).append(time.perf_counter())
+
+        def after(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info['profiler_started'].pop()
+            key = (name, calling_function(self.module_file), normalize_sql(statement))
+            with self.lock:
+                stats = self.stats.get(key)
+                if stats is None:
+                    stats = self.stats[key] = StatementStats()
+                stats.count += 1
+                stats.rows += len(parameters) if executemany else 1
+                stats.total += elapsed
+                stats.slowest = max(stats.slowest, elapsed)
+        return before, after
+
+    def n_plus_one(self):
+        """(engine, caller, sql, stats) of per-row patterns run at least
+        n_plus_one_min times by one function, most frequent first."""
+        found = [(engine, caller, sql, stats) for (engine, caller, sql), stats in self.stats.items()
+                 if stats.count >= self.n_plus_one_min and looks_per_row(sql)]
+        return sorted(found, key=lambda item: -item[3].count)
+
+    def report(self):
+        lines = []
+        totals = {}
+        for (engine, _, _), stats in self.stats.items():
+            count, total = totals.get(engine, (0, 0.0))
+            totals[engine] = (count + stats.count, total + stats.total)
+        overall = sum(count for count, _ in totals.values())
+        lines.append(f"Query profile: {overall} statements, "
+                     f"{sum(total for _, total in totals.values()):.2f}s in the database ("
+                     + ", ".join(f"{engine}: {count} / {total:.2f}s" for engine, (count, total) in totals.items())
+                     + ")")
+        lines.append(f"  {'count':>7} {'total s':>8} {'mean ms':>8} {'max ms':>8}  {'engine':<7} {'caller':<30} sql")
+        top = sorted(self.stats.items(), key=lambda item: -item[1].total)[:TOP_STATEMENTS]
+        for (engine, caller, sql), stats in top:
+            lines.append(f"  {stats.count:>7} {stats.total:>8.3f} {stats.total / stats.count * 1000:>8.2f} "
+                         f"{stats.slowest * 1000:>8.2f}  {engine:<7} {caller:<30} {sql[:120]}")
+        suspects = self.n_plus_one()
+        if suspects:
+            lines.append("Possible N+1 queries (one statement per row):")
+            for engine, caller, sql, stats in suspects:
+                lines.append(f"  {caller} ran {stats.count}x on {engine} ({stats.total:.3f}s): {sql[:160]}")
+        else:
+            lines.append("No per-row query patterns found.")
+        return "\n".join(lines)
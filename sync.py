@@ -1,18 +1,55 @@
 
 
 
+import os
 import sys
+import hashlib
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 from datetime import date, timedelta, datetime
-from sqlalchemy.orm import joinedload
-from sqlalchemy import text, func, or_
+from sqlalchemy import text, func, or_, and_, tuple_, inspect, select, delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.pool import SingletonThreadPool
+from sqlalchemy.orm import sessionmaker
+from keycache import get_key_cache, KeyMap, LOOKUPS, LOOKUP_CHUNK
+import partitions
+from partitions import PARTITION_KEYS, year_of
 from connectors import mysql_engine, sqlite_engine, SQLiteSession, MySQLSession
-from models import LiteBase, DimDate, SyncState
+from models import LiteBase, DimDate, SyncState, AggStoreDaily, LoadCheckpoint
 from models import (Actor, DimActor, Film, DimFilm, Language)
 from models import (Customer, Address, City, Country, DimCustomer)
 from models import (Store, Category, DimStore, DimCategory)
 from models import (FilmActor, FilmCategory, BridgeFilmActor, BridgeFilmCategory)
 from models import (Rental, Inventory, Payment, FactRental, FactPayment, Staff)
+from models import SyncChangelog, FactPartition
 import argparse
+from collections import namedtuple
+from functools import partial
+from pipeline import Pipeline
+from transforms import transform_rows, lookup_many, mapped_columns, key_models, key_fields
+import metrics
+from profiler import QueryProfiler
+import advisor
+
+#Rows fetched per round trip when streaming from MySQL during full-load
+CHUNK_SIZE = 5000
+#Rows per executemany call when writing to SQLite, per kind of table
+BATCH_SIZES = {'dims': 1000, 'bridges': 5000, 'facts': 10000}
+#Connection settings used while bulk loading. The rollback journal stays on
+#disk, so a killed load leaves the committed chunks intact for --resume.
+#synchronous=OFF only risks them on an OS crash or power loss.
+BULK_LOAD_PRAGMAS = {
+    'synchronous': 'OFF',
+    'cache_size': -262144, #256MB
+    'temp_store': 'MEMORY',
+    'mmap_size': 1073741824, #1GB
+}
+
+#Attaches the fact year files (if partition-facts was run) to every connection
+partitions.install(sqlite_engine)
 
 def verify_mysql_connection():
     """Checks for MySQL"""
@@ -26,44 +63,114 @@ def verify_mysql_connection():
         return False
 
 #INIT FUNCTIONS
+#Natural key of each dimension, which upsert_dimension conflicts on
+NATURAL_KEYS = {
+    DimActor: 'actor_id',
+    DimFilm: 'film_id',
+    DimCustomer: 'customer_id',
+    DimStore: 'store_id',
+    DimCategory: 'category_id',
+}
+
+def ensure_indexes(engine):
+    """Upgrades warehouses created by an older version: natural key indexes are
+    rebuilt as unique, since ON CONFLICT needs a unique index to target, and
+    indexes added to models.py since are created."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for model in NATURAL_KEYS:
+            existing = {i['name']: i for i in inspector.get_indexes(model.__tablename__)}
+            for index in model.__table__.indexes:
+                current = existing.get(index.name)
+                if current and not current['unique']:
+                    print(f"Rebuilding {index.name} as unique")
+                    conn.execute(text(f"DROP INDEX {index.name}"))
+                    index.create(conn)
+        shadowed = partitions.shadowed_tables(conn)
+        for table in LiteBase.metadata.sorted_tables:
+            if table.name in shadowed:
+                continue
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        #Year files get indexes added to the fact tables since they were created
+        cursor = conn.connection.dbapi_connection.cursor()
+        for year in conn.connection.info.get('fact_years', []):
+            partitions.create_fact_tables(cursor, partitions.year_schema(year), year)
+
+def ensure_columns(engine):
+    """Adds columns introduced in models.py since an older warehouse was created."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in LiteBase.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    print(f"Adding {table.name}.{column.name}")
+                    conn.exec_driver_sql(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                    )
+
+#Builds the calendar for a span of days in one statement, skipping days
+#that already exist. day_of_week is ISO (Monday=1), quarter is (month+2)/3.
+DIM_DATE_SQL = text("""
+    INSERT OR IGNORE INTO dim_date
+        (date_key, date, year, quarter, month, day_of_month, day_of_week, is_weekend)
+    WITH RECURSIVE days(day) AS (
+        SELECT date(:start)
+        UNION ALL
+        SELECT date(day, '+1 day') FROM days WHERE day < date(:end)
+    )
+    SELECT
+        CAST(strftime('%Y%m%d', day) AS INTEGER),
+        day,
+        CAST(strftime('%Y', day) AS INTEGER),
+        (CAST(strftime('%m', day) AS INTEGER) + 2) / 3,
+        CAST(strftime('%m', day) AS INTEGER),
+        CAST(strftime('%d', day) AS INTEGER),
+        (CAST(strftime('%w', day) AS INTEGER) + 6) % 7 + 1,
+        strftime('%w', day) IN ('0', '6')
+    FROM days
+""")
+
+def fill_dim_date(session, start_date, end_date):
+    """Inserts every missing day between start_date and end_date, inclusive."""
+    result = session.execute(DIM_DATE_SQL, {'start': start_date.isoformat(), 'end': end_date.isoformat()})
+    return result.rowcount
+
 def populate_dim_date(session, start_year=1987, end_year=2035):
     """Generates and inserts date records into dim_date."""
-
-    if session.query(DimDate).first():
-        print("dim_date already exists")
-        return
-
-    start_date = date(start_year, 1, 1)
-    end_date = date(end_year, 12, 31)
-    delta = timedelta(days=1)
-    current_date = start_date
-    date_records = []
-    
     print(f"Populating dim_date between {start_year} and {end_year}")
-    
-    while current_date <= end_date:
-        date_key = int(current_date.strftime('%Y%m%d')) 
-        
-        #Datetime calculation
-        day_of_week = current_date.isoweekday()
-        is_weekend = 1 if day_of_week in [6, 7] else 0
-        quarter = (current_date.month - 1) // 3 + 1
-        
-        dim_date_record = DimDate(
-            date_key=date_key,
-            date=current_date.strftime('%Y-%m-%d'),
-            year=current_date.year,
-            quarter=quarter,
-            month=current_date.month,
-            day_of_month=current_date.day,
-            day_of_week=day_of_week,
-            is_weekend=is_weekend
-        )
-        date_records.append(dim_date_record)
-        current_date += delta
-        
-    session.bulk_save_objects(date_records)
-    print(f"Successfully staged {len(date_records)} dates for dim_date.")
+    added = fill_dim_date(session, date(start_year, 1, 1), date(end_year, 12, 31))
+    print(f"Successfully staged {added} dates for dim_date.")
+
+def extend_dim_date(sqlite_session, dates):
+    """Makes sure dim_date covers every given date (Nones are ignored),
+    extending the populated window on either side when needed."""
+    dates = [d for d in dates if d is not None]
+    if not dates:
+        return 0
+    first, last = min(dates).date(), max(dates).date()
+    low, high = sqlite_session.execute(text("SELECT MIN(date_key), MAX(date_key) FROM dim_date")).one()
+    if low is None:
+        return fill_dim_date(sqlite_session, first, last)
+    added = 0
+    low_date = datetime.strptime(str(low), '%Y%m%d').date()
+    high_date = datetime.strptime(str(high), '%Y%m%d').date()
+    if first < low_date:
+        added += fill_dim_date(sqlite_session, first, low_date - timedelta(days=1))
+    if last > high_date:
+        added += fill_dim_date(sqlite_session, high_date + timedelta(days=1), last)
+    if added:
+        print(f"Extended dim_date by {added} days")
+    return added
+
+def extend_dim_date_keys(sqlite_session, date_keys):
+    """extend_dim_date for YYYYMMDD date keys."""
+    date_keys = [key for key in date_keys if key]
+    if not date_keys:
+        return 0
+    return extend_dim_date(sqlite_session, [datetime.strptime(str(min(date_keys)), '%Y%m%d'),
+                                            datetime.strptime(str(max(date_keys)), '%Y%m%d')])
 
 def init_sync_state(session):
     """Initializes the sync_state table with default old timestamps."""
@@ -85,263 +192,618 @@ def init_sync_state(session):
     print("Sync_state populated")
 
 #FULL LOAD FUNCTIONS
-def load_dims(mysql_session, sqlite_session):
-    """Gets information from Dims. Includes Actors, Films, Customers,
-    Stores, and Categories."""
-    print("Getting Actors from Sakila")
-    sakila_a = mysql_session.query(Actor).all()
-    
-    dim_actors = []
-    for actor in sakila_a:
-        dim_actors.append(DimActor(
-            actor_id=actor.actor_id,
-            first_name=actor.first_name,
-            last_name=actor.last_name,
-            last_update=str(actor.last_update)
-        ))
-    
-    sqlite_session.bulk_save_objects(dim_actors)
-    print(f"Loaded {len(dim_actors)} records into dim_actor.")
+def stream_chunks(query, chunk_size=CHUNK_SIZE):
+    """Runs a query on a server-side cursor and yields lists of at most
+    chunk_size rows, so only one chunk is ever held in memory."""
+    chunk = []
+    for row in query.yield_per(chunk_size):
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class KeysetChunk(list):
+    """Rows of one primary-key range, with the key of its last row."""
+    last_pk = None
+
+def keyset_chunks(query, chunk_size=CHUNK_SIZE, after=None):
+    """Pages through a query in primary-key order of its first column's table, one
+    WHERE pk > last ORDER BY pk LIMIT n query per chunk. Each chunk carries the
+    key it ended on, so it can be checkpointed and later resumed with after."""
+    entity = query.column_descriptions[0]['entity']
+    mapper = inspect(entity)
+    keys = [getattr(entity, mapper.get_property_by_column(column).key) for column in mapper.primary_key]
+    ordered = query.order_by(*keys)
+    while True:
+        page = ordered
+        if after is not None:
+            page = page.filter(tuple_(*keys) > tuple_(*after) if len(keys) > 1 else keys[0] > after[0])
+        chunk = KeysetChunk(page.limit(chunk_size).all())
+        if not chunk:
+            return
+        #Rows carry the key columns under their own names
+        after = chunk.last_pk = tuple(getattr(chunk[-1], key.key) for key in keys)
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+
+#Dimension rows carry a fingerprint of their content, so re-pulled rows that
+#did not change are not rewritten. last_update is left out of it, it moves
+#when a joined table is touched even if nothing we keep changed.
+def hashed_columns(model):
+    return [column.name for column in model.__table__.columns
+            if not column.primary_key and column.name not in ('last_update', 'row_hash')]
+
+def with_row_hash(model, columns, rows):
+    """Appends row_hash to tuples in the order of columns, for tables that have one."""
+    if 'row_hash' not in model.__table__.c:
+        return columns, rows
+    positions = [columns.index(name) if name in columns else None for name in hashed_columns(model)]
+    return columns + ('row_hash',), [
+        row + (row_hash([None if i is None else row[i] for i in positions]),) for row in rows
+    ]
 
-    print('Moving on...')
-    print("Getting dim Films from Sakila")
-    sakila_f = (
-        mysql_session.query(Film, Language.name)
+def row_hash(values):
+    """64-bit fingerprint of a row's values, signed to fit an SQLite INTEGER."""
+    text_value = '\x1f'.join('\x00' if value is None else str(value) for value in values)
+    digest = hashlib.blake2b(text_value.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+def bulk_insert(sqlite_session, target_model, columns, rows, batch_size, schema='main'):
+    """Writes plain tuples straight through the sqlite3 cursor's executemany,
+    skipping ORM object construction and unit-of-work bookkeeping.
+    Tuples must follow the order of columns."""
+    table = target_model.__table__
+    sql = (f"INSERT INTO {schema}.{table.name} ({', '.join(columns)}) "
+           f"VALUES ({', '.join('?' for _ in columns)})")
+    conn = sqlite_session.connection()
+    for start in range(0, len(rows), batch_size):
+        conn.exec_driver_sql(sql, rows[start:start + batch_size])
+    return len(rows)
+
+#Partitioned facts. Once partition-facts has run, fact rows live in one file
+#per year (see partitions.py), and the fact tables are read through views.
+#Writes go straight to the files of the years they touch.
+def insert_facts(sqlite_session, model, columns, rows, batch_size):
+    """bulk_insert for a fact table, into the year file of each row's date key."""
+    if not partitions.fact_years(sqlite_session):
+        return bulk_insert(sqlite_session, model, columns, rows, batch_size)
+    key_at = columns.index(PARTITION_KEYS[model])
+    by_year = {}
+    for row in rows:
+        by_year.setdefault(year_of(row[key_at]), []).append(row)
+    for year, year_rows in by_year.items():
+        bulk_insert(sqlite_session, model, columns, year_rows, batch_size,
+                    partitions.ensure_year(sqlite_session, year))
+    return len(rows)
+
+def delete_facts(sqlite_session, model, id_column, ids):
+    """Deletes the fact rows with these natural ids. When partitioned, their
+    years are looked up first, so only those files are written."""
+    table = model.__tablename__
+    if not partitions.fact_years(sqlite_session):
+        sqlite_session.query(model).filter(id_column.in_(ids)).delete(synchronize_session=False)
+        return
+    conn = sqlite_session.connection()
+    ids = list(ids)
+    for start in range(0, len(ids), LOOKUP_CHUNK):
+        chunk = ids[start:start + LOOKUP_CHUNK]
+        marks = ', '.join('?' for _ in chunk)
+        years = conn.exec_driver_sql(
+            f"SELECT DISTINCT {PARTITION_KEYS[model]} / 10000 FROM {table} WHERE {id_column.name} IN ({marks})",
+            tuple(chunk)).scalars().all()
+        for year in years:
+            conn.exec_driver_sql(f"DELETE FROM {partitions.year_schema(year)}.{table} "
+                                 f"WHERE {id_column.name} IN ({marks})", tuple(chunk))
+
+#Extraction queries, one per Sakila table. They select only the columns the
+#warehouse needs, with the joins resolved in the query, and return plain rows
+#(named tuples), so no entities are hydrated and nothing is lazy loaded.
+#Full-load streams them, the incremental syncs filter them.
+def extract_actor(mysql_session):
+    return mysql_session.query(Actor.actor_id, Actor.first_name, Actor.last_name, Actor.last_update)
+
+def extract_film(mysql_session):
+    return (
+        mysql_session.query(Film.film_id, Film.title, Film.release_year, Language.name.label('language'),
+                            Film.rating, Film.length, Film.last_update)
         .join(Language, Film.language_id == Language.language_id)
-        .all()
     )
-    dim_films = []
-    for film, language_name in sakila_f:
-        dim_films.append(DimFilm(
-            film_id=film.film_id,
-            title=film.title,
-            release_year=film.release_year,
-            language=language_name,
-            rating=film.rating,
-            length=film.length,
-            last_update=str(film.last_update) 
-        ))
-        
-    sqlite_session.bulk_save_objects(dim_films)
-    print(f"Loaded {len(dim_films)} records into dim_film.")
-    print('Moving on...')
-    print("Getting dim Customers from Sakila, joining with Address, City, Country")
 
-    sakila_c = (
-        mysql_session.query(Customer, City.city, Country.country)
+def extract_customer(mysql_session):
+    return (
+        mysql_session.query(Customer.customer_id, Customer.first_name, Customer.last_name,
+                            Customer.active, City.city, Country.country, Customer.last_update)
         .join(Address, Customer.address_id == Address.address_id)
         .join(City, Address.city_id == City.city_id)
         .join(Country, City.country_id == Country.country_id)
-        .all()
     )
-    
-    dim_customers = []
-    for customer, city_name, country_name in sakila_c:
-        dim_customers.append(DimCustomer(
-            customer_id=customer.customer_id,
-            first_name=customer.first_name,
-            last_name=customer.last_name,
-            active=1 if customer.active else 0, 
-            city=city_name,
-            country=country_name,
-            last_update=str(customer.last_update)
-        ))
-        
-    sqlite_session.bulk_save_objects(dim_customers)
-    print(f"Loaded {len(dim_customers)} records into dim_customer.")
-    print('Moving on...')
-    print("Getting dim Stores from Sakila, joining with Address, City, Country")
 
-    sakila_s = (
-        mysql_session.query(Store, City.city, Country.country)
+def extract_store(mysql_session):
+    return (
+        mysql_session.query(Store.store_id, City.city, Country.country, Store.last_update)
         .join(Address, Store.address_id == Address.address_id)
         .join(City, Address.city_id == City.city_id)
         .join(Country, City.country_id == Country.country_id)
-        .all()
     )
-    
-    dim_stores = []
-    
-    for store, city_name, country_name in sakila_s:
-        dim_stores.append(DimStore(
-            store_id=store.store_id,
-            city=city_name,
-            country=country_name,
-            last_update=str(store.last_update)
-        ))
-        
-    sqlite_session.bulk_save_objects(dim_stores)
-    print(f"Loaded {len(dim_stores)} records into dim_store.")
-    print('Last one. Phew!')
-    print("Getting Categories from Sakila, joined with nothing!")
-    
-    source_categories = mysql_session.query(Category).all()
-    
-    dim_categories = []
-    for category in source_categories:
-        dim_categories.append(DimCategory(
-            category_id=category.category_id,
-            name=category.name,
-            last_update=str(category.last_update)
-        ))
-        
-    sqlite_session.bulk_save_objects(dim_categories)
-    print(f"Loaded {len(dim_categories)} records into dim_category.")
 
-    sqlite_session.flush() 
+def extract_category(mysql_session):
+    return mysql_session.query(Category.category_id, Category.name, Category.last_update)
+
+def extract_film_actor(mysql_session):
+    return mysql_session.query(FilmActor.actor_id, FilmActor.film_id)
+
+def extract_film_category(mysql_session):
+    return mysql_session.query(FilmCategory.film_id, FilmCategory.category_id)
+
+def extract_inventory(mysql_session):
+    return mysql_session.query(Inventory.inventory_id, Inventory.film_id, Inventory.store_id)
+
+def extract_staff(mysql_session):
+    return mysql_session.query(Staff.staff_id, Staff.store_id)
+
+def extract_rental(mysql_session):
+    return mysql_session.query(Rental.rental_id, Rental.rental_date, Rental.return_date, Rental.inventory_id,
+                               Rental.customer_id, Rental.staff_id, Rental.last_update)
+
+def extract_payment(mysql_session):
+    return mysql_session.query(Payment.payment_id, Payment.rental_id, Payment.customer_id, Payment.staff_id,
+                               Payment.amount, Payment.payment_date, Payment.last_update)
+
+#Pushdown variants of the fact extracts: the film and store are joined on the
+#source and come back with each row, so inventory and staff never have to be
+#pulled into Python
+def extract_rental_pushdown(mysql_session):
+    return extract_rental(mysql_session)\
+        .add_columns(Inventory.film_id, Inventory.store_id)\
+        .outerjoin(Inventory, Rental.inventory_id == Inventory.inventory_id)
+
+def extract_payment_pushdown(mysql_session):
+    #Payments are booked to the store their rental came from, like
+    #agg_store_daily and validation do, else to their staff's store
+    return extract_payment(mysql_session)\
+        .add_columns(func.coalesce(Inventory.store_id, Staff.store_id).label('store_id'))\
+        .outerjoin(Rental, Payment.rental_id == Rental.rental_id)\
+        .outerjoin(Inventory, Rental.inventory_id == Inventory.inventory_id)\
+        .outerjoin(Staff, Payment.staff_id == Staff.staff_id)
+
+#Transforms. Each turns one extracted chunk into tuples in the order of its
+#step's columns. Tables are built by their mapping in models.MAPPINGS, compiled
+#by transforms.py. They only read ctx and the key maps preloaded for the step,
+#so they can run off the writer thread
+def collect_inventory(chunk, ctx):
+    """Inventory is not stored, only kept as two compact maps (inventory_id ->
+    film_id and -> store_id) to resolve rentals."""
+    films = ctx.setdefault('inventory_film', KeyMap())
+    stores = ctx.setdefault('inventory_store', KeyMap())
+    films.update((inv.inventory_id, inv.film_id) for inv in chunk)
+    stores.update((inv.inventory_id, inv.store_id) for inv in chunk)
+    return []
+
+def collect_staff(chunk, ctx):
+    """Same as inventory, staff only resolves payments to stores."""
+    stores = ctx.setdefault('staff_store', KeyMap())
+    stores.update((staff.staff_id, staff.store_id) for staff in chunk)
+    return []
+
+def transform_fact_rental(chunk, ctx):
+    # Look up the film and store of the whole chunk's inventory ids at once
+    inventory_ids = [rental.inventory_id for rental in chunk]
+    films = lookup_many(ctx.get('inventory_film', {}), inventory_ids)
+    stores = lookup_many(ctx.get('inventory_store', {}), inventory_ids)
+    located = [(*rental, film_id, store_id) for rental, film_id, store_id in zip(chunk, films, stores)]
+    return transform_rows(FactRental, located, ctx, chunk[0]._fields + ('film_id', 'store_id'))
+
+def collect_rental_stores(sqlite_session, ctx):
+    """rental_id -> store_id of the rentals already in the warehouse, the store
+    payments are booked to. Read back from fact_rental, so it also holds the
+    rentals of a resumed load."""
+    ctx['rental_store'] = KeyMap(
+        sqlite_session.query(FactRental.rental_id, DimStore.store_id)
+        .join(DimStore, FactRental.store_key == DimStore.store_key)
+        .order_by(FactRental.rental_id))
+
+def transform_fact_payment(chunk, ctx):
+    # The rental's store, else the staff's (as extract_payment_pushdown
+    # does on the source), the mapping takes it to the store_key
+    rental_stores = lookup_many(ctx.get('rental_store', {}), [p.rental_id for p in chunk])
+    staff_stores = lookup_many(ctx.get('staff_store', {}), [p.staff_id for p in chunk])
+    located = [(*p, staff_store if rental_store is None else rental_store)
+               for p, rental_store, staff_store in zip(chunk, rental_stores, staff_stores)]
+    return transform_rows(FactPayment, located, ctx, chunk[0]._fields + ('store_id',))
+
+#One full-load step per Sakila table. model/columns say where the transformed
+#tuples go (None for lookup-only tables), needs lists the dims whose key maps
+#the transform reads, date_columns the date keys dim_date must cover. prepare
+#puts anything else the transform reads from the warehouse into ctx.
+LoadStep = namedtuple('LoadStep', 'source extract transform kind model columns needs date_columns prepare',
+                      defaults=(None,))
+
+def mapped_step(source, extract, transform, kind, model, date_columns=(), prepare=None):
+    """A step writing model's mapped columns, with the key maps its mapping reads."""
+    return LoadStep(source, extract, transform or partial(transform_rows, model), kind, model,
+                    mapped_columns(model), key_models(model), date_columns, prepare)
+
+#Steps in dependency order. Bridges need the dims' keys, facts need the dims
+#plus the inventory and staff maps.
+DIM_STEPS = [
+    mapped_step('actor', extract_actor, None, 'dims', DimActor),
+    mapped_step('film', extract_film, None, 'dims', DimFilm),
+    mapped_step('customer', extract_customer, None, 'dims', DimCustomer),
+    mapped_step('store', extract_store, None, 'dims', DimStore),
+    mapped_step('category', extract_category, None, 'dims', DimCategory),
+]
+BRIDGE_STEPS = [
+    mapped_step('film_actor', extract_film_actor, None, 'bridges', BridgeFilmActor),
+    mapped_step('film_category', extract_film_category, None, 'bridges', BridgeFilmCategory),
+]
+FACT_STEPS = [
+    LoadStep('inventory', extract_inventory, collect_inventory, 'facts', None, (), (), ()),
+    LoadStep('staff', extract_staff, collect_staff, 'facts', None, (), (), ()),
+    mapped_step('rental', extract_rental, transform_fact_rental, 'facts', FactRental,
+                ('date_key_rented', 'date_key_returned')),
+    mapped_step('payment', extract_payment, transform_fact_payment, 'facts', FactPayment, ('date_key_paid',),
+                collect_rental_stores),
+]
+#Same facts without the lookup-only steps, the joins run on MySQL
+PUSHDOWN_FACT_STEPS = [
+    FACT_STEPS[2]._replace(extract=extract_rental_pushdown, transform=partial(transform_rows, FactRental)),
+    FACT_STEPS[3]._replace(extract=extract_payment_pushdown, transform=partial(transform_rows, FactPayment),
+                           prepare=None),
+]
+FULL_LOAD_STEPS = DIM_STEPS + BRIDGE_STEPS + FACT_STEPS
+
+def full_load_steps(pushdown=False):
+    return DIM_STEPS + BRIDGE_STEPS + (PUSHDOWN_FACT_STEPS if pushdown else FACT_STEPS)
+
+def prepare_step(sqlite_session, step, ctx):
+    """Loads the key maps a step's transform reads into ctx. Runs on the writer,
+    once the dims the step depends on have been written."""
+    key_cache = get_key_cache(sqlite_session)
+    for model in step.needs:
+        ctx[model] = key_cache.full_map(model)
+    if step.prepare is not None:
+        step.prepare(sqlite_session, ctx)
+
+def get_checkpoints(sqlite_session):
+    """{source table: LoadCheckpoint} of the current (or interrupted) full-load."""
+    return {c.table_name: c for c in sqlite_session.query(LoadCheckpoint)}
+
+def resume_point(checkpoints, step):
+    """The primary key a step continues after, None to start from the beginning.
+    Lookup-only steps are not stored, so they always run from the beginning."""
+    checkpoint = checkpoints.get(step.source)
+    if step.model is None or checkpoint is None or not checkpoint.last_pk:
+        return None
+    return tuple(int(value) for value in checkpoint.last_pk.split(','))
+
+def commit_chunk(sqlite_session, step, last_pk, rows_loaded, completed=False):
+    """Records how far a step got and commits it together with the chunk's rows."""
+    if step.model is None:
+        return
+    checkpoint = sqlite_session.get(LoadCheckpoint, step.source)
+    if checkpoint is None:
+        checkpoint = LoadCheckpoint(table_name=step.source)
+        sqlite_session.add(checkpoint)
+    if last_pk is not None:
+        checkpoint.last_pk = ','.join(str(value) for value in last_pk)
+    checkpoint.rows_loaded = rows_loaded
+    checkpoint.completed = completed
+    checkpoint.updated_at = datetime.now()
+    sqlite_session.commit()
+
+def pending_steps(steps, checkpoints):
+    """Steps a resumed full-load still has to run. Lookup-only steps always run,
+    their maps are rebuilt in memory."""
+    return [step for step in steps
+            if step.model is None or not getattr(checkpoints.get(step.source), 'completed', False)]
+
+def already_loaded(checkpoints, step):
+    checkpoint = checkpoints.get(step.source)
+    return checkpoint.rows_loaded or 0 if checkpoint is not None else 0
+
+def write_step_rows(sqlite_session, step, rows, batch_size):
+    """Writes one chunk of transformed rows for a step and returns the count."""
+    if step.model is None or not rows:
+        return 0
+    if step.date_columns:
+        positions = [step.columns.index(column) for column in step.date_columns]
+        extend_dim_date_keys(sqlite_session, [row[i] for row in rows for i in positions])
+    columns, rows = with_row_hash(step.model, step.columns, rows)
+    write = insert_facts if step.model in PARTITION_KEYS else bulk_insert
+    return write(sqlite_session, step.model, columns, rows, batch_size or BATCH_SIZES[step.kind])
+
+def run_steps(steps, mysql_session, sqlite_session, chunk_size, batch_size, ctx, checkpoints=None):
+    """Extracts each step in primary-key ranges from one MySQL session, committing
+    every chunk with its checkpoint. checkpoints resumes steps after their last chunk."""
+    checkpoints = checkpoints or {}
+    for step in pending_steps(steps, checkpoints):
+        print(f"Getting {step.source} from Sakila")
+        with metrics.stage(sqlite_session, step.source):
+            prepare_step(sqlite_session, step, ctx)
+            count = already_loaded(checkpoints, step)
+            chunks = keyset_chunks(step.extract(mysql_session), chunk_size, resume_point(checkpoints, step))
+            while True:
+                with metrics.timed(sqlite_session, 'extract'):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                with metrics.timed(sqlite_session, 'transform'):
+                    rows = step.transform(chunk, ctx)
+                with metrics.timed(sqlite_session, 'load'):
+                    written = write_step_rows(sqlite_session, step, rows, batch_size)
+                    count += written
+                    commit_chunk(sqlite_session, step, chunk.last_pk, count)
+                metrics.count_rows(sqlite_session, read=len(chunk), written=written)
+            if step.model is not None:
+                commit_chunk(sqlite_session, step, None, count, completed=True)
+                print(f"Loaded {count} records into {step.model.__tablename__}.")
+
+def load_dims(mysql_session, sqlite_session, chunk_size=CHUNK_SIZE, batch_size=None, ctx=None, checkpoints=None):
+    """Gets information from Dims. Includes Actors, Films, Customers,
+    Stores, and Categories. Each chunk is written before the next is fetched."""
+    run_steps(DIM_STEPS, mysql_session, sqlite_session, chunk_size, batch_size,
+              {} if ctx is None else ctx, checkpoints)
 
-def load_bridges(mysql_session, sqlite_session):
+def load_bridges(mysql_session, sqlite_session, chunk_size=CHUNK_SIZE, batch_size=None, ctx=None, checkpoints=None):
     """Gets the junction tables from MySQL and move them to SQLite."""
-    print("Getting SQLITE's keys")
-    
-    #Move from Sakila's ID -> SQLite's ID
-    map_f = {f.film_id: f.film_key for f in sqlite_session.query(DimFilm.film_id, DimFilm.film_key).all()}
-    map_a = {a.actor_id: a.actor_key for a in sqlite_session.query(DimActor.actor_id, DimActor.actor_key).all()}
-    map_c = {c.category_id: c.category_key for c in sqlite_session.query(DimCategory.category_id, DimCategory.category_key).all()}
-
-
-    print("Scraping Film-Actor from Sakila...")
-    sakila_f_a = mysql_session.query(FilmActor).all()
-    
-    bridge_film_actors = []
-    for mapping in sakila_f_a:
-        # Translate the old IDs into the new Keys
-        f_key = map_f.get(mapping.film_id)
-        a_key = map_a.get(mapping.actor_id)
-
-        if f_key and a_key:
-            bridge_film_actors.append(BridgeFilmActor(
-                film_key=f_key,
-                actor_key=a_key
-            ))
-            
-    sqlite_session.bulk_save_objects(bridge_film_actors)
-    print(f"Loaded {len(bridge_film_actors)} records into bridge_film_actor.")
-
-    print('Moving on...')
-    print("Scraping Film-Category from Sakila...")
-    sakila_f_c = mysql_session.query(FilmCategory).all()
-    
-    bridge_film_categories = []
-    for mapping in sakila_f_c:
-        f_key = map_f.get(mapping.film_id)
-        c_key = map_c.get(mapping.category_id)
-        
-        if f_key and c_key:
-            bridge_film_categories.append(BridgeFilmCategory(
-                film_key=f_key,
-                category_key=c_key
-            ))
-            
-    sqlite_session.bulk_save_objects(bridge_film_categories)
-    print(f"Loaded {len(bridge_film_categories)} records into bridge_film_category.")
-
-    sqlite_session.flush()
-
-def load_facts(mysql_session, sqlite_session):
-    """Gets the transactions from MySQL and populates them in SQLite with the appropriate keys."""
-    
-    #hashmap SQLite keys so we avoid joining
-    map_c = {c.customer_id: c.customer_key for c in sqlite_session.query(DimCustomer.customer_id, DimCustomer.customer_key).all()}
-    map_s = {s.store_id: s.store_key for s in sqlite_session.query(DimStore.store_id, DimStore.store_key).all()}
-    map_f = {f.film_id: f.film_key for f in sqlite_session.query(DimFilm.film_id, DimFilm.film_key).all()}
-    map_i = {inv.inventory_id: {'film_id': inv.film_id, 'store_id': inv.store_id} for inv in mysql_session.query(Inventory).all()}
-    map_st = {staff.staff_id: staff.store_id for staff in mysql_session.query(Staff).all()}
-    #Payment is a little more involved since we'll need to add them up
-    payments = mysql_session.query(Payment).all()
-    map_p = {}
-    for p in payments:
-        if p.rental_id:
-            #Add up those with multiple payments
-            map_p[p.rental_id] = map_p.get(p.rental_id, 0) + float(p.amount)
-
-    print('Got everything we need to fill in Rentals')
-    print("Extracting Rentals and building Fact table...")
-    sakila_r = mysql_session.query(Rental).all()
-    
-    fact_rentals = []
-    for rental in sakila_r:
-        # Transform the datetime into our YYYYMMDD integer date_key
-        rental_date_key = int(rental.rental_date.strftime('%Y%m%d'))
-        returned_key = None
-        if rental.return_date:
-            returned_key = int(rental.return_date.strftime('%Y%m%d'))
-        # Look up the source IDs from the inventory map
-        inv_data = map_i.get(rental.inventory_id, {})
-        source_film_id = inv_data.get('film_id')
-        source_store_id = inv_data.get('store_id')
-        
-        # Translate source IDs to our new SQLite Surrogate Keys
-        c_key = map_c.get(rental.customer_id)
-        f_key = map_f.get(source_film_id)
-        s_key = map_s.get(source_store_id)
-        
-        
-        # Only build the fact record if we successfully found all our dimension keys
-        if c_key and f_key and s_key:
-            fact_rentals.append(FactRental(
-                rental_id=rental.rental_id,
-                date_key_rented=rental_date_key,
-                date_key_returned=returned_key,
-                customer_key=c_key,
-                film_key=f_key,
-                store_key=s_key,
-                last_update=str(rental.last_update)
-            ))
-            
-    sqlite_session.bulk_save_objects(fact_rentals)
-    print(f"Loaded {len(fact_rentals)} records into fact_rental.")
-    print('Moving on to FactPayment')
-    print("Building FactPayment table...")
-    fact_payments = []
-    
-    for p in payments:
-        p_date_key = int(p.payment_date.strftime('%Y%m%d'))
-        
-        # staff_id -> store_id -> store_key
-        source_store_id = map_st.get(p.staff_id)
-        c_key = map_c.get(p.customer_id)
-        s_key = map_s.get(source_store_id)
-        
-        if c_key and s_key:
-            fact_payments.append(FactPayment(
-                payment_id=p.payment_id,
-                date_key_paid=p_date_key,
-                rental_id = p.rental_id,
-                customer_key=c_key,
-                store_key=s_key,
-                amount=float(p.amount),
-                last_update=str(p.last_update)
-            ))
-            
-    sqlite_session.bulk_save_objects(fact_payments)
-    print(f"Loaded {len(fact_payments)} records into fact_payment.")
+    run_steps(BRIDGE_STEPS, mysql_session, sqlite_session, chunk_size, batch_size,
+              {} if ctx is None else ctx, checkpoints)
+
+def load_facts(mysql_session, sqlite_session, chunk_size=CHUNK_SIZE, batch_size=None, ctx=None, checkpoints=None,
+               pushdown=False):
+    """Gets the transactions from MySQL and populates them in SQLite with the appropriate keys.
+    Rentals and payments are streamed chunk by chunk, never held whole. With
+    pushdown, their film and store are joined in on MySQL."""
+    run_steps(PUSHDOWN_FACT_STEPS if pushdown else FACT_STEPS, mysql_session, sqlite_session, chunk_size, batch_size,
+              {} if ctx is None else ctx, checkpoints)
+
+#PIPELINED FULL LOAD
+def run_steps_pipelined(steps, mysql_session, sqlite_session, chunk_size, batch_size, ctx, checkpoints=None):
+    """Runs every step as an extract -> transform -> load pipeline, so MySQL
+    reads, Python transforms and SQLite writes overlap. Chunks are committed
+    and checkpointed like run_steps. Returns the pipelines for reporting."""
+    checkpoints = checkpoints or {}
+    pipelines = []
+    for step in pending_steps(steps, checkpoints):
+        print(f"Pipelining {step.source} from Sakila")
+        prepare_step(sqlite_session, step, ctx)
+        count = already_loaded(checkpoints, step)
+
+        def load(item, step=step):
+            nonlocal count
+            last_pk, rows = item
+            written = write_step_rows(sqlite_session, step, rows, batch_size)
+            count += written
+            commit_chunk(sqlite_session, step, last_pk, count)
+            return written
+
+        pipe = Pipeline(step.source)
+        with metrics.stage(sqlite_session, step.source):
+            pipe.run(
+                keyset_chunks(step.extract(mysql_session), chunk_size, resume_point(checkpoints, step)),
+                lambda chunk, step=step: (chunk.last_pk, step.transform(chunk, ctx)),
+                load,
+            )
+            metrics.add_pipeline(sqlite_session, pipe)
+        if step.model is not None:
+            commit_chunk(sqlite_session, step, None, count, completed=True)
+            print(f"Loaded {count} records into {step.model.__tablename__}.")
+        pipelines.append(pipe)
+    return pipelines
+
+#PARALLEL FULL LOAD
+def open_snapshot_sessions(sources):
+    """Opens one MySQL connection per source table, each inside a
+    START TRANSACTION WITH CONSISTENT SNAPSHOT. The snapshots are opened under
+    FLUSH TABLES WITH READ LOCK so they all see the same point in time; without
+    the RELOAD privilege they are opened back to back instead."""
+    is_mysql = mysql_engine.dialect.name == 'mysql'
+    lock_conn = None
+    if is_mysql:
+        lock_conn = mysql_engine.connect()
+        try:
+            lock_conn.exec_driver_sql("FLUSH TABLES WITH READ LOCK")
+        except Exception as e:
+            print(f"Could not take a global read lock, snapshots may drift slightly: {e}")
+            lock_conn.close()
+            lock_conn = None
+
+    sessions = {}
+    try:
+        for source in sources:
+            conn = mysql_engine.connect()
+            if is_mysql:
+                conn = conn.execution_options(isolation_level="REPEATABLE READ")
+                conn.exec_driver_sql("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+            sessions[source] = MySQLSession(bind=conn)
+    finally:
+        if lock_conn is not None:
+            lock_conn.exec_driver_sql("UNLOCK TABLES")
+            lock_conn.close()
+    return sessions
+
+def run_steps_parallel(steps, sqlite_session, chunk_size, batch_size, ctx, workers, queue_depth=4, checkpoints=None):
+    """Extracts every step on its own snapshot connection in a thread pool.
+    Workers push chunks onto a bounded queue per table; this thread is the only
+    SQLite writer and drains the queues in step order, so dependencies hold.
+    Steps are submitted in the same order, so a worker blocked on a full queue
+    never starves the table the writer is waiting on."""
+    checkpoints = checkpoints or {}
+    steps = pending_steps(steps, checkpoints)
+    sessions = open_snapshot_sessions([step.source for step in steps])
+    queues = {step.source: queue.Queue(maxsize=queue_depth) for step in steps}
+    stop = threading.Event()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def extract_worker(step):
+        q = queues[step.source]
+        try:
+            chunks = keyset_chunks(step.extract(sessions[step.source]), chunk_size, resume_point(checkpoints, step))
+            for chunk in chunks:
+                put(q, chunk)
+                if stop.is_set():
+                    return
+            put(q, None)
+        except Exception as e:
+            put(q, e)
 
-def run_full_load():
-    """Main execution function for the 'Full-load' command."""
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for step in steps:
+                pool.submit(extract_worker, step)
+            try:
+                for step in steps:
+                    print(f"Writing {step.source} from Sakila")
+                    with metrics.stage(sqlite_session, step.source):
+                        prepare_step(sqlite_session, step, ctx)
+                        count = already_loaded(checkpoints, step)
+                        while True:
+                            #Extraction runs in the workers, this is the time spent waiting on it
+                            with metrics.timed(sqlite_session, 'extract'):
+                                chunk = queues[step.source].get()
+                            if chunk is None:
+                                break
+                            if isinstance(chunk, Exception):
+                                raise chunk
+                            with metrics.timed(sqlite_session, 'transform'):
+                                rows = step.transform(chunk, ctx)
+                            with metrics.timed(sqlite_session, 'load'):
+                                written = write_step_rows(sqlite_session, step, rows, batch_size)
+                                count += written
+                                commit_chunk(sqlite_session, step, chunk.last_pk, count)
+                            metrics.count_rows(sqlite_session, read=len(chunk), written=written)
+                    if step.model is not None:
+                        commit_chunk(sqlite_session, step, None, count, completed=True)
+                        print(f"Loaded {count} records into {step.model.__tablename__}.")
+            finally:
+                stop.set()
+    finally:
+        for session in sessions.values():
+            session.rollback()
+            session.close()
+            session.bind.close()
+
+@contextmanager
+def bulk_load_mode(engine):
+    """Yields a SQLite connection set up for bulk loading: the secondary indexes
+    are dropped and BULK_LOAD_PRAGMAS applied. Afterwards, even on failure, the
+    indexes are rebuilt in one pass each and the previous settings restored."""
+    conn = engine.connect()
+    previous = {name: conn.exec_driver_sql(f"PRAGMA {name}").scalar() for name in BULK_LOAD_PRAGMAS}
+    shadowed = partitions.shadowed_tables(conn)
+    indexes = [index for table in LiteBase.metadata.sorted_tables if table.name not in shadowed
+               for index in table.indexes]
+    try:
+        for name, value in BULK_LOAD_PRAGMAS.items():
+            conn.exec_driver_sql(f"PRAGMA {name} = {value}")
+        print(f"Dropping {len(indexes)} indexes for the load")
+        for index in indexes:
+            index.drop(conn, checkfirst=True)
+        conn.commit()
+        yield conn
+    finally:
+        conn.rollback()
+        print(f"Rebuilding {len(indexes)} indexes")
+        for index in indexes:
+            index.create(conn, checkfirst=True)
+        conn.commit()
+        for name, value in previous.items():
+            conn.exec_driver_sql(f"PRAGMA {name} = {value}")
+        conn.close()
+
+def run_full_load(chunk_size=CHUNK_SIZE, batch_size=None, workers=1, bulk_mode=False, pipeline=False, resume=False,
+                  pushdown=False):
+    """Main execution function for the 'Full-load' command.
+    Tables are read in primary-key ranges and every chunk is committed with a
+    per-table checkpoint, so resume continues an interrupted load after its last
+    chunk instead of starting over.
+    batch_size overrides BATCH_SIZES for every table when given. With more than
+    one worker, tables are extracted concurrently from a consistent snapshot.
+    bulk_mode loads with the indexes dropped and durability relaxed. pipeline
+    overlaps extract, transform and load of each table and reports the stages.
+    pushdown resolves the facts' film and store with joins on MySQL instead of
+    in-memory inventory and staff maps."""
+    if pipeline and workers > 1:
+        raise ValueError("pipeline runs one table at a time, it can't be combined with workers > 1")
     print("Starting Full Load Process...")
+    steps = full_load_steps(pushdown)
     
+    LoadCheckpoint.__table__.create(sqlite_engine, checkfirst=True)
     mysql_session = MySQLSession()
     sqlite_session = SQLiteSession()
+    run = metrics.start_run('full-load --resume' if resume else 'full-load', sqlite_session)
+    status = None
     
     try:
-        row_count = sqlite_session.query(FactRental).count()
-        if row_count > 0:
-            print(f"SQLite already contains {row_count} records.")
-            print("Use 'incremental' to sync new data, or 'init' to start over.")
-            return
-        load_dims(mysql_session, sqlite_session)
-        load_bridges(mysql_session, sqlite_session)
-        load_facts(mysql_session, sqlite_session)
-        sqlite_session.commit()
+        checkpoints = get_checkpoints(sqlite_session)
+        if resume:
+            if not checkpoints:
+                print("No interrupted full-load to resume.")
+                return
+            if not any(step.model is not None for step in pending_steps(steps, checkpoints)):
+                print("Full-load already completed, nothing to resume.")
+                return
+            for c in checkpoints.values():
+                print(f"Resuming {c.table_name}: {c.rows_loaded} rows loaded"
+                      + (" (done)" if c.completed else f", after {c.last_pk}"))
+        else:
+            row_count = sqlite_session.query(FactRental).count()
+            if row_count > 0 or checkpoints:
+                print(f"SQLite already contains {row_count} records.")
+                print("Use 'incremental' to sync new data, 'full-load --resume' to finish an "
+                      "interrupted load, or 'init' to start over.")
+                return
+
+        def load(sqlite_session):
+            ctx = {}
+            if workers > 1:
+                run_steps_parallel(steps, sqlite_session, chunk_size, batch_size, ctx, workers,
+                                   checkpoints=checkpoints)
+            elif pipeline:
+                pipelines = run_steps_pipelined(steps, mysql_session, sqlite_session,
+                                                chunk_size, batch_size, ctx, checkpoints)
+                print("Pipeline stages:")
+                for pipe in pipelines:
+                    print(pipe.report())
+            else:
+                load_dims(mysql_session, sqlite_session, chunk_size, batch_size, ctx, checkpoints)
+                load_bridges(mysql_session, sqlite_session, chunk_size, batch_size, ctx, checkpoints)
+                load_facts(mysql_session, sqlite_session, chunk_size, batch_size, ctx, checkpoints, pushdown)
+            with metrics.stage(sqlite_session, 'agg_store_daily'), metrics.timed(sqlite_session, 'load'):
+                rebuild_store_daily(sqlite_session)
+                sqlite_session.commit()
+
+        if bulk_mode:
+            sqlite_session.close()
+            with bulk_load_mode(sqlite_engine) as conn:
+                sqlite_session = SQLiteSession(bind=conn)
+                metrics.attach(sqlite_session, run)
+                load(sqlite_session)
+        else:
+            load(sqlite_session)
         print("Full Load SUCCESSFUL.")
+        status = 'ok'
         
     except Exception as e:
         sqlite_session.rollback()
-        print(f"Full Load FAILED. Transaction rolled back. Error: {e}")
+        print(f"Full Load FAILED. Chunks committed so far are kept, rerun with --resume. Error: {e}")
+        status = 'failed'
     finally:
         mysql_session.close()
         sqlite_session.close()
+        #Runs that refused to start are not recorded
+        if status:
+            metrics.finish_run(run, status, sqlite_engine)
 
 #INCREMENTAL
 #HELPERS
@@ -360,293 +822,1030 @@ def update_sync_state(sqlite_session, table_name, max_ts):
             sqlite_session.add(state)
         state.last_sync_timestamp = max_ts
 
-def upsert_dimension(sqlite_session, target_model, mysql_key_name, data_list):
-    '''Handles upserting of a SQLite row
+def advance_sync_state(sqlite_session, table_name, max_ts):
+    """Like update_sync_state, but only ever moves the watermark forward."""
+    sqlite_session.flush()
+    if max_ts and max_ts > get_last_sync(sqlite_session, table_name):
+        update_sync_state(sqlite_session, table_name, max_ts)
+
+def upsert_rows(sqlite_session, target_model, mysql_key_name, columns, rows, batch_size=BATCH_SIZES['dims']):
+    '''Handles upserting of SQLite rows, tuples in the order of columns, in
+    batches with INSERT ... ON CONFLICT(natural_key) DO UPDATE. Tables with a
+    row_hash only update rows whose hash changed. Returns the rows actually written.
     '''
-    for item_dict in data_list:
-        b_key_val = item_dict.get(mysql_key_name)
-        #Check if record exists in SQLite
-        existing = sqlite_session.query(target_model).filter(
-            getattr(target_model, mysql_key_name) == b_key_val
-        ).first()
-
-        if existing:
-            # Update columns
-            for key, value in item_dict.items():
-                setattr(existing, key, value)
-        else:
-            # Insert new row
-            sqlite_session.add(target_model(**item_dict))
+    if not rows:
+        return 0
+    columns, rows = with_row_hash(target_model, tuple(columns), rows)
+    table = target_model.__tablename__
+    updates = ', '.join(f"{column} = excluded.{column}" for column in columns if column != mysql_key_name)
+    sql = (f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)}) "
+           f"ON CONFLICT({mysql_key_name}) DO UPDATE SET {updates}")
+    if 'row_hash' in columns:
+        sql += f" WHERE {table}.row_hash IS NOT excluded.row_hash"
+    key_position = columns.index(mysql_key_name)
+    written = 0
+    with metrics.timed(sqlite_session, 'load'):
+        conn = sqlite_session.connection()
+        for start in range(0, len(rows), batch_size):
+            written += conn.exec_driver_sql(sql, rows[start:start + batch_size]).rowcount
+        #New natural keys got fresh surrogate keys, let the cache see them
+        get_key_cache(sqlite_session).refresh(target_model, [row[key_position] for row in rows])
+    metrics.count_rows(sqlite_session, written=written, skipped=len(rows) - written)
+    return written
+
+def upsert_dimension(sqlite_session, target_model, mysql_key_name, data_list, batch_size=BATCH_SIZES['dims']):
+    '''upsert_rows for a list of dicts. Keys that are not columns of
+    target_model are ignored.'''
+    if not data_list:
+        return 0
+    columns = [key for key in data_list[0] if key in target_model.__table__.c and key != 'row_hash']
+    rows = [tuple(item_dict.get(key) for key in columns) for item_dict in data_list]
+    return upsert_rows(sqlite_session, target_model, mysql_key_name, columns, rows, batch_size)
+
+def apply_dimension(sqlite_session, target_model, changes):
+    '''Upserts changed source rows through the dimension's compiled mapping.'''
+    rows = transform_rows(target_model, changes)
+    return upsert_rows(sqlite_session, target_model, NATURAL_KEYS[target_model], mapped_columns(target_model), rows)
+
+def delete_dimension(sqlite_session, target_model, mysql_key_name, ids):
+    '''Removes dimension rows whose source rows were deleted.'''
+    if not ids:
+        return 0
+    key_col = getattr(target_model, mysql_key_name)
+    deleted = sqlite_session.query(target_model).filter(key_col.in_(ids)).delete(synchronize_session=False)
+    get_key_cache(sqlite_session).refresh(target_model, ids)
+    return deleted
+
+def with_source_updates(query, *models):
+    '''Adds the last_update of each joined model to the query's rows (as
+    <table>_update), so a sync can advance its watermark past all its sources.'''
+    return query.add_columns(*[model.last_update.label(f'{model.__tablename__}_update') for model in models])
+
+def newest_update(changes):
+    '''Newest last_update of the rows and of the joined sources with_source_updates added.'''
+    fields = [f for f in changes[0]._fields if f == 'last_update' or f.endswith('_update')]
+    return max(ts for row in changes for ts in (getattr(row, f) for f in fields) if ts is not None)
+
+#Each dimension is fetched with a filter (last_update watermarks when polling,
+#primary keys when reading the changelog) and applied the same way either way
+def changed_actors(mysql_session, criterion):
+    return extract_actor(mysql_session).filter(criterion).all()
+
+def apply_dim_actor(sqlite_session, changes):
+    return apply_dimension(sqlite_session, DimActor, changes)
+def extract_dim_actor_inc(mysql_session, last_sync):
+    return changed_actors(mysql_session, Actor.last_update > last_sync)
+
+def load_dim_actor_inc(mysql_session, sqlite_session, changes):
+    metrics.count_rows(sqlite_session, read=len(changes))
+    if changes:
+        with metrics.timed(sqlite_session, 'transform'):
+            apply_dim_actor(sqlite_session, changes)
+        update_sync_state(sqlite_session, 'dim_actor', max(row.last_update for row in changes))
+    return len(changes)
 
 def sync_dim_actor_inc(mysql_session, sqlite_session):
     ''' Syncs actor. This requires no joins.
     '''
-    last_sync = get_last_sync(sqlite_session, 'dim_actor')
-    changes = mysql_session.query(Actor).filter(Actor.last_update > last_sync).all()
+    return sync_node(SYNC_NODES['dim_actor'], mysql_session, sqlite_session)
+
+def changed_categories(mysql_session, criterion):
+    return extract_category(mysql_session).filter(criterion).all()
+
+def apply_dim_category(sqlite_session, changes):
+    return apply_dimension(sqlite_session, DimCategory, changes)
+def extract_dim_category_inc(mysql_session, last_sync):
+    return changed_categories(mysql_session, Category.last_update > last_sync)
+
+def load_dim_category_inc(mysql_session, sqlite_session, changes):
+    metrics.count_rows(sqlite_session, read=len(changes))
     if changes:
-        data = [{
-            "actor_id": a.actor_id,
-            "first_name": a.first_name,
-            "last_name": a.last_name,
-            "last_update": str(a.last_update)
-        } for a in changes]
-        upsert_dimension(sqlite_session, DimActor, 'actor_id', data)
-        update_sync_state(sqlite_session, 'dim_actor', max(a.last_update for a in changes))
+        with metrics.timed(sqlite_session, 'transform'):
+            apply_dim_category(sqlite_session, changes)
+        update_sync_state(sqlite_session, 'dim_category', max(row.last_update for row in changes))
     return len(changes)
 
 def sync_dim_category_inc(mysql_session, sqlite_session):
     '''Syncs categories. Also no joins!
     '''
-    last_sync = get_last_sync(sqlite_session, 'dim_category')
-    changes = mysql_session.query(Category).filter(Category.last_update > last_sync).all()
+    return sync_node(SYNC_NODES['dim_category'], mysql_session, sqlite_session)
 
+#From here are dims that need joins
+def changed_stores(mysql_session, criterion, joined=()):
+    #The join is flattened in the query
+    return with_source_updates(extract_store(mysql_session), *joined).filter(criterion).all()
+
+def apply_dim_store(sqlite_session, changes):
+    return apply_dimension(sqlite_session, DimStore, changes)
+def extract_dim_store_inc(mysql_session, last_sync):
+    return changed_stores(mysql_session, or_(
+        Store.last_update > last_sync,
+        Address.last_update > last_sync
+    ), (Address,))
+
+def load_dim_store_inc(mysql_session, sqlite_session, changes):
+    metrics.count_rows(sqlite_session, read=len(changes))
     if changes:
-        data = [{
-            "category_id": c.category_id,
-            "name": c.name,
-            "last_update": str(c.last_update)
-        } for c in changes]
-        
-        upsert_dimension(sqlite_session, DimCategory, 'category_id', data)
-        update_sync_state(sqlite_session, 'dim_category', max(c.last_update for c in changes))
+        with metrics.timed(sqlite_session, 'transform'):
+            apply_dim_store(sqlite_session, changes)
+        update_sync_state(sqlite_session, 'dim_store', newest_update(changes))
     return len(changes)
 
-#From here are dims that need joins
 def sync_dim_store_inc(mysql_session, sqlite_session):
     '''Syncs the store dimension. Here we have to join with Address, City and Country
     '''
-    last_sync = get_last_sync(sqlite_session, 'dim_store')
-    
-    #Flatten the join
-    changes = mysql_session.query(Store).join(Address).join(City).join(Country).filter(
-        or_(
-            Store.last_update > last_sync,
-            Address.last_update > last_sync
-        )
-    ).all()
-
+    return sync_node(SYNC_NODES['dim_store'], mysql_session, sqlite_session)
+
+def changed_customers(mysql_session, criterion, joined=()):
+    return with_source_updates(extract_customer(mysql_session), *joined).filter(criterion).all()
+
+def apply_dim_customer(sqlite_session, changes):
+    return apply_dimension(sqlite_session, DimCustomer, changes)
+def extract_dim_customer_inc(mysql_session, last_sync):
+    return changed_customers(mysql_session, or_(
+        Customer.last_update > last_sync,
+        Address.last_update > last_sync,
+        City.last_update > last_sync
+    ), (Address, City))
+
+def load_dim_customer_inc(mysql_session, sqlite_session, changes):
+    metrics.count_rows(sqlite_session, read=len(changes))
     if changes:
-        data = [{
-            "store_id": s.store_id,
-            "address": s.address.address,
-            "city": s.address.city.city,
-            "country": s.address.city.country.country,
-            "last_update": str(s.last_update)
-        } for s in changes]
-        
-        upsert_dimension(sqlite_session, DimStore, 'store_id', data)
-        update_sync_state(sqlite_session, 'dim_store', max(s.last_update for s in changes))
+        with metrics.timed(sqlite_session, 'transform'):
+            apply_dim_customer(sqlite_session, changes)
+        update_sync_state(sqlite_session, 'dim_customer', newest_update(changes))
     return len(changes)
 
 def sync_dim_customer_inc(mysql_session, sqlite_session):
     '''Syncs customer. We'll need to join with Address, City, Country
     '''
-    last_sync = get_last_sync(sqlite_session, 'dim_customer')
-    changes = mysql_session.query(Customer).join(Address).join(City).join(Country).filter(
-        or_(
-            Customer.last_update > last_sync,
-            Address.last_update > last_sync,
-            City.last_update > last_sync
-        )
-    ).all()
+    return sync_node(SYNC_NODES['dim_customer'], mysql_session, sqlite_session)
+
+def changed_films(mysql_session, criterion, joined=()):
+    return with_source_updates(extract_film(mysql_session), *joined).filter(criterion).all()
+
+def apply_dim_film(sqlite_session, changes):
+    return apply_dimension(sqlite_session, DimFilm, changes)
+def extract_dim_film_inc(mysql_session, last_sync):
+    return changed_films(mysql_session, or_(
+        Film.last_update > last_sync,
+        Language.last_update > last_sync
+    ), (Language,))
 
+def load_dim_film_inc(mysql_session, sqlite_session, changes):
+    metrics.count_rows(sqlite_session, read=len(changes))
     if changes:
-        data = [{
-            "customer_id": c.customer_id,
-            "first_name": c.first_name,
-            "last_name": c.last_name,
-            "email": c.email,
-            "address": c.address.address,
-            "city": c.address.city.city,
-            "country": c.address.city.country.country,
-            "last_update": str(c.last_update)
-        } for c in changes]
-        
-        upsert_dimension(sqlite_session, DimCustomer, 'customer_id', data)
-        max_ts = max(c.last_update for c in changes)
-        update_sync_state(sqlite_session, 'dim_customer', max_ts)
+        with metrics.timed(sqlite_session, 'transform'):
+            apply_dim_film(sqlite_session, changes)
+        update_sync_state(sqlite_session, 'dim_film', newest_update(changes))
     return len(changes)
 
 def sync_dim_film_inc(mysql_session, sqlite_session):
     '''Film syncs. Will need to be joined with Langauge'''
-    last_sync = get_last_sync(sqlite_session, 'dim_film')
-    changes = mysql_session.query(Film).join(Language, Film.language_id == Language.language_id).filter(
-        or_(
-            Film.last_update > last_sync,
-            Language.last_update > last_sync
-        )
-    ).all()
-
-    if changes:
-        data = [{
-            "film_id": f.film_id,
-            "title": f.title,
-            "release_year": f.release_year,
-            "language": f.language.name, 
-            "length": f.length,
-            "rating": f.rating,
-            "last_update": str(f.last_update)
-        } for f in changes]
-        
-        upsert_dimension(sqlite_session, DimFilm, 'film_id', data)
-        max_ts = max(f.last_update for f in changes)
-        update_sync_state(sqlite_session, 'dim_film', max_ts)     
-    return len(changes)
+    return sync_node(SYNC_NODES['dim_film'], mysql_session, sqlite_session)
 
 #Bridge tables
-def sync_bridge_film_actor_inc(mysql_session, sqlite_session):
-    '''Syncs bridge tables. We'll need to delete, then scrape, then re-insert'''
-    last_sync = get_last_sync(sqlite_session, 'bridge_film_actor')
-    changed_film_ids = [f.film_id for f in mysql_session.query(Film.film_id).filter(Film.last_update > last_sync).all()]
-
-    if not changed_film_ids:
+def apply_bridge_pairs(sqlite_session, bridge_model, other_model, added, removed):
+    '''Writes membership changes to a bridge. added and removed are
+    (film_id, other_id) pairs of Sakila IDs, other_id being the actor or category.
+    Pairs whose dimension rows are not in the warehouse are skipped.'''
+    other_key_name = 'actor_key' if bridge_model is BridgeFilmActor else 'category_key'
+    pairs = list(added) + list(removed)
+    key_cache = get_key_cache(sqlite_session)
+    film_map = key_cache.resolve(DimFilm, {film_id for film_id, _ in pairs})
+    other_map = key_cache.resolve(other_model, {other_id for _, other_id in pairs})
+
+    def to_keys(source_pairs):
+        return [(film_map[f], other_map[o]) for f, o in source_pairs if f in film_map and o in other_map]
+
+    removed_keys = to_keys(removed)
+    added_keys = to_keys(added)
+    other_key_col = getattr(bridge_model, other_key_name)
+    with metrics.timed(sqlite_session, 'load'):
+        for start in range(0, len(removed_keys), LOOKUP_CHUNK):
+            sqlite_session.query(bridge_model).filter(
+                tuple_(bridge_model.film_key, other_key_col).in_(removed_keys[start:start + LOOKUP_CHUNK])
+            ).delete(synchronize_session=False)
+
+        if added_keys:
+            stmt = sqlite_insert(bridge_model.__table__).on_conflict_do_nothing()
+            sqlite_session.execute(stmt, [{'film_key': f, other_key_name: o} for f, o in added_keys])
+    metrics.count_rows(sqlite_session, written=len(added_keys) + len(removed_keys))
+    return len(added_keys) + len(removed_keys)
+
+def extract_bridge_changes(mysql_session, source_model, other_name, last_sync):
+    '''Films whose memberships changed since last_sync, going by the bridge
+    table's own last_update. Films touched themselves are included too, which is
+    how a removed pair shows up. Returns their film ids, all their current
+    (film_id, other_id) pairs and the newest change.'''
+    changed = dict(mysql_session.query(source_model.film_id, func.max(source_model.last_update))
+                   .filter(source_model.last_update > last_sync)
+                   .group_by(source_model.film_id).all())
+    for film_id, ts in mysql_session.query(Film.film_id, Film.last_update).filter(Film.last_update > last_sync):
+        changed[film_id] = max(ts, changed.get(film_id, ts))
+    film_ids = sorted(changed)
+
+    other_col = getattr(source_model, other_name)
+    pairs = []
+    for start in range(0, len(film_ids), LOOKUP_CHUNK):
+        pairs.extend((row[0], row[1]) for row in mysql_session.query(source_model.film_id, other_col)
+                     .filter(source_model.film_id.in_(film_ids[start:start + LOOKUP_CHUNK])))
+    return film_ids, pairs, max(changed.values()) if changed else None
+
+def warehouse_bridge_pairs(sqlite_session, bridge_model, other_model, film_ids):
+    '''(film_id, other_id) pairs the warehouse holds for the given films.'''
+    other_pk = inspect(other_model).primary_key[0]
+    other_id = getattr(other_model, NATURAL_KEYS[other_model])
+    pairs = set()
+    for start in range(0, len(film_ids), LOOKUP_CHUNK):
+        pairs.update((row[0], row[1]) for row in sqlite_session.query(DimFilm.film_id, other_id)
+                     .select_from(bridge_model)
+                     .join(DimFilm, DimFilm.film_key == bridge_model.film_key)
+                     .join(other_model, other_pk == getattr(bridge_model, other_pk.key))
+                     .filter(DimFilm.film_id.in_(film_ids[start:start + LOOKUP_CHUNK])))
+    return pairs
+
+def load_bridge_changes(sqlite_session, bridge_model, other_model, table_name, extracted):
+    '''Diffs the source pairs of the changed films against the warehouse and
+    writes only the pairs added and removed.'''
+    film_ids, pairs, max_ts = extracted
+    metrics.count_rows(sqlite_session, read=len(pairs))
+    if not film_ids:
         return 0
+    with metrics.timed(sqlite_session, 'transform'):
+        current = warehouse_bridge_pairs(sqlite_session, bridge_model, other_model, film_ids)
+        source = set(pairs)
+    written = apply_bridge_pairs(sqlite_session, bridge_model, other_model, source - current, current - source)
+    update_sync_state(sqlite_session, table_name, max_ts)
+    return written
 
-    film_map = {f.film_id: f.film_key for f in sqlite_session.query(DimFilm).filter(DimFilm.film_id.in_(changed_film_ids)).all()}
-    actor_map = {a.actor_id: a.actor_key for a in sqlite_session.query(DimActor).all()}
-    #Delete
-    sqlite_session.query(BridgeFilmActor).filter(BridgeFilmActor.film_key.in_(film_map.values())).delete(synchronize_session=False)
+def extract_bridge_film_actor_inc(mysql_session, last_sync):
+    return extract_bridge_changes(mysql_session, FilmActor, 'actor_id', last_sync)
 
-    changes = mysql_session.query(FilmActor).filter(FilmActor.film_id.in_(changed_film_ids)).all()
-    for row in changes:
-        new_entry = BridgeFilmActor(
-            film_key=film_map.get(row.film_id),
-            actor_key=actor_map.get(row.actor_id)
-        )
-        sqlite_session.add(new_entry)
-    max_ts = mysql_session.query(func.max(FilmActor.last_update)).scalar()
-    update_sync_state(sqlite_session, 'bridge_film_actor', max_ts)
-    return len(changes)
+def load_bridge_film_actor_inc(mysql_session, sqlite_session, extracted):
+    return load_bridge_changes(sqlite_session, BridgeFilmActor, DimActor, 'bridge_film_actor', extracted)
+
+def sync_bridge_film_actor_inc(mysql_session, sqlite_session):
+    '''Syncs bridge tables. Only the pairs that differ from the source are written'''
+    return sync_node(SYNC_NODES['bridge_film_actor'], mysql_session, sqlite_session)
+
+def extract_bridge_film_category_inc(mysql_session, last_sync):
+    return extract_bridge_changes(mysql_session, FilmCategory, 'category_id', last_sync)
+
+def load_bridge_film_category_inc(mysql_session, sqlite_session, extracted):
+    return load_bridge_changes(sqlite_session, BridgeFilmCategory, DimCategory, 'bridge_film_category', extracted)
 
 def sync_bridge_film_category_inc(mysql_session, sqlite_session):
     '''
     Film_cat'''
-    last_sync = get_last_sync(sqlite_session, 'bridge_film_category')
-    
-    changed_films = mysql_session.query(Film.film_id).filter(Film.last_update > last_sync).all()
-    changed_film_ids = [f.film_id for f in changed_films]
-
-    if not changed_film_ids:
-        return 0
-    #Same as above
-    film_map = {f.film_id: f.film_key for f in sqlite_session.query(DimFilm).filter(DimFilm.film_id.in_(changed_film_ids)).all()}
-    category_map = {c.category_id: c.category_key for c in sqlite_session.query(DimCategory).all()}
-
-    sqlite_session.query(BridgeFilmCategory).filter(
-        BridgeFilmCategory.film_key.in_(film_map.values())
-    ).delete(synchronize_session=False)
-
-    assignments = mysql_session.query(FilmCategory).filter(FilmCategory.film_id.in_(changed_film_ids)).all()
-    for row in assignments:
-        new_entry = BridgeFilmCategory(
-            film_key=film_map.get(row.film_id),
-            category_key=category_map.get(row.category_id)
-        )
-        sqlite_session.add(new_entry)
-
-    max_ts = mysql_session.query(func.max(FilmCategory.last_update)).scalar()
-    update_sync_state(sqlite_session, 'bridge_film_category', max_ts)
-    return len(assignments)
+    return sync_node(SYNC_NODES['bridge_film_category'], mysql_session, sqlite_session)
 
 #Facts tables
 
-def sync_fact_payment_inc(mysql_session, sqlite_session):
-    '''Payment. Just need to get keys for customer
+def query_payments(mysql_session, criterion):
+    #Same store as the pushdown full-load
+    return extract_payment_pushdown(mysql_session).filter(criterion)
+
+def changed_payments(mysql_session, criterion):
+    return query_payments(mysql_session, criterion).all()
+
+PAYMENT_COLUMNS = mapped_columns(FactPayment)
+
+def fact_key_maps(sqlite_session, model, changes):
+    '''The key maps model's transform reads, holding just the ids in changes.'''
+    key_cache = get_key_cache(sqlite_session)
+    return {dim: key_cache.resolve(dim, {getattr(row, field) for row in changes})
+            for field, dim in key_fields(model)}
+
+def full_key_maps(sqlite_session, model):
+    '''Every key model's transform can read, for transforms run off the writer thread.'''
+    key_cache = get_key_cache(sqlite_session)
+    return {dim: key_cache.full_map(dim) for dim in key_models(model)}
+
+def load_payment_changes(sqlite_session, rows, removed_ids=()):
+    '''Replaces the fact rows of the transformed payments and drops removed ones.'''
+    id_at, date_at = PAYMENT_COLUMNS.index('payment_id'), PAYMENT_COLUMNS.index('date_key_paid')
+    payment_ids = [row[id_at] for row in rows] + list(removed_ids)
+    extend_dim_date_keys(sqlite_session, [row[date_at] for row in rows])
+    partitions = store_daily_partitions(sqlite_session, payment_ids=payment_ids)
+    delete_facts(sqlite_session, FactPayment, FactPayment.payment_id, payment_ids)
+    insert_facts(sqlite_session, FactPayment, PAYMENT_COLUMNS, rows, BATCH_SIZES['facts'])
+    partitions |= store_daily_partitions(sqlite_session, payment_ids=payment_ids)
+    refresh_store_daily(sqlite_session, partitions)
+    return len(rows)
+
+def apply_fact_payment(sqlite_session, changes, removed_ids=()):
+    '''Replaces the fact rows of the changed payments and drops removed ones.'''
+    with metrics.timed(sqlite_session, 'transform'):
+        rows = transform_rows(FactPayment, changes, fact_key_maps(sqlite_session, FactPayment, changes),
+                              keep_missing=True)
+    with metrics.timed(sqlite_session, 'load'):
+        written = load_payment_changes(sqlite_session, rows, removed_ids)
+    metrics.count_rows(sqlite_session, written=written)
+    return written
+
+def run_fact_pipeline(query, transform, load, pipeline):
+    """Streams a changed-facts query through a Pipeline. Returns how many rows
+    were written and the newest last_update among them."""
+    newest = []
+    def transform_chunk(chunk):
+        return transform(chunk), max(row.last_update for row in chunk)
+    def load_chunk(item):
+        rows, chunk_newest = item
+        newest.append(chunk_newest)
+        return load(rows)
+    count = pipeline.run(stream_chunks(query, CHUNK_SIZE), transform_chunk, load_chunk)
+    return count, max(newest) if newest else None
+
+def sync_fact_payment_inc(mysql_session, sqlite_session, pipeline=None):
+    '''Payment. Just need to get keys for customer.
+    With a pipeline, changes are streamed in chunks from a second MySQL session
+    while earlier chunks are being written.
     '''
     last_sync = get_last_sync(sqlite_session, 'fact_payment')
-    changes = mysql_session.query(Payment).filter(Payment.last_update > last_sync).all()
+    if pipeline is not None:
+        extract_session = source_sessions(mysql_session)()
+        try:
+            ctx = full_key_maps(sqlite_session, FactPayment)
+            count, newest = run_fact_pipeline(
+                query_payments(extract_session, Payment.last_update > last_sync),
+                lambda chunk: transform_rows(FactPayment, chunk, ctx, keep_missing=True),
+                lambda rows: load_payment_changes(sqlite_session, rows),
+                pipeline)
+        finally:
+            extract_session.close()
+        metrics.add_pipeline(sqlite_session, pipeline)
+        if newest is not None:
+            update_sync_state(sqlite_session, 'fact_payment', newest)
+        return count
+
+    return sync_node(SYNC_NODES['fact_payment'], mysql_session, sqlite_session)
+
+def extract_fact_payment_inc(mysql_session, last_sync):
+    return changed_payments(mysql_session, Payment.last_update > last_sync)
+
+def load_fact_payment_inc(mysql_session, sqlite_session, changes):
+    metrics.count_rows(sqlite_session, read=len(changes))
     if not changes: return 0
 
-    payment_ids = [p.payment_id for p in changes]
-    sqlite_session.query(FactPayment).filter(FactPayment.payment_id.in_(payment_ids)).delete(synchronize_session=False)
-    cust_map = {c.customer_id: c.customer_key for c in sqlite_session.query(DimCustomer).all()}
-    rental_store_map = {r.rental_id: r.store_key for r in sqlite_session.query(FactRental.rental_id, FactRental.store_key).all()}
-    staff_map = {s.staff_id: s.store_id for s in mysql_session.query(Staff).all()}
-    map_s = {s.store_id: s.store_key for s in sqlite_session.query(DimStore).all()}
-    for p in changes:
-        date_key = int(p.payment_date.strftime('%Y%m%d'))
-        s_key = rental_store_map.get(p.rental_id)
-        if s_key is None:
-            source_store_id = staff_map.get(p.staff_id)
-            s_key = map_s.get(source_store_id)
-        sqlite_session.add(FactPayment(
-            payment_id=p.payment_id,
-            rental_id=p.rental_id,
-            customer_key=cust_map.get(p.customer_id),
-            store_key=s_key,
-            staff_id=p.staff_id, #Note that we do NOT have a DimStaff!
-            amount=float(p.amount),
-            date_key_paid=date_key,
-        ))
+    apply_fact_payment(sqlite_session, changes)
     update_sync_state(sqlite_session, 'fact_payment', max(p.last_update for p in changes))
     return len(changes)
 
-def sync_fact_rental_inc(mysql_session, sqlite_session):
-    '''The worst one of them all. This is so many joins.'''
+def query_rentals(mysql_session, criterion):
+    #The film and store come from the inventory in the same query
+    return extract_rental_pushdown(mysql_session).filter(criterion)
+
+def changed_rentals(mysql_session, criterion):
+    return query_rentals(mysql_session, criterion).all()
+
+RENTAL_COLUMNS = mapped_columns(FactRental)
+
+def load_rental_changes(sqlite_session, rows, removed_ids=()):
+    '''Replaces the fact rows of the transformed rentals and drops removed ones.'''
+    id_at = RENTAL_COLUMNS.index('rental_id')
+    dates_at = (RENTAL_COLUMNS.index('date_key_rented'), RENTAL_COLUMNS.index('date_key_returned'))
+    rental_ids = [row[id_at] for row in rows] + list(removed_ids)
+    extend_dim_date_keys(sqlite_session, [row[i] for row in rows for i in dates_at])
+    #Partitions these rentals leave, refreshed along with the ones they land in
+    partitions = store_daily_partitions(sqlite_session, rental_ids=rental_ids)
+    delete_facts(sqlite_session, FactRental, FactRental.rental_id, rental_ids)
+    insert_facts(sqlite_session, FactRental, RENTAL_COLUMNS, rows, BATCH_SIZES['facts'])
+    partitions |= store_daily_partitions(sqlite_session, rental_ids=rental_ids)
+    refresh_store_daily(sqlite_session, partitions)
+    return len(rows)
+
+def apply_fact_rental(sqlite_session, changes, removed_ids=()):
+    '''Replaces the fact rows of the changed rentals and drops removed ones.'''
+    with metrics.timed(sqlite_session, 'transform'):
+        rows = transform_rows(FactRental, changes, fact_key_maps(sqlite_session, FactRental, changes),
+                              keep_missing=True)
+    with metrics.timed(sqlite_session, 'load'):
+        written = load_rental_changes(sqlite_session, rows, removed_ids)
+    metrics.count_rows(sqlite_session, written=written)
+    return written
+
+def sync_fact_rental_inc(mysql_session, sqlite_session, pipeline=None):
+    '''The worst one of them all. This is so many joins.
+    Pipelined the same way as sync_fact_payment_inc when given a pipeline.'''
     last_sync = get_last_sync(sqlite_session, 'fact_rental')
-    changes = mysql_session.query(Rental)\
-        .options(joinedload(Rental.inventory))\
-        .filter(Rental.last_update > last_sync).all()
+    if pipeline is not None:
+        extract_session = source_sessions(mysql_session)()
+        try:
+            ctx = full_key_maps(sqlite_session, FactRental)
+            count, newest = run_fact_pipeline(
+                query_rentals(extract_session, Rental.last_update > last_sync),
+                lambda chunk: transform_rows(FactRental, chunk, ctx, keep_missing=True),
+                lambda rows: load_rental_changes(sqlite_session, rows),
+                pipeline)
+        finally:
+            extract_session.close()
+        metrics.add_pipeline(sqlite_session, pipeline)
+        if newest is not None:
+            update_sync_state(sqlite_session, 'fact_rental', newest)
+        return count
+
+    return sync_node(SYNC_NODES['fact_rental'], mysql_session, sqlite_session)
+
+def extract_fact_rental_inc(mysql_session, last_sync):
+    return changed_rentals(mysql_session, Rental.last_update > last_sync)
+
+def load_fact_rental_inc(mysql_session, sqlite_session, changes):
+    metrics.count_rows(sqlite_session, read=len(changes))
     if not changes: return 0
-    rental_ids = [r.rental_id for r in changes]
-    sqlite_session.query(FactRental).filter(FactRental.rental_id.in_(rental_ids)).delete(synchronize_session=False)
-
-    cust_map = {c.customer_id: c.customer_key for c in sqlite_session.query(DimCustomer).all()}
-    film_map = {f.film_id: f.film_key for f in sqlite_session.query(DimFilm).all()}
-    store_map = {st.store_id: st.store_key for st in sqlite_session.query(DimStore).all()}
-
-    for r in changes:
-        duration = None
-        rented_key = int(r.rental_date.strftime('%Y%m%d'))
-        return_key = int(r.return_date.strftime('%Y%m%d')) if r.return_date else None
-        if r.return_date and r.rental_date:
-            duration = (r.return_date - r.rental_date).total_seconds() / (3600*24)
-
-        inv = r.inventory
-        f_key = film_map.get(inv.film_id) if inv else None
-        s_key = store_map.get(inv.store_id) if inv else None
-
-        sqlite_session.add(FactRental(
-            rental_id=r.rental_id,
-            date_key_rented=rented_key,
-            date_key_returned=return_key if return_key else None,
-            customer_key=cust_map.get(r.customer_id),
-            film_key=f_key,
-            store_key=s_key,
-            staff_id=r.staff_id, #Again, no dim_staff here
-            rental_duration_days=duration
-        ))
 
+    apply_fact_rental(sqlite_session, changes)
     update_sync_state(sqlite_session, 'fact_rental', max(r.last_update for r in changes))
     return len(changes)
 
-def validate(mysql_session, sqlite_session):
-    """Compares row counts and totals per store.
-    """
-    print("Validating")
-    
-    # mysql_session = MySQLSession()
-    # sqlite_session = SQLiteSession()
-    mysql_rentals = mysql_session.query(func.count(Rental.rental_id)).scalar()
-    sqlite_rentals = sqlite_session.query(func.count(FactRental.rental_id)).scalar()
-    
-    mysql_store_totals = mysql_session.query(
+#SCHEDULING
+#Incremental syncs as a dependency graph. Each node is split into an extract
+#(MySQL only, run on a worker thread with its own session) and a load (run on
+#the main thread, the only SQLite writer). A node is loaded once the nodes it
+#resolves keys from are loaded; extracts don't wait for anything.
+#sources are the Sakila tables whose last_update the extract filters on. A node
+#is skipped when none of them changed since its watermark (see probe_changes).
+SyncNode = namedtuple('SyncNode', 'name extract load deps stream sources', defaults=((),))
+
+SYNC_WORKERS = 4
+
+SYNC_GRAPH = [
+    SyncNode('dim_actor', extract_dim_actor_inc, load_dim_actor_inc, (), None, (Actor,)),
+    SyncNode('dim_category', extract_dim_category_inc, load_dim_category_inc, (), None, (Category,)),
+    SyncNode('dim_store', extract_dim_store_inc, load_dim_store_inc, (), None, (Store, Address)),
+    SyncNode('dim_customer', extract_dim_customer_inc, load_dim_customer_inc, (), None,
+             (Customer, Address, City)),
+    SyncNode('dim_film', extract_dim_film_inc, load_dim_film_inc, (), None, (Film, Language)),
+    SyncNode('bridge_film_actor', extract_bridge_film_actor_inc, load_bridge_film_actor_inc,
+             ('dim_film', 'dim_actor'), None, (Film, FilmActor)),
+    SyncNode('bridge_film_category', extract_bridge_film_category_inc, load_bridge_film_category_inc,
+             ('dim_film', 'dim_category'), None, (Film, FilmCategory)),
+    #Payments are summed per store over their rentals in agg_store_daily, so they go after them
+    SyncNode('fact_rental', extract_fact_rental_inc, load_fact_rental_inc,
+             ('dim_customer', 'dim_film', 'dim_store'), sync_fact_rental_inc, (Rental,)),
+    SyncNode('fact_payment', extract_fact_payment_inc, load_fact_payment_inc,
+             ('dim_customer', 'dim_store', 'fact_rental'), sync_fact_payment_inc, (Payment,)),
+]
+SYNC_NODES = {node.name: node for node in SYNC_GRAPH}
+
+def get_watermarks(sqlite_session):
+    '''Every table's last sync timestamp from SyncState, in one query.'''
+    return dict(sqlite_session.query(SyncState.table_name, SyncState.last_sync_timestamp).all())
+
+def source_high_water(mysql_session, models):
+    '''MAX(last_update) of each model's table, in one round trip. None for
+    empty tables.'''
+    models = list(dict.fromkeys(models))
+    if not models:
+        return {}
+    row = mysql_session.execute(select(*[
+        select(func.max(model.last_update)).scalar_subquery().label(model.__tablename__)
+        for model in models
+    ])).one()
+    return dict(zip(models, row))
+
+def probe_changes(graph, mysql_session, sqlite_session):
+    '''Reads the watermarks and the newest change of every source, one query
+    each side. Returns the watermarks and the names of the nodes with nothing
+    newer than their watermark in any of their sources.'''
+    watermarks = get_watermarks(sqlite_session)
+    newest = source_high_water(mysql_session, [model for node in graph for model in node.sources])
+    idle = set()
+    high_water = {}
+    for node in graph:
+        if not node.sources:
+            continue
+        last_sync = watermarks.get(node.name) or datetime(1970, 1, 1)
+        if all(newest[model] is None or newest[model] <= last_sync for model in node.sources):
+            idle.add(node.name)
+        high_water[node.name] = max((newest[model] for model in node.sources if newest[model] is not None),
+                                    default=None)
+    #For run_sync_graph, see there
+    sqlite_session.info['source_high_water'] = high_water
+    return watermarks, idle
+
+def sync_node(node, mysql_session, sqlite_session):
+    '''Runs one node on the given sessions, extract then load.'''
+    last_sync = get_last_sync(sqlite_session, node.name)
+    with metrics.timed(sqlite_session, 'extract'):
+        changes = node.extract(mysql_session, last_sync)
+    return node.load(mysql_session, sqlite_session, changes)
+
+def source_sessions(mysql_session):
+    '''A sessionmaker on the same source as mysql_session, for extracts that
+    need their own connection (on a worker thread).'''
+    if mysql_session is None:
+        return MySQLSession
+    return sessionmaker(autocommit=False, autoflush=False, bind=mysql_session.get_bind())
+
+def timed_extract(node, last_sync, Session):
+    '''Worker side of run_sync_graph, on a session of Session. Returns the
+    changes and when the extract started and finished.'''
+    session = Session()
+    try:
+        started = time.perf_counter()
+        changes = node.extract(session, last_sync)
+        return changes, started, time.perf_counter()
+    finally:
+        session.close()
+
+def run_sync_graph(graph, mysql_session, sqlite_session, workers=SYNC_WORKERS, pipelines=None,
+                   watermarks=None, skip=()):
+    '''Runs the nodes of graph, extracting up to workers of them at once and
+    loading each as soon as its extract and its dependencies are done. Nodes
+    with a pipeline in pipelines are streamed by their own sync function
+    instead. Nodes in skip count as synced with 0 rows. watermarks saves
+    reading each node's last sync on its own. Returns rows synced per node and
+    prints when each node ran.
+    After probe_changes, a synced node's watermark moves up to the newest
+    change of its sources the probe saw. Its extract ran after the probe, so it
+    read everything up to there. Otherwise a change in a shared source (an
+    address of a customer, not a store) would leave the other node's watermark
+    behind, and it would be synced with 0 rows on every run.'''
+    pipelines = pipelines or {}
+    high_water = sqlite_session.info.pop('source_high_water', {})
+    names = {node.name for node in graph}
+    for node in graph:
+        missing = [dep for dep in node.deps if dep not in names]
+        if missing:
+            raise ValueError(f"{node.name} depends on {missing}, which are not in the graph")
+
+    started = time.perf_counter()
+    timings = {}
+    synced = dict.fromkeys(skip, 0)
+    pending = [node for node in graph if node.name not in synced]
+    if synced:
+        print(f"No changes for {', '.join(node.name for node in graph if node.name in synced)}")
+    if not pending:
+        return synced
+
+    #Extracts read the same source as mysql_session, each on its own connection
+    Session = source_sessions(mysql_session)
+    pool = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='sync-extract')
+    try:
+        #Read on this thread, SQLite sessions are not shared with the workers
+        futures = {}
+        for node in pending:
+            if pipelines.get(node.name) is None:
+                if watermarks is None:
+                    last_sync = get_last_sync(sqlite_session, node.name)
+                else:
+                    last_sync = watermarks.get(node.name) or datetime(1970, 1, 1)
+                futures[node.name] = pool.submit(timed_extract, node, last_sync, Session)
+
+        while pending:
+            ready = [node for node in pending if all(dep in synced for dep in node.deps)]
+            if not ready:
+                raise ValueError(f"Dependency cycle between {[node.name for node in pending]}")
+            #Prefer a node whose extract is already in
+            done = [node for node in ready if node.name not in futures or futures[node.name].done()]
+            if not done:
+                wait([futures[node.name] for node in ready], return_when=FIRST_COMPLETED)
+                continue
+            node = done[0]
+            pending.remove(node)
+
+            print(f"Syncing {node.name}")
+            with metrics.stage(sqlite_session, node.name):
+                load_started = time.perf_counter()
+                if node.name in futures:
+                    changes, extract_started, extract_finished = futures[node.name].result()
+                    metrics.add_phase(sqlite_session, 'extract', extract_finished - extract_started)
+                    synced[node.name] = node.load(mysql_session, sqlite_session, changes)
+                else:
+                    extract_started = extract_finished = None
+                    synced[node.name] = node.stream(mysql_session, sqlite_session, pipelines[node.name])
+                advance_sync_state(sqlite_session, node.name, high_water.get(node.name))
+                timings[node.name] = (extract_started, extract_finished, load_started, time.perf_counter())
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    print_sync_timings(timings, started)
+    return synced
+
+def print_sync_timings(timings, started):
+    '''When each node was extracted and loaded, in seconds from the start of the run.'''
+    def at(t):
+        return f"{t - started:8.2f}" if t is not None else f"{'-':>8}"
+    wall = time.perf_counter() - started
+    serial = 0.0
+    print(f"\n  {'node':<22} {'extract':>8} {'to':>8} {'load':>8} {'to':>8}")
+    for name, (extract_started, extract_finished, load_started, load_finished) in timings.items():
+        if extract_started is not None:
+            serial += extract_finished - extract_started
+        serial += load_finished - load_started
+        print(f"  {name:<22} {at(extract_started)} {at(extract_finished)} {at(load_started)} {at(load_finished)}")
+    print(f"  {wall:.2f}s wall for {serial:.2f}s of extract and load")
+
+#CHANGE DATA CAPTURE
+#Source tables the changelog tracks, with their primary key columns in the
+#order they are joined into sync_changelog.pk
+CHANGELOG_TABLES = {
+    'actor': ('actor_id',),
+    'category': ('category_id',),
+    'language': ('language_id',),
+    'film': ('film_id',),
+    'city': ('city_id',),
+    'address': ('address_id',),
+    'store': ('store_id',),
+    'customer': ('customer_id',),
+    'film_actor': ('film_id', 'actor_id'),
+    'film_category': ('film_id', 'category_id'),
+    'rental': ('rental_id',),
+    'payment': ('payment_id',),
+}
+#Changelog entries consumed per batch
+CDC_BATCH = 10000
+
+def changelog_trigger_sql(dialect_name, table, pk_columns):
+    """AFTER INSERT/UPDATE/DELETE triggers that record (table, pk, op, ts) into
+    sync_changelog, for MySQL or a SQLite stand-in source."""
+    statements = []
+    for op, event_name, row in (('I', 'INSERT', 'NEW'), ('U', 'UPDATE', 'NEW'), ('D', 'DELETE', 'OLD')):
+        name = f"cdc_{table}_{event_name.lower()}"
+        if dialect_name == 'mysql':
+            pk = f"CONCAT_WS(',', {', '.join(f'{row}.{c}' for c in pk_columns)})"
+            body = (f"FOR EACH ROW INSERT INTO sync_changelog (table_name, pk, op, ts) "
+                    f"VALUES ('{table}', {pk}, '{op}', NOW(6))")
+        else:
+            pk = " || ',' || ".join(f"{row}.{c}" for c in pk_columns)
+            body = (f"BEGIN INSERT INTO sync_changelog (table_name, pk, op, ts) "
+                    f"VALUES ('{table}', {pk}, '{op}', CURRENT_TIMESTAMP); END")
+        statements.append(f"DROP TRIGGER IF EXISTS {name}")
+        statements.append(f"CREATE TRIGGER {name} AFTER {event_name} ON {table} {body}")
+    return statements
+
+def install_changelog(engine):
+    """Creates sync_changelog on the source and the triggers that fill it."""
+    SyncChangelog.__table__.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        for table, pk_columns in CHANGELOG_TABLES.items():
+            for statement in changelog_trigger_sql(engine.dialect.name, table, pk_columns):
+                conn.exec_driver_sql(statement)
+    print(f"Changelog triggers installed on {len(CHANGELOG_TABLES)} tables")
+
+def get_changelog_offset(sqlite_session):
+    state = sqlite_session.query(SyncState).filter_by(table_name='changelog').first()
+    return (state.last_change_id or 0) if state else 0
+
+def update_changelog_offset(sqlite_session, change_id, ts):
+    state = sqlite_session.query(SyncState).filter_by(table_name='changelog').first()
+    if not state:
+        state = SyncState(table_name='changelog')
+        sqlite_session.add(state)
+    state.last_change_id = change_id
+    state.last_sync_timestamp = ts
+
+def collapse_changelog(entries):
+    """{table: {pk tuple: op}} keeping the last operation per row, so a row
+    that was changed and then deleted is only deleted."""
+    changes = {}
+    for entry in entries:
+        if entry.table_name not in CHANGELOG_TABLES:
+            continue
+        pk = tuple(int(value) for value in entry.pk.split(','))
+        changes.setdefault(entry.table_name, {})[pk] = entry.op
+    return changes
+
+def apply_changelog(mysql_session, sqlite_session, changes):
+    """Applies collapsed changelog entries, fetching changed rows by primary key.
+    Dims go first, then bridges, then facts, same as run_sync."""
+    def split(table):
+        rows = changes.get(table, {})
+        kept = [pk for pk, op in rows.items() if op != 'D']
+        removed = [pk for pk, op in rows.items() if op == 'D']
+        return kept, removed
+
+    def ids(pks):
+        return [pk[0] for pk in pks]
+
+    counts = {}
+    actors, removed_actors = split('actor')
+    if actors:
+        apply_dim_actor(sqlite_session, changed_actors(mysql_session, Actor.actor_id.in_(ids(actors))))
+    delete_dimension(sqlite_session, DimActor, 'actor_id', ids(removed_actors))
+
+    categories, removed_categories = split('category')
+    if categories:
+        apply_dim_category(sqlite_session, changed_categories(mysql_session, Category.category_id.in_(ids(categories))))
+    delete_dimension(sqlite_session, DimCategory, 'category_id', ids(removed_categories))
+
+    #Address and city changes are pulled in through the dims that join them
+    addresses = ids(split('address')[0])
+    cities = ids(split('city')[0])
+    stores, removed_stores = split('store')
+    if stores or addresses or cities:
+        apply_dim_store(sqlite_session, changed_stores(mysql_session, or_(
+            Store.store_id.in_(ids(stores)),
+            Address.address_id.in_(addresses),
+            City.city_id.in_(cities)
+        )))
+    delete_dimension(sqlite_session, DimStore, 'store_id', ids(removed_stores))
+
+    customers, removed_customers = split('customer')
+    if customers or addresses or cities:
+        apply_dim_customer(sqlite_session, changed_customers(mysql_session, or_(
+            Customer.customer_id.in_(ids(customers)),
+            Address.address_id.in_(addresses),
+            City.city_id.in_(cities)
+        )))
+    delete_dimension(sqlite_session, DimCustomer, 'customer_id', ids(removed_customers))
+
+    films, removed_films = split('film')
+    languages = ids(split('language')[0])
+    if films or languages:
+        apply_dim_film(sqlite_session, changed_films(mysql_session, or_(
+            Film.film_id.in_(ids(films)),
+            Language.language_id.in_(languages)
+        )))
+    delete_dimension(sqlite_session, DimFilm, 'film_id', ids(removed_films))
+
+    for table, source_model, bridge_model, other_model, other_name in (
+        ('film_actor', FilmActor, BridgeFilmActor, DimActor, 'actor_id'),
+        ('film_category', FilmCategory, BridgeFilmCategory, DimCategory, 'category_id'),
+    ):
+        pairs, removed_pairs = split(table)
+        other_col = getattr(source_model, other_name)
+        present = []
+        for start in range(0, len(pairs), LOOKUP_CHUNK):
+            present.extend(
+                (row[0], row[1]) for row in mysql_session.query(source_model.film_id, other_col)
+                .filter(tuple_(source_model.film_id, other_col).in_(pairs[start:start + LOOKUP_CHUNK]))
+            )
+        counts[table] = apply_bridge_pairs(sqlite_session, bridge_model, other_model, present, removed_pairs)
+
+    rentals, removed_rentals = split('rental')
+    changed = changed_rentals(mysql_session, Rental.rental_id.in_(ids(rentals))) if rentals else []
+    if changed or removed_rentals:
+        counts['rental'] = apply_fact_rental(sqlite_session, changed, ids(removed_rentals))
+
+    payments, removed_payments = split('payment')
+    changed = changed_payments(mysql_session, Payment.payment_id.in_(ids(payments))) if payments else []
+    if changed or removed_payments:
+        counts['payment'] = apply_fact_payment(sqlite_session, changed, ids(removed_payments))
+    return counts
+
+def run_cdc_sync(mysql_session, sqlite_session, batch_size=CDC_BATCH):
+    """Incremental sync driven by sync_changelog instead of last_update polling.
+    Consumes the changelog from the offset kept in SyncState, which also lets it
+    see deletes. Validated and committed like run_sync."""
+    print(f"Synching from changelog {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ")
+    run = metrics.start_run('incremental --cdc', sqlite_session)
+    status = 'failed'
+    try:
+        if sqlite_session.query(AggStoreDaily).first() is None:
+            with metrics.stage(sqlite_session, 'agg_store_daily'), metrics.timed(sqlite_session, 'load'):
+                rebuild_store_daily(sqlite_session)
+        offset = get_changelog_offset(sqlite_session)
+        consumed = 0
+        while True:
+            with metrics.stage(sqlite_session, 'changelog'):
+                with metrics.timed(sqlite_session, 'extract'):
+                    entries = mysql_session.query(SyncChangelog)\
+                        .filter(SyncChangelog.change_id > offset)\
+                        .order_by(SyncChangelog.change_id)\
+                        .limit(batch_size).all()
+                if not entries:
+                    break
+                metrics.count_rows(sqlite_session, read=len(entries))
+                counts = apply_changelog(mysql_session, sqlite_session, collapse_changelog(entries))
+            offset = entries[-1].change_id
+            update_changelog_offset(sqlite_session, offset, entries[-1].ts)
+            consumed += len(entries)
+            print(f"Applied {len(entries)} changelog entries up to {offset}: {counts}")
+
+        print(f"Consumed {consumed} changelog entries.")
+        with metrics.stage(sqlite_session, 'validate'):
+            sqlite_session.flush()
+            is_valid = validate_incremental(mysql_session, sqlite_session)
+        if is_valid:
+            sqlite_session.commit()
+            print("Validation complete. Transaction committed.")
+            status = 'ok'
+        else:
+            sqlite_session.rollback()
+            print("Inconsistency detected. Transaction rollbacked")
+            status = 'rolled_back'
+
+    except Exception as e:
+        sqlite_session.rollback()
+        print(f"Error: {str(e)}. Transaction rollback.")
+    finally:
+        mysql_session.close()
+        sqlite_session.close()
+        metrics.finish_run(run, status, sqlite_session.get_bind())
+
+#VALIDATION AGGREGATES
+#Recomputes one (store_key, date_key) partition of agg_store_daily from the facts.
+#The rental's store is looked up per payment rather than joined, which keeps
+#both sides on their indexes when the facts are views over year files
+STORE_DAILY_SQL = text("""
+    INSERT OR REPLACE INTO agg_store_daily
+        (store_id, date_key, rental_count, rental_checksum, payment_total)
+    SELECT
+        ds.store_id,
+        :date_key,
+        (SELECT COUNT(*) FROM fact_rental fr
+          WHERE fr.store_key = :store_key AND fr.date_key_rented = :date_key),
+        (SELECT COALESCE(SUM(fr.rental_id), 0) FROM fact_rental fr
+          WHERE fr.store_key = :store_key AND fr.date_key_rented = :date_key),
+        (SELECT COALESCE(SUM(fp.amount), 0) FROM fact_payment fp
+          WHERE fp.date_key_paid = :date_key
+            AND (SELECT fr.store_key FROM fact_rental fr WHERE fr.rental_id = fp.rental_id) = :store_key)
+    FROM dim_store ds WHERE ds.store_key = :store_key
+""")
+
+STORE_DAILY_REBUILD_SQL = text("""
+    INSERT INTO agg_store_daily
+        (store_id, date_key, rental_count, rental_checksum, payment_total)
+    SELECT store_id, date_key, SUM(rental_count), SUM(rental_checksum), SUM(payment_total)
+    FROM (
+        SELECT ds.store_id, fr.date_key_rented AS date_key,
+               COUNT(*) AS rental_count, SUM(fr.rental_id) AS rental_checksum, 0 AS payment_total
+        FROM fact_rental fr JOIN dim_store ds ON ds.store_key = fr.store_key
+        GROUP BY ds.store_id, fr.date_key_rented
+        UNION ALL
+        SELECT ds.store_id, fp.date_key_paid, 0, 0, SUM(fp.amount)
+        FROM fact_payment fp
+        JOIN fact_rental fr ON fr.rental_id = fp.rental_id
+        JOIN dim_store ds ON ds.store_key = fr.store_key
+        GROUP BY ds.store_id, fp.date_key_paid
+    )
+    GROUP BY store_id, date_key
+""")
+
+#Days per MySQL query when re-verifying partitions
+VALIDATE_DAYS_PER_QUERY = 200
+
+def rebuild_store_daily(sqlite_session):
+    """Recomputes agg_store_daily from scratch. Used after full-load and when
+    an older warehouse does not have the aggregates yet."""
+    sqlite_session.flush()
+    sqlite_session.query(AggStoreDaily).delete(synchronize_session=False)
+    sqlite_session.execute(STORE_DAILY_REBUILD_SQL)
+    print("Rebuilt agg_store_daily")
+
+def store_daily_partitions(sqlite_session, rental_ids=(), payment_ids=()):
+    """The (store_key, date_key) partitions the given rentals and payments
+    currently fall in, including the payment partitions of the given rentals."""
+    sqlite_session.flush()
+    partitions = set()
+    rental_ids, payment_ids = list(rental_ids), list(payment_ids)
+    #Store of each payment's rental, looked up like in STORE_DAILY_SQL
+    rental_store = select(FactRental.store_key).where(FactRental.rental_id == FactPayment.rental_id).scalar_subquery()
+    for start in range(0, len(rental_ids), LOOKUP_CHUNK):
+        ids = rental_ids[start:start + LOOKUP_CHUNK]
+        partitions.update(
+            (row[0], row[1]) for row in sqlite_session.query(FactRental.store_key, FactRental.date_key_rented)
+            .filter(FactRental.rental_id.in_(ids))
+        )
+        partitions.update(
+            (row[0], row[1]) for row in sqlite_session.query(rental_store, FactPayment.date_key_paid)
+            .filter(FactPayment.rental_id.in_(ids))
+        )
+    for start in range(0, len(payment_ids), LOOKUP_CHUNK):
+        ids = payment_ids[start:start + LOOKUP_CHUNK]
+        partitions.update(
+            (row[0], row[1]) for row in sqlite_session.query(rental_store, FactPayment.date_key_paid)
+            .filter(FactPayment.payment_id.in_(ids))
+        )
+    return {p for p in partitions if p[0] is not None and p[1] is not None}
+
+def refresh_store_daily(sqlite_session, partitions):
+    """Recomputes the given partitions and remembers them for validate_incremental."""
+    if not partitions:
+        return
+    sqlite_session.flush()
+    sqlite_session.execute(STORE_DAILY_SQL, [
+        {'store_key': store_key, 'date_key': date_key} for store_key, date_key in partitions
+    ])
+    store_ids = {key: store_id for store_id, key in get_key_cache(sqlite_session).full_map(DimStore).items()}
+    touched = sqlite_session.info.setdefault('store_daily_touched', set())
+    touched.update((store_ids[store_key], date_key) for store_key, date_key in partitions if store_key in store_ids)
+
+def day_ranges(column, date_keys):
+    """[day, next day) range filters on column for each YYYYMMDD date key."""
+    ranges = []
+    for date_key in date_keys:
+        day = datetime.strptime(str(date_key), '%Y%m%d')
+        ranges.append(and_(column >= day, column < day + timedelta(days=1)))
+    return or_(*ranges)
+
+def to_date_key(value):
+    """DATE() comes back as a date from MySQL and as a string from SQLite."""
+    return int(str(value)[:10].replace('-', ''))
+
+def run_sides(mysql_session, mysql_side, sqlite_side):
+    """(mysql_side(), sqlite_side()) of a validation, computed at the same
+    time: the MySQL half on a worker thread (nothing else uses mysql_session
+    meanwhile), the SQLite half on this one. A source session that can't
+    leave its thread, like an in-memory SQLite stand-in, runs first instead."""
+    if isinstance(mysql_session.get_bind().pool, SingletonThreadPool):
+        return mysql_side(), sqlite_side()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='validate-mysql') as pool:
+        source = pool.submit(mysql_side)
+        warehouse = sqlite_side()
+        return source.result(), warehouse
+
+def source_partitions(mysql_session, days):
+    """MySQL side of validate_incremental: {(store_id, date_key): (count, checksum)}
+    of rentals and {(store_id, date_key): total} of payments on the given days."""
+    m_rentals, m_payments = {}, {}
+    for start in range(0, len(days), VALIDATE_DAYS_PER_QUERY):
+        chunk = days[start:start + VALIDATE_DAYS_PER_QUERY]
+        rented_day = func.date(Rental.rental_date)
+        for store_id, day, count, checksum in mysql_session.query(
+            Inventory.store_id, rented_day, func.count(Rental.rental_id), func.sum(Rental.rental_id)
+        ).join(Inventory, Rental.inventory_id == Inventory.inventory_id)\
+         .filter(day_ranges(Rental.rental_date, chunk))\
+         .group_by(Inventory.store_id, rented_day):
+            m_rentals[(store_id, to_date_key(day))] = (count, int(checksum))
+
+        paid_day = func.date(Payment.payment_date)
+        for store_id, day, total in mysql_session.query(
+            Inventory.store_id, paid_day, func.sum(Payment.amount)
+        ).join(Rental, Payment.rental_id == Rental.rental_id)\
+         .join(Inventory, Rental.inventory_id == Inventory.inventory_id)\
+         .filter(day_ranges(Payment.payment_date, chunk))\
+         .group_by(Inventory.store_id, paid_day):
+            m_payments[(store_id, to_date_key(day))] = round(float(total), 2)
+    return m_rentals, m_payments
+
+def warehouse_partitions(sqlite_session, keys):
+    """SQLite side of validate_incremental, the agg_store_daily rows of keys."""
+    s_partitions = {}
+    for start in range(0, len(keys), LOOKUP_CHUNK):
+        for row in sqlite_session.query(AggStoreDaily).filter(
+            tuple_(AggStoreDaily.store_id, AggStoreDaily.date_key).in_(keys[start:start + LOOKUP_CHUNK])
+        ):
+            s_partitions[(row.store_id, row.date_key)] = (
+                (row.rental_count, row.rental_checksum), round(float(row.payment_total), 2)
+            )
+    return s_partitions
+
+def validate_incremental(mysql_session, sqlite_session):
+    """Re-verifies only the store/day partitions touched in this session against
+    MySQL, so the cost follows the size of the delta. Rental count, rental_id
+    checksum and payment total are compared per partition, the MySQL and
+    SQLite sides are read concurrently."""
+    touched = sqlite_session.info.get('store_daily_touched', set())
+    print(f"Validating {len(touched)} store/day partitions")
+    if not touched:
+        return True
+
+    (m_rentals, m_payments), s_partitions = run_sides(
+        mysql_session,
+        partial(source_partitions, mysql_session, sorted({date_key for _, date_key in touched})),
+        partial(warehouse_partitions, sqlite_session, list(touched)))
+
+    is_valid = True
+    for partition in sorted(touched):
+        m_rental = m_rentals.get(partition, (0, 0))
+        m_payment = m_payments.get(partition, 0)
+        s_rental, s_payment = s_partitions.get(partition, ((0, 0), 0))
+        if m_rental != s_rental or m_payment != s_payment:
+            store_id, date_key = partition
+            print(f"Store {store_id} on {date_key} mismatch! "
+                  f"MySQL: {m_rental[0]} rentals ${m_payment}, SQLite: {s_rental[0]} rentals ${s_payment}")
+            is_valid = False
+    if is_valid:
+        print(f"All {len(touched)} partitions match")
+    return is_valid
+
+def warehouse_store_totals():
+    """Payment total per store in the warehouse, what validate compares."""
+    return select(DimStore.store_id, func.sum(FactPayment.amount))\
+        .join(FactRental, FactRental.store_key == DimStore.store_key)\
+        .join(FactPayment, FactPayment.rental_id == FactRental.rental_id)\
+        .group_by(DimStore.store_id)
+
+def source_totals(mysql_session):
+    """MySQL side of validate: rental count and payment total per store."""
+    rentals = mysql_session.query(func.count(Rental.rental_id)).scalar()
+    store_totals = mysql_session.query(
         Inventory.store_id, 
         func.sum(Payment.amount)
     ).join(Rental, Payment.rental_id == Rental.rental_id)\
      .join(Inventory, Rental.inventory_id == Inventory.inventory_id)\
      .group_by(Inventory.store_id).all()
+    return rentals, {row[0]: round(float(row[1]), 2) for row in store_totals}
 
-    sqlite_store_totals = sqlite_session.query(
-        DimStore.store_id,
-        func.sum(FactPayment.amount)
-    ).join(FactRental, FactRental.store_key == DimStore.store_key)\
-     .join(FactPayment, FactPayment.rental_id == FactRental.rental_id)\
-     .group_by(DimStore.store_id).all()
+def warehouse_totals(sqlite_session):
+    """SQLite side of validate, the same numbers from the facts."""
+    rentals = sqlite_session.query(func.count(FactRental.rental_id)).scalar()
+    store_totals = sqlite_session.execute(warehouse_store_totals()).all()
+    return rentals, {row[0]: round(float(row[1]), 2) for row in store_totals}
 
-    #Convert results for comparison: {id: total_amount}
-    m_totals = {row[0]: round(float(row[1]), 2) for row in mysql_store_totals}
-    s_totals = {row[0]: round(float(row[1]), 2) for row in sqlite_store_totals}
+def validate(mysql_session, sqlite_session):
+    """Compares row counts and totals per store. The MySQL and SQLite sides
+    run concurrently.
+    """
+    print("Validating")
+    
+    # mysql_session = MySQLSession()
+    # sqlite_session = SQLiteSession()
+    (mysql_rentals, m_totals), (sqlite_rentals, s_totals) = run_sides(
+        mysql_session, partial(source_totals, mysql_session), partial(warehouse_totals, sqlite_session))
 
     is_valid = True
     
@@ -669,6 +1868,47 @@ def validate(mysql_session, sqlite_session):
     return is_valid
 
 
+#INDEX ADVICE
+def index_workload(sample_ids=(1, 2, 3)):
+    """(name, statement) of the warehouse's recurring SQLite statements, as the
+    code builds them: validate, the key map builds and lookups, and the
+    incremental fact deletes and agg_store_daily lookups. sample_ids stand in
+    for the ids of a batch."""
+    ids = list(sample_ids)
+    rental_store = select(FactRental.store_key).where(FactRental.rental_id == FactPayment.rental_id).scalar_subquery()
+    workload = [
+        ('validate: rental count', select(func.count(FactRental.rental_id))),
+        ('validate: store totals', warehouse_store_totals()),
+    ]
+    for model, (id_name, key_name) in LOOKUPS.items():
+        id_col, key_col = getattr(model, id_name), getattr(model, key_name)
+        workload.append((f'key map: {model.__tablename__}', select(id_col, key_col).order_by(id_col)))
+        workload.append((f'key lookup: {model.__tablename__}', select(id_col, key_col).where(id_col.in_(ids))))
+    workload += [
+        ('incremental: delete rentals', delete(FactRental).where(FactRental.rental_id.in_(ids))),
+        ('incremental: delete payments', delete(FactPayment).where(FactPayment.payment_id.in_(ids))),
+        ('incremental: rental days', select(FactRental.store_key, FactRental.date_key_rented)
+            .where(FactRental.rental_id.in_(ids))),
+        ('incremental: payment days by rental', select(rental_store, FactPayment.date_key_paid)
+            .where(FactPayment.rental_id.in_(ids))),
+        ('incremental: payment days', select(rental_store, FactPayment.date_key_paid)
+            .where(FactPayment.payment_id.in_(ids))),
+    ]
+    for bridge_model, other_model in ((BridgeFilmActor, DimActor), (BridgeFilmCategory, DimCategory)):
+        other_pk = inspect(other_model).primary_key[0]
+        workload.append((f'incremental: {bridge_model.__tablename__} pairs',
+                         select(DimFilm.film_id, getattr(other_model, NATURAL_KEYS[other_model]))
+                         .select_from(bridge_model)
+                         .join(DimFilm, DimFilm.film_key == bridge_model.film_key)
+                         .join(other_model, other_pk == getattr(bridge_model, other_pk.key))
+                         .where(DimFilm.film_id.in_(ids))))
+    return workload
+
+def advise_indexes(engine, apply=False):
+    """Runs the index advisor (advisor.py) over index_workload."""
+    tables = {table.name for table in LiteBase.metadata.sorted_tables}
+    return advisor.advise(engine, index_workload(), tables, apply)
+
 def init_command():
     """Init!"""
     print("Starting initilisation")
@@ -678,6 +1918,8 @@ def init_command():
         
     print("Creating SQLite tables")
     LiteBase.metadata.create_all(sqlite_engine)
+    ensure_columns(sqlite_engine)
+    ensure_indexes(sqlite_engine)
     
 
     session = SQLiteSession()
@@ -692,43 +1934,95 @@ def init_command():
     finally:
         session.close()
 
-def run_sync(mysql_session, sqlite_session):
-    """Big sync function to handle incremental syncing correctly and in order
+def partition_facts(sqlite_session):
+    """Moves the facts into one file per year of their date key (partitions.py).
+    Rows without a date stay in the main file. From then on every connection
+    attaches the year files, and syncs write to the years they touch."""
+    FactPartition.__table__.create(sqlite_session.get_bind(), checkfirst=True)
+    if partitions.fact_years(sqlite_session):
+        print("Facts are already partitioned by year.")
+        return 0
+    conn = sqlite_session.connection()
+    years = set()
+    for model, date_key in PARTITION_KEYS.items():
+        years.update(conn.exec_driver_sql(f"SELECT DISTINCT {date_key} / 10000 FROM main.{model.__tablename__} "
+                                          f"WHERE {date_key} IS NOT NULL").scalars())
+    if not years:
+        print("No facts to partition yet, run partition-facts after full-load.")
+        return 0
+    #Checked before any file is created
+    partitions.check_attach_limit(conn.connection.dbapi_connection, sorted(years))
+
+    moved = 0
+    created = []
+    try:
+        for year in sorted(years):
+            path = partitions.year_path(sqlite_session.get_bind(), year)
+            if not os.path.exists(path):
+                created.append(path)
+            schema = partitions.ensure_year(sqlite_session, year)
+            span = (year * 10000 + 101, year * 10000 + 1231)
+            for model, date_key in PARTITION_KEYS.items():
+                table = model.__tablename__
+                columns = ', '.join(c.name for c in model.__table__.columns)
+                copied = conn.exec_driver_sql(f"INSERT INTO {schema}.{table} ({columns}) SELECT {columns} "
+                                              f"FROM main.{table} WHERE {date_key} BETWEEN ? AND ?", span).rowcount
+                conn.exec_driver_sql(f"DELETE FROM main.{table} WHERE {date_key} BETWEEN ? AND ?", span)
+                print(f"Moved {copied} rows of {table} to {path}")
+                moved += copied
+        sqlite_session.commit()
+    except Exception:
+        #Closing the connection rolls the move back and detaches the year files,
+        #so the ones this run created can be removed
+        conn.invalidate()
+        sqlite_session.rollback()
+        for path in created:
+            for leftover in (path, path + '-journal'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        raise
+    return moved
+
+def run_sync(mysql_session, sqlite_session, pipeline=False, workers=SYNC_WORKERS):
+    """Big sync function to handle incremental syncing correctly and in order.
+    The syncs run as SYNC_GRAPH, with up to workers MySQL extracts at once.
+    With pipeline, the fact syncs overlap extract, transform and load.
+    Every sync is measured as its own stage and the run is recorded in sync_run.
     """
     print(f"Synching!!!! {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ")
     
     # mysql_session = MySQLSession()
     # sqlite_session = SQLiteSession()
+    run = metrics.start_run('incremental --pipeline' if pipeline else 'incremental', sqlite_session)
+    status = 'failed'
     try:
-        print("\nSyncing Actor...")
-        sync_dim_actor_inc(mysql_session, sqlite_session)
-        print('Category')
-        sync_dim_category_inc(mysql_session, sqlite_session)
-        print('Store')
-        sync_dim_store_inc(mysql_session, sqlite_session)
-        print('Customer')
-        sync_dim_customer_inc(mysql_session, sqlite_session)
-        print('Film')
-        sync_dim_film_inc(mysql_session, sqlite_session)
-
-        print("\nNext, Syncing Bridge. Film Actor.")
-        sync_bridge_film_actor_inc(mysql_session, sqlite_session)
-        print('Film Category.')
-        sync_bridge_film_category_inc(mysql_session, sqlite_session)
-
-        print("\nLast and certainly not least, Syncing Facts. Rentals.")
-        rentals_synced = sync_fact_rental_inc(mysql_session, sqlite_session)
-        print('Payments.')
-        payments_synced = sync_fact_payment_inc(mysql_session, sqlite_session)
-        
-        print(f"Processed {rentals_synced} rentals and {payments_synced} payments.")
-        sqlite_session.flush()
-        if validate(mysql_session, sqlite_session):
+        if sqlite_session.query(AggStoreDaily).first() is None:
+            with metrics.stage(sqlite_session, 'agg_store_daily'), metrics.timed(sqlite_session, 'load'):
+                rebuild_store_daily(sqlite_session)
+        pipelines = {}
+        if pipeline:
+            pipelines = {'fact_rental': Pipeline('fact_rental'), 'fact_payment': Pipeline('fact_payment')}
+        with metrics.stage(sqlite_session, 'probe'), metrics.timed(sqlite_session, 'extract'):
+            watermarks, idle = probe_changes(SYNC_GRAPH, mysql_session, sqlite_session)
+        synced = run_sync_graph(SYNC_GRAPH, mysql_session, sqlite_session, workers, pipelines,
+                                watermarks, idle)
+
+        print(f"Processed {synced['fact_rental']} rentals and {synced['fact_payment']} payments.")
+        if pipeline:
+            print("Pipeline stages:")
+            for pipe in pipelines.values():
+                print(pipe.report())
+        with metrics.stage(sqlite_session, 'validate'):
+            sqlite_session.flush()
+            is_valid = validate_incremental(mysql_session, sqlite_session)
+        if is_valid:
             sqlite_session.commit()
             print("Validation complete. Transaction committed.")
+            status = 'ok'
         else:
             sqlite_session.rollback()
             print("Inconsistency detected. Transaction rollbacked")
+            status = 'rolled_back'
 
     except Exception as e:
         sqlite_session.rollback()
@@ -736,24 +2030,66 @@ def run_sync(mysql_session, sqlite_session):
     finally:
         mysql_session.close()
         sqlite_session.close()
+        metrics.finish_run(run, status, sqlite_session.get_bind())
 
 def main():
     parser = argparse.ArgumentParser(description="Sakila SQLite Incremental Manager")
+    parser.add_argument('--profile', action='store_true',
+                        help='Count and time every SQL statement and report likely N+1 queries at the end.')
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
     #Init Command
     subparsers.add_parser('init', help='Initialise the SQLite database.')
 
     #Full-load Command
-    subparsers.add_parser('full-load', help='Scrape from Sakila into SQLite.')
+    full_load_parser = subparsers.add_parser('full-load', help='Scrape from Sakila into SQLite.')
+    full_load_parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                                  help='Rows streamed from MySQL per chunk.')
+    full_load_parser.add_argument('--batch-size', type=int, default=None,
+                                  help='Rows per SQLite executemany call (overrides the per-table defaults).')
+    full_load_parser.add_argument('--workers', type=int, default=1,
+                                  help='Tables extracted concurrently, each on its own snapshot connection.')
+    full_load_parser.add_argument('--bulk-mode', action='store_true',
+                                  help='Drop indexes and relax durability during the load, then rebuild and restore.')
+    full_load_parser.add_argument('--resume', action='store_true',
+                                  help='Continue an interrupted full-load after its last committed chunk.')
+    full_load_parser.add_argument('--pipeline', action='store_true',
+                                  help='Overlap extract, transform and load of each table and report the stages '
+                                       '(not with --workers).')
+    full_load_parser.add_argument('--pushdown', action='store_true',
+                                  help='Join rentals to inventory and payments to staff on MySQL instead of in Python.')
 
     #Incremental Command
-    subparsers.add_parser('incremental', help='Load only new or changed data since the last sync.')
+    incremental_parser = subparsers.add_parser('incremental', help='Load only new or changed data since the last sync.')
+    incremental_parser.add_argument('--cdc', action='store_true',
+                                    help='Consume the source changelog instead of polling last_update.')
+    incremental_parser.add_argument('--pipeline', action='store_true',
+                                    help='Overlap extract, transform and load of the fact syncs.')
+    incremental_parser.add_argument('--workers', type=int, default=SYNC_WORKERS,
+                                    help='Syncs extracted from MySQL concurrently. 1 runs them one at a time.')
+
+    #Changelog Command
+    subparsers.add_parser('install-changelog', help='Create the changelog table and triggers on MySQL for --cdc.')
+
+    #Index advice Command
+    advise_parser = subparsers.add_parser('advise-indexes',
+                                          help='EXPLAIN the warehouse workload and propose indexes for scans and sorts.')
+    advise_parser.add_argument('--apply', action='store_true',
+                               help='Build the proposed indexes, measure them and keep those that help.')
+
+    #Partition Command
+    subparsers.add_parser('partition-facts', help='Split the fact tables into one attached SQLite file per year.')
 
     #Validate Command
     subparsers.add_parser('validate', help='Verify data consistency.')
 
     args = parser.parse_args()
+    if args.command == 'full-load' and args.pipeline and args.workers > 1:
+        parser.error("full-load: --pipeline runs one table at a time, it can't be combined with --workers > 1")
+
+    profiler = None
+    if args.profile:
+        profiler = QueryProfiler(__file__).install(mysql=mysql_engine, sqlite=sqlite_engine)
 
     mysql_session = MySQLSession()
     sqlite_session = SQLiteSession()
@@ -764,12 +2100,26 @@ def main():
             print("Init Success")
 
         elif args.command == 'full-load':
-            run_full_load()
+            run_full_load(args.chunk_size, args.batch_size, args.workers, args.bulk_mode, args.pipeline,
+                          args.resume, args.pushdown)
             print("Full load success")
 
         elif args.command == 'incremental':
-            run_sync(mysql_session, sqlite_session)
-            print("Successfully synced changes since last timestamp")
+            if args.cdc:
+                run_cdc_sync(mysql_session, sqlite_session)
+                print("Successfully synced changes since last changelog offset")
+            else:
+                run_sync(mysql_session, sqlite_session, args.pipeline, args.workers)
+                print("Successfully synced changes since last timestamp")
+
+        elif args.command == 'install-changelog':
+            install_changelog(mysql_engine)
+
+        elif args.command == 'advise-indexes':
+            advise_indexes(sqlite_engine, args.apply)
+
+        elif args.command == 'partition-facts':
+            partition_facts(sqlite_session)
 
         elif args.command == 'validate':
             if validate(mysql_session, sqlite_session):
@@ -787,6 +2137,9 @@ def main():
     finally:
         mysql_session.close()
         sqlite_session.close()
+        if profiler is not None:
+            profiler.uninstall()
+            print(profiler.report())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -167,4 +167,776 @@ def test_validate():
         
     finally:
         mysql_session.close()
-        sqlite_session.close()
\ No newline at end of file
+        sqlite_session.close()
+
+def test_dim_date_extends():
+    """Calendar is built in SQL and grows on demand"""
+    from sqlalchemy.orm import Session
+    from models import LiteBase, DimDate
+    from sync import populate_dim_date, extend_dim_date
+
+    engine = create_engine("sqlite://")
+    LiteBase.metadata.create_all(engine)
+    with Session(engine) as session:
+        populate_dim_date(session, 2005, 2006)
+        day = session.get(DimDate, 20050528)
+        assert (day.quarter, day.day_of_week, day.is_weekend) == (2, 6, 1)
+
+        extend_dim_date(session, [datetime(2004, 12, 30), None, datetime(2007, 1, 2)])
+        low, high = session.query(func.min(DimDate.date_key), func.max(DimDate.date_key)).one()
+        assert (low, high) == (20041230, 20070102)
+        assert session.query(DimDate).count() == 365 * 2 + 4
+
+
+def test_key_cache_sees_upserts():
+    """Keys inserted mid-run are resolvable from the shared cache"""
+    from sqlalchemy.orm import Session
+    from models import LiteBase, DimActor
+    from keycache import get_key_cache
+    from sync import upsert_dimension
+
+    engine = create_engine("sqlite://")
+    LiteBase.metadata.create_all(engine)
+    with Session(engine) as session:
+        upsert_dimension(session, DimActor, 'actor_id', [{"actor_id": 1, "first_name": "A", "last_name": "B"}])
+        cache = get_key_cache(session)
+        assert set(cache.full_map(DimActor)) == {1}
+
+        upsert_dimension(session, DimActor, 'actor_id', [{"actor_id": 2, "first_name": "C", "last_name": "D"}])
+        assert cache.resolve(DimActor, [1, 2, 3]) == {1: 1, 2: 2}
+
+        session.rollback()
+        assert 'key_cache' not in session.info
+
+
+def seed_source(session, rentals=1):
+    """One store's worth of Sakila rows in a SQLite stand-in source, with the
+    given number of rentals, each paid once"""
+    from models import (Language, Country, City, Address, Store, Staff, Customer, Actor,
+                        Film, FilmActor, Inventory)
+    day = datetime(2005, 6, 1, 12, 0)
+    session.add_all([
+        Language(language_id=1, name='English'),
+        Country(country_id=1, country='Canada'),
+        City(city_id=1, city='Lethbridge', country_id=1),
+        Address(address_id=1, address='47 MySakila Drive', city_id=1),
+        Store(store_id=1, manager_staff_id=1, address_id=1),
+        Staff(staff_id=1, first_name='Mike', last_name='Hillyer', address_id=1, store_id=1, username='Mike'),
+        Customer(customer_id=1, store_id=1, first_name='Mary', last_name='Smith', address_id=1),
+        Actor(actor_id=1, first_name='Penelope', last_name='Guiness'),
+        Film(film_id=1, title='Academy Dinosaur', language_id=1),
+        Inventory(inventory_id=1, film_id=1, store_id=1),
+    ])
+    session.flush()
+    session.add(FilmActor(film_id=1, actor_id=1))
+    for i in range(1, rentals + 1):
+        session.add(Rental(rental_id=i, rental_date=day, inventory_id=1, customer_id=1, staff_id=1))
+    session.flush()
+    for i in range(1, rentals + 1):
+        session.add(Payment(payment_id=i, customer_id=1, staff_id=1, rental_id=i, amount=2.99, payment_date=day))
+    session.commit()
+
+def test_cdc_sync_from_changelog(tmp_path, monkeypatch):
+    """CDC mode against a SQLite stand-in source whose changelog is filled by triggers"""
+    import json
+    import metrics
+    from sqlalchemy.orm import sessionmaker
+    from models import LiteBase, SyncState, SyncRun, DimActor, DimCustomer, BridgeFilmActor
+    from models import Actor, FilmActor
+    from sync import install_changelog, run_cdc_sync, populate_dim_date
+
+    monkeypatch.setattr(metrics, 'METRICS_PATH', str(tmp_path / 'metrics.jsonl'))
+    source = create_engine("sqlite://")
+    SakilaBase.metadata.create_all(source)
+    install_changelog(source)
+    warehouse = create_engine("sqlite://")
+    LiteBase.metadata.create_all(warehouse)
+    Source, Warehouse = sessionmaker(bind=source), sessionmaker(bind=warehouse)
+    with Warehouse() as session:
+        populate_dim_date(session, 2005, 2006)
+        session.commit()
+
+    with Source() as session:
+        seed_source(session)
+
+    run_cdc_sync(Source(), Warehouse())
+    with Warehouse() as session:
+        assert session.query(DimCustomer).count() == 1
+        assert session.query(BridgeFilmActor).count() == 1
+        assert session.query(FactRental).filter_by(rental_id=1).count() == 1
+        assert session.query(FactPayment).filter_by(payment_id=1).count() == 1
+        offset = session.query(SyncState).filter_by(table_name='changelog').one().last_change_id
+
+    #Deletes are visible to CDC, unlike last_update polling
+    with Source() as session:
+        session.query(Payment).filter_by(payment_id=1).delete()
+        session.query(FilmActor).delete()
+        session.query(Actor).filter_by(actor_id=1).update({'last_name': 'Cruz'})
+        session.commit()
+
+    run_cdc_sync(Source(), Warehouse())
+    with Warehouse() as session:
+        assert session.query(FactPayment).count() == 0
+        assert session.query(BridgeFilmActor).count() == 0
+        assert session.query(DimActor).one().last_name == 'Cruz'
+        assert session.query(SyncState).filter_by(table_name='changelog').one().last_change_id > offset
+
+    #Both runs were measured, in the metrics file and in sync_run
+    records = [json.loads(line) for line in open(tmp_path / 'metrics.jsonl')]
+    assert [r['status'] for r in records] == ['ok', 'ok']
+    assert records[0]['rows_written'] > 0
+    with Warehouse() as session:
+        assert session.query(SyncRun).count() == 2
+
+def test_full_load_resumes_after_last_chunk():
+    """A load that dies mid-table keeps its committed chunks and resumes after them"""
+    from sqlalchemy.orm import sessionmaker
+    from models import LiteBase, LoadCheckpoint
+    from sync import FACT_STEPS, load_dims, load_bridges, load_facts, run_steps, get_checkpoints, populate_dim_date
+
+    source = create_engine("sqlite://")
+    SakilaBase.metadata.create_all(source)
+    warehouse = create_engine("sqlite://")
+    LiteBase.metadata.create_all(warehouse)
+    Source, Warehouse = sessionmaker(bind=source), sessionmaker(bind=warehouse)
+    with Source() as session:
+        seed_source(session, rentals=5)
+    mysql_session, sqlite_session = Source(), Warehouse()
+    populate_dim_date(sqlite_session, 2005, 2005)
+    load_dims(mysql_session, sqlite_session, chunk_size=2)
+    load_bridges(mysql_session, sqlite_session, chunk_size=2)
+
+    calls = []
+    def flaky(chunk, ctx):
+        calls.append(chunk)
+        if len(calls) == 2:
+            raise RuntimeError("connection lost")
+        return FACT_STEPS[2].transform(chunk, ctx)
+    steps = [step._replace(transform=flaky) if step.source == 'rental' else step for step in FACT_STEPS]
+    with pytest.raises(RuntimeError):
+        run_steps(steps, mysql_session, sqlite_session, 2, None, {})
+    sqlite_session.rollback()
+    assert sqlite_session.query(FactRental).count() == 2
+    assert sqlite_session.get(LoadCheckpoint, 'rental').last_pk == '2'
+
+    load_facts(mysql_session, sqlite_session, chunk_size=2, checkpoints=get_checkpoints(sqlite_session))
+    assert sorted(r.rental_id for r in sqlite_session.query(FactRental)) == [1, 2, 3, 4, 5]
+    assert sqlite_session.query(FactPayment).count() == 5
+    assert all(c.completed for c in sqlite_session.query(LoadCheckpoint))
+    assert sqlite_session.get(LoadCheckpoint, 'rental').rows_loaded == 5
+
+def test_profiler_flags_per_row_queries():
+    """Lazy loads in a comprehension show up as an N+1 against the sync function"""
+    from sqlalchemy.orm import sessionmaker
+    from models import Country, City
+    from profiler import QueryProfiler, normalize_sql
+
+    assert normalize_sql("SELECT a FROM t WHERE id IN (?, ?, ?) AND b = 'x'") == \
+        "SELECT a FROM t WHERE id IN (?...) AND b = ?"
+
+    source = create_engine("sqlite://")
+    SakilaBase.metadata.create_all(source)
+    with sessionmaker(bind=source)() as session:
+        session.add_all([Country(country_id=i, country=f'Country {i}') for i in range(1, 13)])
+        session.add_all([City(city_id=i, city=f'City {i}', country_id=i) for i in range(1, 13)])
+        session.commit()
+
+    def sync_cities(session):
+        return [c.country.country for c in session.query(City).all()]
+
+    profiler = QueryProfiler(__file__).install(mysql=source)
+    try:
+        with sessionmaker(bind=source)() as session:
+            assert len(sync_cities(session)) == 12
+    finally:
+        profiler.uninstall()
+    (engine, caller, sql, stats), = profiler.n_plus_one()
+    assert (engine, caller, stats.count) == ('mysql', 'sync_cities', 12)
+    assert 'FROM country WHERE country.country_id = ?' in sql
+    assert 'Possible N+1' in profiler.report()
+
+
+def test_sync_graph_loads_after_dependencies():
+    """Extracts run ahead, loads wait for the nodes they depend on"""
+    import time
+    from sqlalchemy.orm import Session
+    from models import LiteBase
+    from sync import SyncNode, run_sync_graph
+
+    loaded = []
+    def node(name, deps=(), delay=0.0):
+        def extract(mysql_session, last_sync):
+            time.sleep(delay)
+            return name
+        def load(mysql_session, sqlite_session, changes):
+            loaded.append(changes)
+            return 1
+        return SyncNode(name, extract, load, deps, None)
+
+    graph = [node('fact', ('slow_dim', 'dim')), node('slow_dim', delay=0.2), node('dim'), node('bridge', ('dim',))]
+    engine = create_engine("sqlite://")
+    LiteBase.metadata.create_all(engine)
+    with Session(engine) as session:
+        synced = run_sync_graph(graph, None, session, workers=4)
+        assert synced == dict.fromkeys(['fact', 'slow_dim', 'dim', 'bridge'], 1)
+        assert loaded.index('fact') > max(loaded.index('slow_dim'), loaded.index('dim'))
+        assert loaded.index('bridge') < loaded.index('slow_dim')
+
+        with pytest.raises(ValueError):
+            run_sync_graph([node('a', ('b',)), node('b', ('a',))], None, session)
+
+
+def test_probe_skips_unchanged_sources():
+    """One query per side tells which syncs have something newer than their watermark"""
+    from sqlalchemy.orm import Session
+    from models import LiteBase, SyncState, Actor
+    from sync import SYNC_GRAPH, probe_changes
+
+    source = create_engine("sqlite://")
+    SakilaBase.metadata.create_all(source)
+    warehouse = create_engine("sqlite://")
+    LiteBase.metadata.create_all(warehouse)
+    with Session(source) as mysql_session, Session(warehouse) as sqlite_session:
+        seed_source(mysql_session)
+        newest = datetime.now() + timedelta(minutes=1)
+        sqlite_session.add_all([SyncState(table_name=node.name, last_sync_timestamp=newest) for node in SYNC_GRAPH])
+        sqlite_session.flush()
+        _, idle = probe_changes(SYNC_GRAPH, mysql_session, sqlite_session)
+        assert idle == {node.name for node in SYNC_GRAPH}
+
+        mysql_session.get(Actor, 1).last_update = newest + timedelta(seconds=1)
+        mysql_session.flush()
+        _, idle = probe_changes(SYNC_GRAPH, mysql_session, sqlite_session)
+        assert idle == {node.name for node in SYNC_GRAPH} - {'dim_actor'}
+
+
+def test_watermark_covers_joined_sources():
+    """A joined address newer than its customer and store doesn't make them look changed forever"""
+    from sqlalchemy.orm import Session
+    from models import LiteBase, Address
+    from sync import SYNC_GRAPH, probe_changes, sync_dim_customer_inc, sync_dim_store_inc
+
+    source = create_engine("sqlite://")
+    SakilaBase.metadata.create_all(source)
+    warehouse = create_engine("sqlite://")
+    LiteBase.metadata.create_all(warehouse)
+    with Session(source) as mysql_session, Session(warehouse) as sqlite_session:
+        seed_source(mysql_session)
+        mysql_session.get(Address, 1).last_update = datetime.now() + timedelta(minutes=1)
+        mysql_session.commit()
+
+        assert sync_dim_customer_inc(mysql_session, sqlite_session) == 1
+        assert sync_dim_store_inc(mysql_session, sqlite_session) == 1
+        sqlite_session.flush()
+        _, idle = probe_changes(SYNC_GRAPH, mysql_session, sqlite_session)
+        assert {'dim_customer', 'dim_store'} <= idle
+        assert sync_dim_customer_inc(mysql_session, sqlite_session) == 0
+        assert sync_dim_store_inc(mysql_session, sqlite_session) == 0
+
+
+def test_shared_source_change_leaves_other_nodes_idle(tmp_path, monkeypatch):
+    """An address only a customer uses moves dim_store's watermark too, so the next probe skips both"""
+    import metrics
+    from sqlalchemy.orm import sessionmaker
+    from models import LiteBase, Address, Customer
+    from sync import SYNC_GRAPH, probe_changes, populate_dim_date, run_sync
+
+    monkeypatch.setattr(metrics, 'METRICS_PATH', str(tmp_path / 'metrics.jsonl'))
+    source = create_engine(f"sqlite:///{tmp_path / 'source.db'}")
+    SakilaBase.metadata.create_all(source)
+    Source = sessionmaker(bind=source)
+    warehouse = create_engine(f"sqlite:///{tmp_path / 'warehouse.db'}")
+    LiteBase.metadata.create_all(warehouse)
+    Warehouse = sessionmaker(bind=warehouse)
+    with Source() as session:
+        seed_source(session)
+        session.add(Address(address_id=2, address='28 MySQL Boulevard', city_id=1))
+        session.flush()
+        session.get(Customer, 1).address_id = 2
+        session.commit()
+    with Warehouse() as session:
+        populate_dim_date(session, 2005, 2005)
+        session.commit()
+    run_sync(Source(), Warehouse(), workers=1)
+
+    with Source() as session:
+        session.get(Address, 2).last_update = datetime.now() + timedelta(minutes=1)
+        session.commit()
+    with Source() as mysql_session, Warehouse() as sqlite_session:
+        _, idle = probe_changes(SYNC_GRAPH, mysql_session, sqlite_session)
+        assert 'dim_store' not in idle and 'dim_customer' not in idle
+    run_sync(Source(), Warehouse(), workers=1)
+    with Source() as mysql_session, Warehouse() as sqlite_session:
+        _, idle = probe_changes(SYNC_GRAPH, mysql_session, sqlite_session)
+        assert idle == {node.name for node in SYNC_GRAPH}
+
+
+def test_bridge_sync_writes_only_the_difference():
+    """A changed film_actor row moves one pair, the unchanged pair is left alone"""
+    from sqlalchemy.orm import Session
+    from models import LiteBase, Actor, Film, FilmActor, DimActor, DimFilm, BridgeFilmActor
+    from sync import sync_bridge_film_actor_inc, update_sync_state
+
+    source = create_engine("sqlite://")
+    SakilaBase.metadata.create_all(source)
+    warehouse = create_engine("sqlite://")
+    LiteBase.metadata.create_all(warehouse)
+    with Session(source) as mysql_session, Session(warehouse) as sqlite_session:
+        seed_source(mysql_session)
+        mysql_session.add_all([Actor(actor_id=2, first_name='Nick', last_name='Wahlberg'),
+                               Actor(actor_id=3, first_name='Ed', last_name='Chase')])
+        mysql_session.flush()
+        mysql_session.add(FilmActor(film_id=1, actor_id=3, last_update=datetime.now() + timedelta(minutes=1)))
+        mysql_session.commit()
+
+        sqlite_session.add(DimFilm(film_key=1, film_id=1, title='Academy Dinosaur'))
+        sqlite_session.add_all([DimActor(actor_key=k, actor_id=k) for k in (1, 2, 3)])
+        sqlite_session.add_all([BridgeFilmActor(film_key=1, actor_key=1), BridgeFilmActor(film_key=1, actor_key=2)])
+        sqlite_session.flush()
+
+        update_sync_state(sqlite_session, 'bridge_film_actor', datetime.now())
+        #Actor 2 left (film 1 was touched), actor 3 joined, actor 1 stays
+        mysql_session.query(Film).filter_by(film_id=1).update({'last_update': datetime.now() + timedelta(minutes=1)})
+        mysql_session.commit()
+
+        assert sync_bridge_film_actor_inc(mysql_session, sqlite_session) == 2
+        assert {row.actor_key for row in sqlite_session.query(BridgeFilmActor)} == {1, 3}
+
+
+def test_upsert_skips_unchanged_rows():
+    """Rows whose content hash matches are not rewritten, last_update alone doesn't count"""
+    from sqlalchemy.orm import Session
+    from models import LiteBase, DimActor
+    from sync import upsert_dimension
+
+    engine = create_engine("sqlite://")
+    LiteBase.metadata.create_all(engine)
+    with Session(engine) as session:
+        rows = [{"actor_id": i, "first_name": "A", "last_name": f"B{i}", "last_update": "2006-02-15"} for i in (1, 2, 3)]
+        assert upsert_dimension(session, DimActor, 'actor_id', rows) == 3
+
+        rows = [dict(row, last_update="2030-01-01") for row in rows]
+        rows[1]["first_name"] = "C"
+        assert upsert_dimension(session, DimActor, 'actor_id', rows) == 1
+        assert session.query(DimActor.first_name).filter_by(actor_id=2).scalar() == "C"
+
+
+def test_pushdown_facts_match_lookup_maps():
+    """Joining on the source resolves the same keys as the inventory and staff maps"""
+    from sqlalchemy.orm import sessionmaker
+    from models import LiteBase
+    from sync import load_dims, load_facts, populate_dim_date
+
+    source = create_engine("sqlite://")
+    SakilaBase.metadata.create_all(source)
+    with sessionmaker(bind=source)() as session:
+        seed_source(session, rentals=3)
+
+    facts = []
+    for pushdown in (False, True):
+        warehouse = create_engine("sqlite://")
+        LiteBase.metadata.create_all(warehouse)
+        with sessionmaker(bind=source)() as mysql_session, sessionmaker(bind=warehouse)() as sqlite_session:
+            populate_dim_date(sqlite_session, 2005, 2005)
+            load_dims(mysql_session, sqlite_session)
+            load_facts(mysql_session, sqlite_session, chunk_size=2, pushdown=pushdown)
+            facts.append((
+                [(r.rental_id, r.customer_key, r.film_key, r.store_key) for r in sqlite_session.query(FactRental)],
+                [(p.payment_id, p.customer_key, p.store_key) for p in sqlite_session.query(FactPayment)],
+            ))
+    assert facts[0] == facts[1]
+    assert len(facts[1][0]) == 3 and len(facts[1][1]) == 3
+
+
+def test_payment_store_matches_across_load_paths():
+    """A payment taken by another store's staff is booked to its rental's store on every path"""
+    from sqlalchemy.orm import sessionmaker
+    from models import LiteBase, Store, Staff, Inventory, DimStore
+    from sync import load_dims, load_facts, populate_dim_date, sync_fact_rental_inc, sync_fact_payment_inc
+
+    source = create_engine("sqlite://")
+    SakilaBase.metadata.create_all(source)
+    with sessionmaker(bind=source)() as session:
+        seed_source(session)
+        session.add_all([Store(store_id=2, manager_staff_id=2, address_id=1),
+                         Staff(staff_id=2, first_name='Jon', last_name='Stephens', address_id=1, store_id=2,
+                               username='Jon'),
+                         Inventory(inventory_id=2, film_id=1, store_id=2)])
+        session.flush()
+        session.add(Rental(rental_id=2, rental_date=datetime(2005, 6, 2), inventory_id=2, customer_id=1, staff_id=1))
+        session.flush()
+        session.add(Payment(payment_id=2, customer_id=1, staff_id=1, rental_id=2, amount=4.99,
+                            payment_date=datetime(2005, 6, 2)))
+        session.commit()
+
+    stores = []
+    for path in ('map', 'pushdown', 'incremental'):
+        warehouse = create_engine("sqlite://")
+        LiteBase.metadata.create_all(warehouse)
+        with sessionmaker(bind=source)() as mysql_session, sessionmaker(bind=warehouse)() as sqlite_session:
+            populate_dim_date(sqlite_session, 2005, 2005)
+            load_dims(mysql_session, sqlite_session)
+            if path == 'incremental':
+                sync_fact_rental_inc(mysql_session, sqlite_session)
+                sync_fact_payment_inc(mysql_session, sqlite_session)
+            else:
+                load_facts(mysql_session, sqlite_session, pushdown=path == 'pushdown')
+            stores.append(sorted(sqlite_session.query(FactPayment.payment_id, DimStore.store_id)
+                                 .join(DimStore, DimStore.store_key == FactPayment.store_key).all()))
+    assert stores[0] == [(1, 1), (2, 2)]
+    assert stores[0] == stores[1] == stores[2]
+
+
+def test_incremental_keeps_facts_with_unresolved_keys():
+    """A rental whose customer isn't in the warehouse yet is written with a NULL key, not lost"""
+    from sqlalchemy.orm import Session
+    from models import LiteBase, DimCustomer
+    from sync import load_dims, populate_dim_date, sync_fact_rental_inc, sync_fact_payment_inc
+
+    source = create_engine("sqlite://")
+    SakilaBase.metadata.create_all(source)
+    warehouse = create_engine("sqlite://")
+    LiteBase.metadata.create_all(warehouse)
+    with Session(source) as mysql_session, Session(warehouse) as sqlite_session:
+        seed_source(mysql_session)
+        populate_dim_date(sqlite_session, 2005, 2005)
+        load_dims(mysql_session, sqlite_session)
+        sqlite_session.query(DimCustomer).delete()
+
+        assert sync_fact_rental_inc(mysql_session, sqlite_session) == 1
+        assert sync_fact_payment_inc(mysql_session, sqlite_session) == 1
+        assert sqlite_session.query(FactRental.customer_key).all() == [(None,)]
+        assert sqlite_session.query(FactPayment.customer_key).all() == [(None,)]
+
+        #Changed again, its row is replaced rather than kept twice
+        mysql_session.query(Rental).update({'return_date': datetime(2005, 6, 3),
+                                            'last_update': datetime.now() + timedelta(minutes=1)})
+        mysql_session.commit()
+        assert sync_fact_rental_inc(mysql_session, sqlite_session) == 1
+        assert sqlite_session.query(FactRental.date_key_returned).all() == [(20050603,)]
+
+
+def test_compiled_mapping_builds_tuples():
+    """A mapping compiles to a transform giving tuples in column order, dropping rows without keys"""
+    from collections import namedtuple
+    from models import DimCustomer, DimFilm, DimStore
+    from transforms import mapped_columns, transform_rows
+
+    Source = namedtuple('Source', 'rental_id rental_date return_date customer_id staff_id last_update film_id store_id')
+    day = datetime(2005, 5, 24, 22, 53, 30)
+    chunk = [Source(1, day, day + timedelta(days=2), 1, 1, day, 1, 1),
+             Source(2, day, None, 2, 1, day, 1, 1)]
+    ctx = {DimCustomer: {1: 10}, DimFilm: {1: 20}, DimStore: {1: 30}}
+    rows = transform_rows(FactRental, chunk, ctx)
+    assert rows == [(1, 20050524, 20050526, 10, 20, 30, 1, 2.0, '2005-05-24 22:53:30')]
+    assert len(mapped_columns(FactRental)) == len(rows[0])
+
+
+def test_key_map_stores_dense_ids_in_array():
+    """KeyMap answers like a dict, keeping dense ids in its array and the rest in a dict"""
+    from keycache import KeyMap
+    from models import DimCustomer, DimFilm, DimStore
+    from collections import namedtuple
+    from transforms import transform_rows
+
+    key_map = KeyMap((i, i + 100) for i in range(1, 1001))
+    key_map[10 ** 9] = 7
+    assert len(key_map) == 1001 and len(key_map.slots) == 1000 and key_map.sparse == {10 ** 9: 7}
+    assert key_map[5] == 105 and 10 ** 9 in key_map and 1001 not in key_map
+    assert key_map.get_many([1, 1000, 1001, None, 10 ** 9]) == [101, 1100, None, None, 7]
+    assert key_map.pop(5) == 105 and key_map.get(5) is None and len(key_map) == 1000
+
+    Source = namedtuple('Source', 'rental_id rental_date return_date customer_id staff_id last_update film_id store_id')
+    day = datetime(2005, 5, 24)
+    chunk = [Source(1, day, None, 1, 1, day, 1, 1), Source(2, day, None, 5, 1, day, 1, 1)]
+    ctx = {DimCustomer: key_map, DimFilm: KeyMap([(1, 20)]), DimStore: {1: 30}}
+    assert [row[3] for row in transform_rows(FactRental, chunk, ctx)] == [101]
+    #Incremental keeps the row, with a NULL key like before
+    assert [row[3] for row in transform_rows(FactRental, chunk, ctx, keep_missing=True)] == [101, None]
+
+
+def test_partitioned_facts_route_by_year(tmp_path):
+    """partition-facts splits the facts into year files, writes go to the file of their year"""
+    from sqlalchemy.orm import Session
+    from models import LiteBase
+    import partitions
+    from sync import bulk_insert, insert_facts, delete_facts, partition_facts, RENTAL_COLUMNS
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'warehouse.db'}")
+    partitions.install(engine)
+    LiteBase.metadata.create_all(engine)
+
+    def rental(rental_id, date_key):
+        return tuple(rental_id if c == 'rental_id' else date_key if c == 'date_key_rented' else None
+                     for c in RENTAL_COLUMNS)
+
+    with Session(engine) as session:
+        bulk_insert(session, FactRental, RENTAL_COLUMNS, [rental(1, 20050524), rental(2, 20060214)], 100)
+        assert partition_facts(session) == 2
+        assert partitions.fact_years(session) == [2005, 2006]
+        insert_facts(session, FactRental, RENTAL_COLUMNS, [rental(3, 20070101), rental(4, None)], 100)
+        delete_facts(session, FactRental, FactRental.rental_id, [1])
+        session.commit()
+
+    assert (tmp_path / 'warehouse_2007.db').exists()
+    with Session(engine) as session:
+        assert partitions.fact_years(session) == [2005, 2006, 2007]
+        assert sorted(r for r, in session.query(FactRental.rental_id)) == [2, 3, 4]
+        in_2006 = session.connection().exec_driver_sql("SELECT rental_id FROM y2006.fact_rental").scalars().all()
+        in_main = session.connection().exec_driver_sql("SELECT rental_id FROM main.fact_rental").scalars().all()
+        assert in_2006 == [2] and in_main == [4]
+
+
+def test_advisor_keeps_index_for_payment_deletes(tmp_path):
+    """advise-indexes proposes an index for the payment_id delete and keeps it once measured"""
+    from sqlalchemy.orm import Session
+    from models import LiteBase
+    from sync import advise_indexes, bulk_insert, PAYMENT_COLUMNS
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'warehouse.db'}")
+    LiteBase.metadata.create_all(engine)
+    rows = [tuple(i if c in ('payment_id', 'rental_id') else 20050524 if c == 'date_key_paid' else 1
+                  for c in PAYMENT_COLUMNS) for i in range(1, 50001)]
+    with Session(engine) as session:
+        bulk_insert(session, FactPayment, PAYMENT_COLUMNS, rows, 10000)
+        session.commit()
+
+    proposals = advise_indexes(engine, apply=True)
+    payment_ids = [p for p in proposals if p.table == 'fact_payment' and p.columns[0] == 'payment_id']
+    assert payment_ids and payment_ids[0].kept
+    with engine.connect() as conn:
+        names = [row[1] for row in conn.exec_driver_sql("PRAGMA index_list(fact_payment)")]
+    assert payment_ids[0].name in names
+
+
+def test_validate_reads_both_sides_concurrently(tmp_path):
+    """validate's MySQL side runs on a worker thread while the SQLite side runs here"""
+    import threading
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+    from models import LiteBase
+
+    source = create_engine(f"sqlite:///{tmp_path / 'source.db'}")
+    SakilaBase.metadata.create_all(source)
+    warehouse = create_engine(f"sqlite:///{tmp_path / 'warehouse.db'}")
+    LiteBase.metadata.create_all(warehouse)
+    with Session(source) as session:
+        seed_source(session)
+
+    threads = {}
+    for name, engine in (('source', source), ('warehouse', warehouse)):
+        event.listen(engine, 'before_cursor_execute',
+                     lambda *args, name=name: threads.setdefault(name, threading.current_thread().name))
+    with Session(source) as mysql_session, Session(warehouse) as sqlite_session:
+        assert validate(mysql_session, sqlite_session) is False
+    assert threads['source'].startswith('validate-mysql')
+    assert threads['warehouse'] == threading.current_thread().name
+
+
+def test_partitioning_checks_the_attach_limit(tmp_path, monkeypatch):
+    """More years than SQLite can attach fail before any year file is written,
+    a run failing halfway removes the files it created"""
+    from sqlalchemy.orm import Session
+    from models import LiteBase, FactPartition
+    import partitions
+    from sync import bulk_insert, insert_facts, partition_facts, RENTAL_COLUMNS
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'warehouse.db'}")
+    partitions.install(engine)
+    LiteBase.metadata.create_all(engine)
+
+    def rental(rental_id, year):
+        return tuple(rental_id if c == 'rental_id' else year * 10000 + 101 if c == 'date_key_rented' else None
+                     for c in RENTAL_COLUMNS)
+
+    with Session(engine) as session:
+        bulk_insert(session, FactRental, RENTAL_COLUMNS, [rental(i, 2000 + i) for i in range(1, 13)], 100)
+        session.commit()
+        with pytest.raises(ValueError, match="at most 10 files"):
+            partition_facts(session)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['warehouse.db']
+    with Session(engine) as session:
+        assert session.query(FactPartition).count() == 0
+        assert session.query(FactRental).count() == 12
+
+        #Within the limit it works, a sync then can't add an 11th year
+        session.query(FactRental).filter(FactRental.rental_id > 10).delete()
+        session.commit()
+        ensure_year = partitions.ensure_year
+        def failing(session, year):
+            if year == 2005:
+                raise OSError("disk full")
+            return ensure_year(session, year)
+        monkeypatch.setattr(partitions, 'ensure_year', failing)
+        with pytest.raises(OSError):
+            partition_facts(session)
+        assert sorted(p.name for p in tmp_path.iterdir()) == ['warehouse.db']
+        monkeypatch.undo()
+        assert partition_facts(session) == 10
+        with pytest.raises(ValueError, match="at most 10 files"):
+            insert_facts(session, FactRental, RENTAL_COLUMNS, [rental(11, 2011)], 100)
+        session.rollback()
+    assert not (tmp_path / 'warehouse_2011.db').exists()
+
+
+def load_with(runner, tmp_path, name, **kwargs):
+    """Full-loads a fresh warehouse from the stand-in source.db in tmp_path with
+    one of the step runners. Returns every warehouse row and the checkpoints."""
+    from sqlalchemy.orm import sessionmaker
+    from models import LiteBase, LoadCheckpoint
+    from sync import full_load_steps, populate_dim_date
+
+    source = create_engine(f"sqlite:///{tmp_path / 'source.db'}")
+    warehouse = create_engine(f"sqlite:///{tmp_path / name}")
+    LiteBase.metadata.create_all(warehouse)
+    with sessionmaker(bind=source)() as mysql_session, sessionmaker(bind=warehouse)() as sqlite_session:
+        populate_dim_date(sqlite_session, 2005, 2005)
+        runner(full_load_steps(), mysql_session, sqlite_session, **kwargs)
+        tables = {table.name: sqlite_session.execute(table.select().order_by(*table.primary_key)).all()
+                  for table in LiteBase.metadata.sorted_tables
+                  if table.name.startswith(('dim_', 'bridge_', 'fact_')) and table.name != 'dim_date'}
+        checkpoints = sorted((c.table_name, c.last_pk, c.rows_loaded, c.completed)
+                             for c in sqlite_session.query(LoadCheckpoint))
+    return tables, checkpoints
+
+
+def test_pipelined_full_load_matches_serial(tmp_path):
+    """Overlapping extract, transform and load writes the same rows and checkpoints"""
+    from sqlalchemy.orm import Session
+    from sync import run_steps, run_steps_pipelined, run_full_load
+
+    source = create_engine(f"sqlite:///{tmp_path / 'source.db'}")
+    SakilaBase.metadata.create_all(source)
+    with Session(source) as session:
+        seed_source(session, rentals=5)
+
+    serial = load_with(run_steps, tmp_path, 'serial.db', chunk_size=2, batch_size=None, ctx={})
+    pipelined = load_with(run_steps_pipelined, tmp_path, 'pipelined.db', chunk_size=2, batch_size=None, ctx={})
+    assert len(serial[0]['fact_rental']) == 5 and len(serial[0]['fact_payment']) == 5
+    assert pipelined == serial
+
+    with pytest.raises(ValueError):
+        run_full_load(workers=2, pipeline=True)
+
+
+def test_parallel_full_load_matches_serial(tmp_path, monkeypatch):
+    """Two extract workers feeding the single writer load the same rows and checkpoints.
+    The source is SQLite, so the MySQL snapshot statements are skipped"""
+    from sqlalchemy.orm import Session
+    import sync
+    from sync import run_steps, run_steps_parallel
+
+    source = create_engine(f"sqlite:///{tmp_path / 'source.db'}")
+    SakilaBase.metadata.create_all(source)
+    with Session(source) as session:
+        seed_source(session, rentals=5)
+    monkeypatch.setattr(sync, 'mysql_engine', source)
+
+    def parallel(steps, mysql_session, sqlite_session):
+        run_steps_parallel(steps, sqlite_session, 2, None, {}, workers=2, queue_depth=1)
+
+    serial = load_with(run_steps, tmp_path, 'serial.db', chunk_size=2, batch_size=None, ctx={})
+    assert load_with(parallel, tmp_path, 'parallel.db') == serial
+
+
+def test_bulk_load_mode_restores_after_failure(tmp_path):
+    """A load failing inside bulk mode still gets its indexes and PRAGMAs back"""
+    from models import LiteBase
+    from sync import bulk_load_mode, BULK_LOAD_PRAGMAS
+
+    #One pooled connection, so the PRAGMAs read afterwards are the ones bulk mode changed
+    engine = create_engine(f"sqlite:///{tmp_path / 'warehouse.db'}", pool_size=1, max_overflow=0)
+    LiteBase.metadata.create_all(engine)
+
+    def settings():
+        with engine.connect() as conn:
+            pragmas = {name: conn.exec_driver_sql(f"PRAGMA {name}").scalar() for name in BULK_LOAD_PRAGMAS}
+        indexes = {index['name'] for table in inspect(engine).get_table_names()
+                   for index in inspect(engine).get_indexes(table)}
+        return pragmas, indexes
+
+    pragmas, indexes = settings()
+    assert 'idx_fact_rental_id' in indexes
+    with pytest.raises(RuntimeError):
+        with bulk_load_mode(engine) as conn:
+            assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 0
+            assert conn.exec_driver_sql("SELECT count(*) FROM sqlite_master WHERE name = 'idx_fact_rental_id'").scalar() == 0
+            raise RuntimeError("load failed")
+    assert settings() == (pragmas, indexes)
+
+
+def test_incremental_rolls_back_on_a_bad_partition(tmp_path, monkeypatch):
+    """Only the store/days a run touched are re-checked, a mismatch in one rolls the run back"""
+    import metrics
+    import sync
+    from sqlalchemy.orm import sessionmaker
+    from models import LiteBase, SyncRun
+    from sync import SYNC_GRAPH, load_dims, load_facts, populate_dim_date, rebuild_store_daily, update_sync_state
+
+    monkeypatch.setattr(metrics, 'METRICS_PATH', str(tmp_path / 'metrics.jsonl'))
+    source = create_engine(f"sqlite:///{tmp_path / 'source.db'}")
+    SakilaBase.metadata.create_all(source)
+    Source = sessionmaker(bind=source)
+    warehouse = create_engine(f"sqlite:///{tmp_path / 'warehouse.db'}")
+    LiteBase.metadata.create_all(warehouse)
+    Warehouse = sessionmaker(bind=warehouse)
+
+    with Source() as session:
+        seed_source(session)
+        day = datetime(2005, 6, 2, 12, 0)
+        session.add(Rental(rental_id=2, rental_date=day, inventory_id=1, customer_id=1, staff_id=1))
+        session.flush()
+        session.add(Payment(payment_id=2, customer_id=1, staff_id=1, rental_id=2, amount=4.99, payment_date=day))
+        session.commit()
+    with Source() as mysql_session, Warehouse() as sqlite_session:
+        populate_dim_date(sqlite_session, 2005, 2005)
+        load_dims(mysql_session, sqlite_session)
+        load_facts(mysql_session, sqlite_session)
+        rebuild_store_daily(sqlite_session)
+        for node in SYNC_GRAPH:
+            update_sync_state(sqlite_session, node.name, datetime.now())
+        #Corrupt June 2nd in the warehouse only
+        sqlite_session.query(FactPayment).filter_by(payment_id=2).update({'amount': 0})
+        sqlite_session.commit()
+
+    def return_rental(rental_id, minutes):
+        with Source() as session:
+            session.query(Rental).filter_by(rental_id=rental_id).update({
+                'return_date': datetime(2005, 6, 5), 'last_update': datetime.now() + timedelta(minutes=minutes)})
+            session.commit()
+
+    def returned(rental_id):
+        with Warehouse() as session:
+            return session.query(FactRental.date_key_returned).filter_by(rental_id=rental_id).scalar()
+
+    #June 1st is re-checked and matches, the bad June 2nd isn't looked at
+    return_rental(1, 1)
+    sync.run_sync(Source(), Warehouse(), workers=1)
+    assert returned(1) == 20050605
+
+    #Touching June 2nd finds the mismatch, nothing of the run is kept
+    return_rental(2, 2)
+    sync.run_sync(Source(), Warehouse(), workers=1)
+    assert returned(2) is None
+    with Warehouse() as session:
+        assert [run.status for run in session.query(SyncRun).order_by(SyncRun.run_id)] == ['ok', 'rolled_back']
+
+
+def test_pipelined_incremental_reads_the_given_source(tmp_path):
+    """The pipelined fact syncs extract from the session passed in, not the configured MySQL"""
+    from sqlalchemy.orm import sessionmaker
+    from models import LiteBase
+    from pipeline import Pipeline
+    from sync import load_dims, populate_dim_date, sync_fact_rental_inc, sync_fact_payment_inc
+
+    source = create_engine(f"sqlite:///{tmp_path / 'source.db'}")
+    SakilaBase.metadata.create_all(source)
+    warehouse = create_engine("sqlite://")
+    LiteBase.metadata.create_all(warehouse)
+    with sessionmaker(bind=source)() as mysql_session, sessionmaker(bind=warehouse)() as sqlite_session:
+        seed_source(mysql_session, rentals=3)
+        populate_dim_date(sqlite_session, 2005, 2005)
+        load_dims(mysql_session, sqlite_session)
+        assert sync_fact_rental_inc(mysql_session, sqlite_session, Pipeline('fact_rental')) == 3
+        assert sync_fact_payment_inc(mysql_session, sqlite_session, Pipeline('fact_payment')) == 3
+        assert sqlite_session.query(FactPayment).count() == 3
@@ -0,0 +1,109 @@
+from models import MAPPINGS
+
+#Compiled transforms, by (model, source fields)
+_compiled = {}
+
+_CONVERSIONS = {
+    None: '{0}',
+    'text': 'str({0})',
+    'flag': '(1 if {0} else 0)',
+    'float': 'float({0})',
+    #Plain arithmetic, several times faster than strftime and parsing it back
+    'date_key': '(None if {0} is None else {0}.year * 10000 + {0}.month * 100 + {0}.day)',
+    'days': '((({1}) - ({0})).total_seconds() / 86400 if {0} and {1} else None)',
+}
+
+
+def mapped_columns(model):
+    """Warehouse columns a transform for model fills, in tuple order."""
+    return tuple(column for column, _, _ in MAPPINGS[model])
+
+
+def key_fields(model):
+    """(source field, Dim model) of every key a transform for model resolves."""
+    return tuple((source, conversion) for _, source, conversion in MAPPINGS[model]
+                 if conversion not in _CONVERSIONS)
+
+
+def key_models(model):
+    """Dimensions whose key maps a transform for model reads from ctx."""
+    return tuple(dim for _, dim in key_fields(model))
+
+
+def lookup_many(key_map, ids):
+    """Keys of a list of ids, None where missing. KeyMaps look the whole list
+    up at once, plain dicts one id at a time."""
+    get_many = getattr(key_map, 'get_many', None)
+    if get_many is not None:
+        return get_many(ids)
+    get = key_map.get
+    return [get(i) for i in ids]
+
+
+def compile_mapping(model, fields, keep_missing=False):
+    """Builds the transform for model's mapping over source rows with the given
+    fields. The row is unpacked into locals once and every column is a single
+    expression, so there is no per-row dict or attribute lookup. Dimension keys
+    are looked up for the whole chunk before the loop, rows missing one are
+    dropped, or kept with a NULL key when keep_missing."""
+    names = {field: f'f{i}' for i, field in enumerate(fields)}
+    missing = [source for _, source, _ in MAPPINGS[model]
+               for source in (source if isinstance(source, tuple) else (source,)) if source not in names]
+    if missing:
+        raise ValueError(f"{model.__tablename__} needs {missing}, source rows only have {list(fields)}")
+
+    namespace = {'lookup_many': lookup_many}
+    setup, key_columns, values = [], [], []
+    for column, source, conversion in MAPPINGS[model]:
+        sources = source if isinstance(source, tuple) else (source,)
+        args = [names[s] for s in sources]
+        if conversion in _CONVERSIONS:
+            values.append(_CONVERSIONS[conversion].format(*args))
+        else:
+            model_name = f'm_{column}'
+            namespace[model_name] = conversion
+            position = fields.index(sources[0])
+            setup.append(f'    keys_{column} = lookup_many(ctx[{model_name}], [row[{position}] for row in chunk])')
+            key_columns.append(column)
+            values.append(f'k_{column}')
+
+    unpack = ', '.join(names.values()) + (',' if len(names) == 1 else '')
+    row = '(' + ', '.join(values) + (',)' if len(values) == 1 else ')')
+    if key_columns and not keep_missing:
+        found = ', '.join(f'k_{column}' for column in key_columns)
+        looked_up = ', '.join(f'keys_{column}' for column in key_columns)
+        missing = ' or '.join(f'k_{column} is None' for column in key_columns)
+        body = setup + ['    rows = []', '    append = rows.append',
+                        f'    for ({unpack}), {found} in zip(chunk, {looked_up}):',
+                        f'        if {missing}: continue',
+                        f'        append({row})', '    return rows']
+    elif key_columns:
+        found = ', '.join(f'k_{column}' for column in key_columns)
+        looked_up = ', '.join(f'keys_{column}' for column in key_columns)
+        body = setup + [f'    return [{row} for ({unpack}), {found} in zip(chunk, {looked_up})]']
+    else:
+        body = [f'    return [{row} for {unpack} in chunk]']
+    source_code = 'def transform(chunk, ctx):\n' + '\n'.join(body) + '\n'
+    exec(compile(source_code, f'<transform {model.__tablename__}>', 'exec'), namespace)
+    return namespace['transform']
+
+
+def transform_for(model, fields, keep_missing=False):
+    """The compiled transform of model for rows with these fields, compiled on
+    first use."""
+    key = (model, tuple(fields), keep_missing)
+    transform = _compiled.get(key)
+    if transform is None:
+        transform = _compiled[key] = compile_mapping(model, key[1], keep_missing)
+    return transform
+
+
+def transform_rows(model, chunk, ctx=None, fields=None, keep_missing=False):
+    """Tuples for model from a chunk of source rows (query result rows, whose
+    fields are read off the first one, or plain tuples with fields given).
+    ctx holds {Dim model: key map} for the dimensions resolved, a KeyMap or a
+    plain {source id: key} dict. Rows with a key missing from ctx are dropped,
+    unless keep_missing, then the key is None."""
+    if not chunk:
+        return []
+    return transform_for(model, fields or chunk[0]._fields, keep_missing)(chunk, ctx or {})